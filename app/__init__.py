@@ -1,54 +1,58 @@
 from flask import Flask
-from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_openid import OpenID
-from config import basedir, ADMINS, MAIL_SERVER, MAIL_PORT, MAIL_USERNAME, MAIL_PASSWORD
-from elasticsearch import Elasticsearch
+from config import basedir
 from flask_mail import Mail
 import os
+from app.replicas import RoutingSQLAlchemy
 
 app = Flask(__name__)
 # 在flask web service被创建后，读取config文件
 app.config.from_object('config')
-db = SQLAlchemy(app)
+# 部署时可以用环境变量MICROBLOG_SETTINGS指定一个覆盖config.py的配置文件，导入时就会生效
+app.config.from_envvar('MICROBLOG_SETTINGS', silent=True)
+# 配置了只读副本时，只读视图里的查询由RoutingSQLAlchemy的session发给副本，见app/replicas.py
+db = RoutingSQLAlchemy(app)
 # Flask-openID需要一个存储临时文件的路径
 lm = LoginManager()
 lm.init_app(app)
 # 告知login manager这个view允许用户登录
 lm.login_view = 'login'
+# 存储在第一次登录时才创建
 oid = OpenID(app, os.path.join(basedir, 'tmp'))
-# 初始163化邮件服务器
+# 初始163化邮件服务器，只是保存配置，第一次发邮件时才连接SMTP服务器
 mail = Mail(app)
-# 初始化全文搜索引擎Elasticsearch
-es = Elasticsearch(app.config.get('ES_HOSTS')) if app.config.get('ES_HOSTS') else None
-if es:
-    if not es.indices.exists(app.config.get('POSTS_FULL_TEXT')):
-        es.indices.create(index=app.config.get('POSTS_FULL_TEXT'), body=app.config.get('MAPPING'))
+# 全文搜索引擎Elasticsearch的客户端在app/search.py里，第一次使用时才创建，导入app时不再连接ES；
+# 索引的初始化由bootstrap.py完成，ES连不上也不影响web进程启动
 
-from app import views, models
+from app import views, models, timeline, fragments, api, metrics
 
-# 在生产模式下，使用logging记录出错信息，使用邮件发送给管理员
-if not app.debug:
-    import logging
-    # 使用邮件发送异常
-    from logging.handlers import SMTPHandler
-    credentials = None
-    if MAIL_USERNAME or MAIL_PASSWORD:
-        credentials = (MAIL_SERVER, MAIL_PASSWORD)
-    # Python的logging模块自带SMTP功能，所以可以直接使用logging的SMTP handler
-    mail_handler = SMTPHandler((MAIL_SERVER, MAIL_PORT), 'no-reply@'+MAIL_SERVER, ADMINS, 'microblog failure', credentials)
-    mail_handler.setLevel(logging.ERROR)
-    # Flask默认自带一个logger
-    app.logger.addHandler(mail_handler)
-# 如果你的部署环境没有打开SMTP服务，那么可以使用python自带的SMTP调试服务器顶上
-# >>> python -m smtp -n -c DebuggingServer localhost:25
-# 当这个邮件服务器运行后，应用程序发送的邮件将会被接受并显示在命令行窗口上。
+logging_configured = False
 
-    # 使用文件记录异常
-    from logging.handlers import RotatingFileHandler
-    file_handler = RotatingFileHandler('tmp/microblog.log', 'a', 1*1024*1024*1024, 10)
-    file_handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'))
-    app.logger.setLevel(logging.INFO)
-    file_handler.setLevel(logging.INFO)
-    app.logger.addHandler(file_handler)
+
+def configure_logging(app):
+    # 在生产模式下，使用logging记录出错信息，使用邮件发送给管理员。
+    # 以前SMTPHandler和RotatingFileHandler直接挂在app.logger上，每条ERROR都在出错的请求里同步连接一次SMTP服务器，
+    # 一波错误就是一波邮件，把worker都卡住。现在请求里只把日志放进队列，写文件和发邮件都在后台线程里，
+    # 同一个错误在一段时间内只发一封邮件，见app/logs.py
+    global logging_configured
+    if logging_configured or app.debug or app.testing:
+        return
+    logging_configured = True
+    from app.logs import setup_logging
+    setup_logging(app)
+    # 如果你的部署环境没有打开SMTP服务，那么可以使用python自带的SMTP调试服务器顶上
+    # >>> python -m smtp -n -c DebuggingServer localhost:25
+    # 当这个邮件服务器运行后，应用程序发送的邮件将会被接受并显示在命令行窗口上。
     app.logger.info('microblog startup')
+
+
+def configure_app():
+    # 给run.py、WSGI服务器和后台脚本用的入口：导入app只创建对象，不连接任何外部服务，日志在这里才配置，
+    # 打开了的关注图和热门话题也在这里导入（它们依赖numpy，关掉时一直不导入，见app/features.py）。
+    # 这不是创建新app的工厂：视图和模型都直接挂在上面的全局app上，这里返回的总是同一个app。
+    # 搜索后端、缓存大小这些配置在导入时就读取了，所以这里不接受配置参数，配置只能来自config.py和MICROBLOG_SETTINGS
+    from app.features import load_enabled
+    configure_logging(app)
+    load_enabled()
+    return app
@@ -0,0 +1,84 @@
+from app import app, db
+from app.models import User, unique_nicknames
+from werkzeug.security import generate_password_hash
+from sqlalchemy.exc import IntegrityError
+from itertools import islice, chain
+import csv
+import json
+
+# 批量导入用户（import_users.py）
+# 每批先用一条查询去掉已经注册过的email，再用一条查询给整批用户分配nickname，
+# 最后用一条executemany的INSERT写入，不经过ORM，也就不会为每个用户flush一次。
+
+
+def read_rows(path):
+    # CSV要有表头；JSON可以是一个数组，也可以每行一个对象（JSON Lines）。ingest.py也用它读博客和关注关系，
+    # CSV和JSON Lines是边读边返回的，JSON数组要整个读进内存，大文件请用前两种
+    with open(path, encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            for row in csv.DictReader(f):
+                yield row
+            return
+        first = f.read(1)
+        while first.isspace():
+            first = f.read(1)
+        if first == '[':
+            for row in json.loads(first + f.read()):
+                yield row
+            return
+        for line in chain([first + f.readline()], f):
+            if line.strip():
+                yield json.loads(line)
+
+
+def account_values(row, nickname):
+    # executemany要求每一行的列都一样，没有密码的用户password_hash为None
+    password_hash = row.get('password_hash') or None
+    if password_hash is None and row.get('password'):
+        password_hash = generate_password_hash(row['password'])
+    return {'nickname': nickname, 'email': row['email'], 'about_me': row.get('about_me') or None,
+            'password_hash': password_hash}
+
+
+def import_batch(rows):
+    # 返回(导入的用户数, 跳过的用户数)，没有email或者email已经存在的跳过
+    emails = set(row['email'] for row in rows if row.get('email'))
+    existing = set(email for email, in db.session.query(User.email).filter(User.email.in_(emails))) if emails else set()
+    accepted = []
+    for row in rows:
+        email = row.get('email')
+        if not email or email in existing:
+            continue
+        # 同一批里重复的email只导入第一个
+        existing.add(email)
+        accepted.append(row)
+    if accepted:
+        nicknames = unique_nicknames([row.get('nickname') or row['email'].split('@')[0] for row in accepted])
+        db.session.execute(User.__table__.insert(), [account_values(row, nickname)
+                                                     for row, nickname in zip(accepted, nicknames)])
+    db.session.commit()
+    return len(accepted), len(rows) - len(accepted)
+
+
+def import_accounts(rows, batch_size=None, report=None):
+    batch_size = batch_size or app.config['USER_IMPORT_BATCH']
+    rows = iter(rows)
+    imported = skipped = 0
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        # 导入的同时有用户注册的话，nickname或email可能被抢先用掉，整批回滚后重新分配
+        for attempt in range(app.config['NICKNAME_RETRIES']):
+            try:
+                done, rejected = import_batch(batch)
+                break
+            except IntegrityError:
+                db.session.rollback()
+                if attempt == app.config['NICKNAME_RETRIES'] - 1:
+                    raise
+        imported += done
+        skipped += rejected
+        if report:
+            report(imported, skipped)
+    return imported, skipped
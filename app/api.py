@@ -0,0 +1,143 @@
+from app import app, db, lm
+from app.models import Post, get_user_by_nickname
+from app.timeline import home_timeline
+from app.pagination import keyset_paginate, cursor_depth, encode_cursor, decode_cursor, InvalidCursor
+from app.replicas import replica_reads
+from app.features import trending_terms
+from flask import g, request, url_for, jsonify, Response, stream_with_context, flash, redirect
+from flask_login import login_required, login_url
+from sqlalchemy import tuple_
+from itertools import islice
+import json
+
+# 给移动客户端和数据导出用的JSON API，不经过HTML模板
+# /api/timeline和/api/users/<nickname>/posts用和网页一样的before/after游标翻页，
+# /api/users/<nickname>/posts/export把一个用户的所有博客导出成NDJSON（每行一个JSON对象），
+# 数据库那边用服务端游标分批读取，边读边发，博客再多内存占用也不会增加。
+# /api/trending返回首页上的热门话题，计数是估计值。
+
+
+def author_json(user):
+    return {'id': user.id, 'nickname': user.nickname, 'avatar': user.avatar(50)}
+
+
+def post_json(post, author):
+    return {'id': post.id, 'body': post.body, 'timestamp': post.timestamp.isoformat() + 'Z' if post.timestamp else None,
+            'author': author}
+
+
+def page_json(posts, endpoint, **values):
+    # 同一个作者的信息（头像要算md5）在一页里只生成一次
+    authors = {}
+    items = []
+    for post in posts.items:
+        if post.user_id not in authors:
+            authors[post.user_id] = author_json(post.author)
+        items.append(post_json(post, authors[post.user_id]))
+    limit = request.args.get('limit', type=int)
+    return jsonify({
+        'posts': items,
+        'next': url_for(endpoint, before=posts.next_cursor, limit=limit, **values) if posts.has_next else None,
+        'prev': url_for(endpoint, after=posts.prev_cursor, limit=limit, **values) if posts.has_prev else None,
+    })
+
+
+def error(status, message):
+    # 不用abort()，网页的错误处理函数返回的是HTML页面
+    return jsonify({'error': message}), status
+
+
+@lm.unauthorized_handler
+def unauthorized():
+    # 没登录时flask-login默认重定向到网页的登录页，API的客户端拿到的是302和一个HTML页面，
+    # 所以/api/下面返回JSON的401，网页还是和原来一样提示并重定向到lm.login_view
+    if request.path.startswith('/api/'):
+        return error(401, 'login required')
+    flash(lm.login_message, category=lm.login_message_category)
+    return redirect(login_url(lm.login_view, next_url=request.url))
+
+
+def per_page():
+    limit = request.args.get('limit', app.config['API_PER_PAGE'], type=int)
+    return max(1, min(limit, app.config['API_MAX_PER_PAGE']))
+
+
+@app.route('/api/timeline')
+@login_required
+@replica_reads
+def api_timeline():
+    before = request.args.get('before')
+    after = request.args.get('after')
+    limit = per_page()
+    try:
+        timeline = home_timeline(g.user, cursor_depth(limit, before, after))
+        posts = keyset_paginate(timeline, limit, before, after)
+    except InvalidCursor:
+        return error(400, 'invalid cursor')
+    return page_json(posts, 'api_timeline')
+
+
+@app.route('/api/users/<nickname>/posts')
+@login_required
+@replica_reads
+def api_user_posts(nickname):
+    user = get_user_by_nickname(nickname)
+    if user is None:
+        return error(404, 'user %s not found' % nickname)
+    try:
+        posts = keyset_paginate(user.posts, per_page(), request.args.get('before'), request.args.get('after'))
+    except InvalidCursor:
+        return error(400, 'invalid cursor')
+    return page_json(posts, 'api_user_posts', nickname=nickname)
+
+
+@app.route('/api/users/<nickname>/posts/export')
+@login_required
+@replica_reads
+def api_export_posts(nickname):
+    user = get_user_by_nickname(nickname)
+    if user is None:
+        return error(404, 'user %s not found' % nickname)
+    # 只查询需要的列，不创建Post对象，也就不会堆在session的identity map里
+    query = db.session.query(Post.id, Post.body, Post.timestamp).filter(Post.user_id == user.id)
+    before = request.args.get('before')
+    position = 0
+    if before:
+        # 导出中断后可以用最后一行的cursor接着导出
+        try:
+            timestamp, id, position = decode_cursor(before)
+        except InvalidCursor:
+            return error(400, 'invalid cursor')
+        query = query.filter(tuple_(Post.timestamp, Post.id) < tuple_(timestamp, id))
+        position += 1
+    chunk = app.config['API_EXPORT_CHUNK']
+    # stream_results让psycopg2使用服务端游标，yield_per每次只取chunk行
+    rows = query.order_by(Post.timestamp.desc(), Post.id.desc()).execution_options(stream_results=True).yield_per(chunk)
+    author = author_json(user)
+
+    def generate():
+        # 第一次读取时才执行查询，这时已经在返回响应的过程中了
+        # 每行带着自己的游标，和/api/users/<nickname>/posts的before是同一种
+        results = enumerate(rows, position)
+        while True:
+            # 没有时间的旧博客生成不了游标（响应已经开始发送，不能再报错），cursor为null，
+            # 客户端断开后从前面最近的一个cursor接着导出
+            lines = [json.dumps(dict(post_json(row, author),
+                                     cursor=encode_cursor(row, i) if row.timestamp else None)) + '\n'
+                     for i, row in islice(results, chunk)]
+            if not lines:
+                break
+            yield ''.join(lines)
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': 'attachment; filename=%s-posts.ndjson' % user.id})
+
+
+@app.route('/api/trending')
+@login_required
+@replica_reads
+def api_trending():
+    limit = request.args.get('limit', app.config['TRENDING_TOP'], type=int)
+    terms = trending_terms(max(1, min(limit, app.config['TRENDING_TOP'] * 10)))
+    return jsonify({'terms': [{'term': term, 'posts': count} for term, count in terms],
+                    'window': app.config['TRENDING_WINDOW']})
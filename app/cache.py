@@ -0,0 +1,108 @@
+from app import app
+from collections import OrderedDict
+from werkzeug.utils import import_string
+import threading
+import time
+
+# 两级缓存：进程内的LRU（带过期时间）加上一个可选的共享缓存层。
+# 共享层可以是memcached、redis等，只要提供get(key)、set(key, value, ttl)、delete(key)三个方法，
+# 在config.py的CACHE_SHARED_TIER中填写'模块:工厂函数'，工厂函数接受app参数并返回这个对象。
+# 进程内的缓存无法被其他进程失效，所以它的有效期要设置得比较短。
+
+
+class LRUCache():
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            item = self.data.get(key)
+            if item is None or item[1] < time.time():
+                if item is not None:
+                    del self.data[key]
+                self.misses += 1
+                return None
+            self.data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def set(self, key, value, ttl=None):
+        with self.lock:
+            self.data[key] = (value, time.time() + (ttl or self.ttl))
+            self.data.move_to_end(key)
+            while len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+_shared_tier = None
+
+
+def shared_tier():
+    # 第一次使用时才创建共享层，没有配置的话返回None
+    global _shared_tier
+    if _shared_tier is None and app.config.get('CACHE_SHARED_TIER'):
+        _shared_tier = import_string(app.config['CACHE_SHARED_TIER'])(app)
+    return _shared_tier
+
+
+class TieredCache():
+    def __init__(self, name, maxsize, ttl, shared_ttl):
+        self.name = name
+        self.local = LRUCache(maxsize, ttl)
+        self.shared_ttl = shared_ttl
+        self.shared_hits = 0
+        self.shared_misses = 0
+
+    def key(self, key):
+        # 共享层可能被多个缓存共用，所以加上缓存的名字做前缀
+        return '%s:%s' % (self.name, key)
+
+    def get(self, key):
+        value = self.local.get(key)
+        if value is not None:
+            return value
+        shared = shared_tier()
+        if shared is None:
+            return None
+        value = shared.get(self.key(key))
+        if value is None:
+            self.shared_misses += 1
+            return None
+        self.shared_hits += 1
+        self.local.set(key, value)
+        return value
+
+    def set(self, key, value):
+        self.local.set(key, value)
+        shared = shared_tier()
+        if shared is not None:
+            shared.set(self.key(key), value, self.shared_ttl)
+
+    def delete(self, key):
+        self.local.delete(key)
+        shared = shared_tier()
+        if shared is not None:
+            shared.delete(self.key(key))
+
+    def stats(self):
+        # 进程内没命中的才会去共享层，所以总的查找次数就是进程内的查找次数
+        lookups = self.local.hits + self.local.misses
+        return {
+            'local_hits': self.local.hits, 'local_misses': self.local.misses,
+            'shared_hits': self.shared_hits, 'shared_misses': self.shared_misses,
+            'hit_rate': float(self.local.hits + self.shared_hits) / lookups if lookups else 0.0,
+            'size': len(self.local.data)
+        }
@@ -0,0 +1,89 @@
+from app import app, db
+from app.models import Post, followers
+from app.features import current_graph, trending_terms
+from app import timeline
+from flask import request, session, g
+from flask_wtf.csrf import generate_csrf
+from werkzeug.http import is_resource_modified
+from sqlalchemy import func
+from hashlib import md5
+import time
+
+# 首页和个人主页的条件GET（ETag / Last-Modified / 304）
+# 浏览器和代理每次都要完整地重新请求这两个页面，其实大部分时候页面并没有变化。
+# 这里在查询博客和渲染模板之前，先用几条很便宜的查询算出页面的版本，和请求头里的If-None-Match/If-Modified-Since一致就直接返回304。
+# ETag覆盖页面上会变化的所有内容，Last-Modified只是最新博客的时间，所以两个都有时以ETag为准（werkzeug就是这样处理的）。
+# 注意：页面上其他作者修改nickname或者头像不会改变ETag，要等有新博客或者CSRF时间段变化时才会重新渲染。
+
+
+def user_version(user):
+    # 页面上显示的nickname、头像（由email算出）和about_me
+    return md5(('%s\0%s\0%s' % (user.nickname, user.email, user.about_me)).encode('utf-8')).hexdigest()
+
+
+def csrf_parts():
+    # 表单里的CSRF token带着签名时间，超过WTF_CSRF_TIME_LIMIT就会失效。
+    # 把session里的原始token和半个有效期的时间段放进ETag，换了session或者token快过期时都会重新渲染
+    if not app.config.get('WTF_CSRF_ENABLED', True):
+        return ()
+    # 第一次访问时session里还没有token，先生成出来，渲染模板时会用同一个
+    generate_csrf()
+    limit = app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    bucket = int(time.time() // (limit / 2)) if limit else 0
+    return (session.get(app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token')), bucket)
+
+
+def timeline_validator(user):
+    # 关注的人（包括自己）最新一条博客的时间，再加上关注了哪些人和热门话题。
+    # 打开了TIMELINE_ENABLED时从时间线表读；否则要对每个关注的人在ix_post_user_timestamp_id上各查一次最大值，
+    # 这个索引覆盖了(user_id, timestamp)，每次只读一行，但是开销和关注的人数成正比，关注几千人时就不便宜了
+    if timeline.enabled():
+        newest = timeline.newest_timestamp(user)
+    else:
+        newest = db.session.query(func.max(Post.timestamp)).join(followers, followers.c.followed_id == Post.user_id) \
+            .filter(followers.c.follower_id == user.id).scalar()
+    followed = md5(','.join(str(id) for id in sorted(user.followed_ids())).encode('utf-8')).hexdigest()
+    return ('index', user.id, user_version(user), followed, newest, tuple(trending_terms())) + csrf_parts(), newest
+
+
+def profile_validator(user, viewer):
+    # 这个用户最新一条博客的时间、资料和计数器，以及浏览者是否关注了他（决定显示Follow还是Unfollow）
+    newest = db.session.query(func.max(Post.timestamp)).filter(Post.user_id == user.id).scalar()
+    # followed_ids()在一次请求里只查一次，渲染模板时的is_following()直接使用它的结果。
+    # 推荐关注和“Follows you”来自内存中的关注图，图重新加载后页面也要重新渲染
+    graph = current_graph()
+    return ('user', user.id, user_version(user), user.last_seen, user.post_count, user.follower_count,
+            user.followed_count, newest, viewer.id, user_version(viewer), user.id in viewer.followed_ids(),
+            graph.built_at if graph is not None else None), newest
+
+
+def not_modified(validator):
+    # 页面没有变化时返回304响应，否则返回None，由视图正常渲染，after_request时再加上ETag和Last-Modified
+    parts, last_modified = validator
+    # 有待显示的flash消息时必须渲染页面，否则消息就不会被取出来显示
+    if session.get('_flashes'):
+        return None
+    etag = md5(repr(parts).encode('utf-8')).hexdigest()
+    g.validators = (etag, last_modified)
+    if is_resource_modified(request.environ, etag=etag, last_modified=last_modified):
+        return None
+    return add_validators(app.response_class(status=304))
+
+
+def add_validators(response):
+    etag, last_modified = g.validators
+    response.set_etag(etag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    # 页面因人而异，只能由浏览器缓存，并且每次使用前都要验证
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+@app.after_request
+def after_request(response):
+    if 'validators' in g and response.status_code == 200:
+        add_validators(response)
+    return response
@@ -1,8 +0,0 @@
-from threading import Thread
-
-
-def async_(f):
-    def wrapper(*args, **kwargs):
-        thr = Thread(target=f, args=args, kwargs=kwargs)
-        thr.start()
-    return wrapper
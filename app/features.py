@@ -0,0 +1,50 @@
+from app import app
+import sys
+
+# 关注图（app/graph.py）和热门话题（app/trending.py）要导入numpy，热门话题还会在session上挂事件。
+# 视图通过这里使用它们：GRAPH_ENABLED/TRENDING_ENABLED关掉时这两个模块不会被导入，
+# 打开时由configure_app()在启动时导入，这里的import只是从sys.modules里取出来
+
+
+def current_graph():
+    if not app.config['GRAPH_ENABLED']:
+        return None
+    from app.graph import current_graph
+    return current_graph()
+
+
+def who_to_follow(user):
+    if not app.config['GRAPH_ENABLED']:
+        return []
+    from app.graph import who_to_follow
+    return who_to_follow(user)
+
+
+def graph_stats():
+    # 统计只看有没有导入过：运行中关掉的话，已经加载的图还占着内存，照样报告
+    if 'app.graph' not in sys.modules:
+        return {'users': 0, 'edges': 0, 'bytes': 0, 'age': None}
+    from app.graph import graph_stats
+    return graph_stats()
+
+
+def trending_terms(k=None):
+    if not app.config['TRENDING_ENABLED']:
+        return []
+    from app.trending import trending_terms
+    return trending_terms(k)
+
+
+def trending_stats():
+    if 'app.trending' not in sys.modules:
+        return {'bytes': 0, 'posts': 0}
+    from app.trending import trending_stats
+    return trending_stats()
+
+
+def load_enabled():
+    # 启动时导入打开了的功能，第一个请求不用再等numpy导入，热门话题的事件也从启动起就在统计
+    if app.config['GRAPH_ENABLED']:
+        from app import graph
+    if app.config['TRENDING_ENABLED']:
+        from app import trending
@@ -0,0 +1,36 @@
+from app import app
+from app.cache import TieredCache
+from flask import render_template
+from markupsafe import Markup
+from hashlib import md5
+
+# 博客片段的缓存
+# 时间线、个人主页和搜索结果页每一条博客都要渲染一次post.html，其中还要算作者头像的md5、转义正文。
+# 博客发出后就不会再修改，同一条博客会被渲染成千上万次，所以把渲染结果按博客id缓存起来。
+# 片段里有作者的nickname和头像（由email算出），键里带上这两个字段的版本，作者修改资料后旧的片段不会再被读到。
+
+fragment_cache = TieredCache('fragment', app.config['FRAGMENT_CACHE_SIZE'], app.config['FRAGMENT_CACHE_TTL'],
+                             app.config['FRAGMENT_CACHE_SHARED_TTL'])
+
+
+def author_version(user):
+    return md5(('%s\0%s' % (user.nickname, user.email)).encode('utf-8')).hexdigest()[:12]
+
+
+def render_post(post):
+    # 模板里用{{ render_post(post) }}代替{% include 'post.html' %}
+    if not app.config['FRAGMENT_CACHE_ENABLED']:
+        return Markup(render_template('post.html', post=post))
+    key = '%d:%s' % (post.id, author_version(post.author))
+    html = fragment_cache.get(key)
+    if html is None:
+        html = render_template('post.html', post=post)
+        fragment_cache.set(key, html)
+    return Markup(html)
+
+
+def fragment_cache_stats():
+    return fragment_cache.stats()
+
+
+app.add_template_global(render_post)
@@ -0,0 +1,208 @@
+from app import app, db
+from app.models import User, followers
+from sqlalchemy import select
+from itertools import chain
+import numpy as np
+import os
+import threading
+import time
+
+# 内存中的关注图
+# followers表按CSR（压缩稀疏行）格式加载成几个numpy数组：ids是排好序的用户id，
+# 用户在ids中的下标为u时，他关注的人是out_idx[out_ptr[u]:out_ptr[u + 1]]，他的粉丝是in_idx[in_ptr[u]:in_ptr[u + 1]]，
+# 都是ids中的下标，并且升序排列。推荐关注（二度关系）、互相关注、粉丝重合度都用向量化的数组运算完成，不用再join followers表。
+# 每个进程一份，第一次使用时加载，之后每隔GRAPH_REBUILD_INTERVAL秒在后台线程里重新加载，加载期间继续使用旧的图。
+# 每条边在两个方向上各占一个int32，一百万条边大约8MB，另外每个用户三个int64。
+
+# 二度关系不够时用粉丝最多的用户补足，预先算好这么多个
+POPULAR = 100
+
+
+def csr_pointers(keys, n):
+    # keys是已经排好序的行号，返回每一行在列数组中的起止位置
+    pointers = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n), out=pointers[1:])
+    return pointers
+
+
+def gather(pointers, indices, rows):
+    # 一次取出多行的所有列，相当于np.concatenate([indices[pointers[r]:pointers[r + 1]] for r in rows])，但没有Python循环
+    starts = pointers[rows]
+    lengths = pointers[rows + 1] - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return indices[:0]
+    return indices[np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)]
+
+
+class FollowGraph():
+    def __init__(self, src, dst, built_at=None):
+        # src[i]关注了dst[i]，都是用户id
+        src = np.asarray(src, dtype=np.int64)
+        dst = np.asarray(dst, dtype=np.int64)
+        self.ids = np.unique(np.concatenate([src, dst]))
+        n = len(self.ids)
+        s = np.searchsorted(self.ids, src).astype(np.int32)
+        d = np.searchsorted(self.ids, dst).astype(np.int32)
+        order = np.lexsort((d, s))
+        self.out_ptr = csr_pointers(s[order], n)
+        self.out_idx = d[order]
+        order = np.lexsort((s, d))
+        self.in_ptr = csr_pointers(d[order], n)
+        self.in_idx = s[order]
+        self.in_degree = np.diff(self.in_ptr)
+        self.popular = np.argsort(-self.in_degree, kind='stable')[:POPULAR].astype(np.int32)
+        self.edges = len(src)
+        self.built_at = built_at or time.time()
+
+    def nbytes(self):
+        return sum(array.nbytes for array in (self.ids, self.out_ptr, self.out_idx, self.in_ptr, self.in_idx,
+                                              self.in_degree, self.popular))
+
+    def position(self, user_id):
+        i = int(np.searchsorted(self.ids, user_id))
+        if i < len(self.ids) and self.ids[i] == user_id:
+            return i
+        return None
+
+    def positions(self, user_ids):
+        user_ids = np.fromiter(user_ids, dtype=np.int64)
+        i = np.searchsorted(self.ids, user_ids)
+        found = i < len(self.ids)
+        found[found] = self.ids[i[found]] == user_ids[found]
+        return i[found].astype(np.int32)
+
+    def following(self, u):
+        return self.out_idx[self.out_ptr[u]:self.out_ptr[u + 1]]
+
+    def followers(self, u):
+        return self.in_idx[self.in_ptr[u]:self.in_ptr[u + 1]]
+
+    def follows(self, follower_id, followed_id):
+        a = self.position(follower_id)
+        b = self.position(followed_id)
+        if a is None or b is None:
+            return False
+        row = self.following(a)
+        i = np.searchsorted(row, b)
+        return bool(i < len(row) and row[i] == b)
+
+    def mutual(self, a_id, b_id):
+        return self.follows(a_id, b_id) and self.follows(b_id, a_id)
+
+    def follower_overlap(self, a_id, b_id):
+        # 两个用户共同的粉丝数，以及Jaccard系数（共同粉丝 / 两人粉丝的并集）
+        a = self.position(a_id)
+        b = self.position(b_id)
+        if a is None or b is None:
+            return 0, 0.0
+        fa = self.followers(a)
+        fb = self.followers(b)
+        common = np.intersect1d(fa, fb, assume_unique=True).size
+        union = fa.size + fb.size - common
+        return common, common / union if union else 0.0
+
+    def suggestions(self, user_id, k, exclude=()):
+        # 推荐关注：我关注的人关注了谁。被越多我关注的人关注的排在越前面，一样多时粉丝多的在前，
+        # 返回[(用户id, 我关注的人里有几个关注了他)]，不够k个时用粉丝最多的用户补足（计数为0）
+        u = self.position(user_id)
+        skip = self.positions(exclude)
+        if u is not None:
+            skip = np.concatenate([skip, self.following(u), [u]]).astype(np.int32)
+            candidates, counts = np.unique(gather(self.out_ptr, self.out_idx, self.following(u)), return_counts=True)
+            keep = ~np.isin(candidates, skip)
+            candidates = candidates[keep]
+            counts = counts[keep]
+            # 计数和粉丝数合成一个排序键，先用argpartition选出前k个再排序，候选人很多时也不用整体排序
+            key = counts.astype(np.int64) * (int(self.in_degree.max()) + 1) + self.in_degree[candidates]
+            if len(key) > k:
+                top = np.argpartition(-key, k)[:k]
+                candidates, counts, key = candidates[top], counts[top], key[top]
+            order = np.lexsort((candidates, -key))
+            result = [(int(self.ids[c]), int(n)) for c, n in zip(candidates[order], counts[order])]
+        else:
+            result = []
+        if len(result) < k:
+            taken = set(id for id, n in result)
+            for c in self.popular[~np.isin(self.popular, skip)]:
+                if len(result) >= k:
+                    break
+                if int(self.ids[c]) not in taken:
+                    result.append((int(self.ids[c]), 0))
+        return result
+
+
+def load_graph(chunk_size=None):
+    # 用服务端游标分批读取followers表，每批直接转换成numpy数组，不为每条边创建Python对象
+    chunk_size = chunk_size or app.config['GRAPH_LOAD_CHUNK']
+    started = time.time()
+    chunks = []
+    with db.engine.connect() as conn:
+        result = conn.execution_options(stream_results=True) \
+            .execute(select([followers.c.follower_id, followers.c.followed_id]))
+        while True:
+            rows = result.fetchmany(chunk_size)
+            if not rows:
+                break
+            chunks.append(np.fromiter(chain.from_iterable(rows), dtype=np.int64, count=2 * len(rows)))
+    edges = np.concatenate(chunks).reshape(-1, 2) if chunks else np.empty((0, 2), dtype=np.int64)
+    return FollowGraph(edges[:, 0], edges[:, 1], started)
+
+
+graph = None
+graph_lock = threading.Lock()
+# 正在后台重建的进程号，fork出来的子进程不会继承父进程里的线程
+rebuilding = None
+# 上一次加载失败的时间，之后GRAPH_REBUILD_INTERVAL秒内不再重试，不会每个请求都扫一遍followers表
+failed_at = 0
+
+
+def refresh_graph():
+    global graph, rebuilding, failed_at
+    try:
+        graph = load_graph()
+    except Exception:
+        failed_at = time.time()
+        app.logger.exception('failed to load the follow graph')
+    finally:
+        with graph_lock:
+            rebuilding = None
+    return graph
+
+
+def current_graph():
+    # 返回当前的关注图。第一次使用和过期时都在后台线程里加载，请求不等待：
+    # 还没加载好时返回None（页面上不显示推荐），过期的图在重新加载期间继续使用
+    global rebuilding
+    if not app.config['GRAPH_ENABLED']:
+        return None
+    current = graph
+    interval = app.config['GRAPH_REBUILD_INTERVAL']
+    now = time.time()
+    if (current is None or now - current.built_at >= interval) and now - failed_at >= interval:
+        with graph_lock:
+            if rebuilding != os.getpid():
+                rebuilding = os.getpid()
+                threading.Thread(target=refresh_graph, name='follow-graph', daemon=True).start()
+    return current
+
+
+def who_to_follow(user, k=None):
+    # 个人主页上的推荐关注，返回[(User, 我关注的人里有几个关注了他)]。
+    # 图最多是GRAPH_REBUILD_INTERVAL秒以前的，所以再用这次请求里查到的关注列表过滤一次
+    current = current_graph()
+    if current is None:
+        return []
+    suggested = current.suggestions(user.id, k or app.config['GRAPH_SUGGESTIONS'], user.followed_ids())
+    if not suggested:
+        return []
+    users = dict((u.id, u) for u in User.query.filter(User.id.in_([id for id, n in suggested])))
+    return [(users[id], n) for id, n in suggested if id in users]
+
+
+def graph_stats():
+    current = graph
+    if current is None:
+        return {'users': 0, 'edges': 0, 'bytes': 0, 'age': None}
+    return {'users': len(current.ids), 'edges': current.edges, 'bytes': current.nbytes(),
+            'age': time.time() - current.built_at}
@@ -0,0 +1,174 @@
+from app import app, db
+from app.models import SearchOutbox, searchable_models, search_rebuilds
+from app.search import bulk_index, index_payload, bump_generation, bump_stored_generation
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import json
+import os
+import time
+
+# 后台批量同步ES
+# SearchableMixin.after_flush把修改写进search_outbox表，这里每次取出一批，
+# 同一个文档的多次修改只同步最后的状态，然后用一次bulk请求发给ES。
+# 失败的记录按指数退避重试，成功的记录从outbox中删除。
+
+
+def drain(batch_size=None):
+    # 处理一批outbox记录，返回这次处理了多少条
+    batch_size = batch_size or app.config['SEARCH_OUTBOX_BATCH']
+    now = datetime.utcnow()
+    # 多个worker同时运行时，用SKIP LOCKED避免重复处理同一批记录（SQLite会忽略这个子句）
+    rows = SearchOutbox.query.filter(SearchOutbox.next_attempt <= now).order_by(SearchOutbox.id) \
+        .limit(batch_size).with_for_update(skip_locked=True).all()
+    if not rows:
+        db.session.commit()
+        return 0
+    # 合并同一个文档的多次修改，按id顺序最后一次的操作生效
+    latest = {}
+    for row in rows:
+        latest.setdefault(row.index, {})[row.doc_id] = row.op
+    actions = outbox_actions(latest)
+    try:
+        failed = bulk_index(actions)
+    except Exception as e:
+        app.logger.warning('search outbox: bulk request failed: %s', e)
+        failed = set((index, doc_id) for index, ops in latest.items() for doc_id in ops)
+    changed = set()
+    rebuilding = set(index for index, in db.session.query(search_rebuilds.c.index))
+    for row in rows:
+        if (row.index, row.doc_id) in failed:
+            row.attempts += 1
+            delay = min(app.config['SEARCH_RETRY_BASE'] * 2 ** (row.attempts - 1), app.config['SEARCH_RETRY_MAX'])
+            row.next_attempt = now + timedelta(seconds=delay)
+        elif row.index in rebuilding:
+            # 正在重建的索引，留给reindex.py重放
+            row.next_attempt = None
+            changed.add(row.index)
+        else:
+            db.session.delete(row)
+            changed.add(row.index)
+    # ES里的数据变了，让这些索引的搜索缓存失效：数据库里的代数给没有共享缓存层的其他进程看，共享层里的直接换掉
+    bump_stored_generation(db.session.connection(), sorted(changed))
+    db.session.commit()
+    for index in changed:
+        bump_generation(index)
+    return len(rows)
+
+
+def outbox_actions(latest, targets=None):
+    # latest是{索引: {文档id: 操作}}，从数据库读取最新的数据生成bulk的操作，targets可以把操作写进别的索引
+    actions = []
+    models = searchable_models()
+    for index, ops in latest.items():
+        model = models[index]
+        target = (targets or {}).get(index, index)
+        ids = [doc_id for doc_id, op in ops.items() if op == 'index']
+        # 直接从数据库读取最新的数据，文档在这期间被删掉的话就从ES里删除
+        objs = dict((obj.id, obj) for obj in model.query.filter(model.id.in_(ids))) if ids else {}
+        for doc_id, op in ops.items():
+            if op == 'index' and doc_id in objs:
+                actions.append(('index', target, doc_id, index_payload(objs[doc_id])))
+            else:
+                actions.append(('delete', target, doc_id, None))
+    return actions
+
+
+def start_rebuild(index, target):
+    # 记下重建开始时outbox的最大id，之后同步过的记录都留着重放。中断后继续时沿用原来的记录
+    row = db.session.query(search_rebuilds).filter(search_rebuilds.c.index == index).first()
+    if row is None:
+        mark = db.session.query(func.max(SearchOutbox.id)).scalar() or 0
+        db.session.execute(search_rebuilds.insert(), [{'index': index, 'target': target, 'outbox_id': mark}])
+        db.session.commit()
+        return mark
+    db.session.commit()
+    return row.outbox_id
+
+
+def replay(index, target, after_id, batch_size=None):
+    # 把重建开始以后search_worker.py同步过的修改（outbox的id大于after_id）再写进新的索引，
+    # 同一个文档只写一次数据库里最新的状态。返回(重放的文档数, 重放到的outbox id)
+    batch_size = batch_size or app.config['SEARCH_OUTBOX_BATCH']
+    done = 0
+    while True:
+        rows = db.session.query(SearchOutbox.id, SearchOutbox.doc_id, SearchOutbox.op) \
+            .filter(SearchOutbox.index == index, SearchOutbox.id > after_id, SearchOutbox.next_attempt == None) \
+            .order_by(SearchOutbox.id).limit(batch_size).all()
+        if not rows:
+            db.session.commit()
+            return done, after_id
+        ops = dict((doc_id, op) for id, doc_id, op in rows)
+        failed = bulk_index(outbox_actions({index: ops}, {index: target}))
+        if failed:
+            raise RuntimeError('%d documents failed to replay' % len(failed))
+        done += len(ops)
+        after_id = rows[-1][0]
+
+
+def finish_rebuild(index):
+    # 别名已经指向新的索引，之后的修改search_worker.py直接写进去，留着重放的记录可以删掉了
+    db.session.execute(search_rebuilds.delete().where(search_rebuilds.c.index == index))
+    SearchOutbox.query.filter(SearchOutbox.index == index, SearchOutbox.next_attempt == None) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+
+def outbox_stats():
+    # 队列深度，以及最早一条未同步修改的等待时间（秒），重建索引期间留着重放的记录不算
+    depth, oldest = db.session.query(func.count(SearchOutbox.id), func.min(SearchOutbox.created)) \
+        .filter(SearchOutbox.next_attempt != None).one()
+    lag = (datetime.utcnow() - oldest).total_seconds() if oldest else 0.0
+    return {'depth': depth, 'lag': lag}
+
+
+def load_checkpoint(path):
+    if path and os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return None
+
+
+def save_checkpoint(path, state):
+    # 先写临时文件再改名，中途被杀掉也不会留下写了一半的检查点
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+def reindex(model, index, chunk_size=1000, workers=4, checkpoint=None, after_id=0, report=None):
+    # 全量重建索引：主线程按主键分段读取数据，多个线程并发发送bulk请求。
+    # 检查点只记录连续完成的最后一段，中断后从这里继续，最多重复发送几段数据。
+    total = model.query.filter(model.id > after_id).count()
+    done = 0
+    started = time.time()
+    pending = deque()
+
+    def send(docs):
+        failed = bulk_index([('index', index, id, payload) for id, payload in docs])
+        if failed:
+            raise RuntimeError('%d documents failed to index' % len(failed))
+        return len(docs)
+
+    def complete_one():
+        nonlocal done, after_id
+        last_id, future = pending.popleft()
+        done += future.result()
+        after_id = last_id
+        if checkpoint:
+            save_checkpoint(checkpoint, {'index': index, 'last_id': after_id})
+        if report:
+            elapsed = time.time() - started
+            report(done, total, done / elapsed if elapsed else 0.0)
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for last_id, docs in model.index_chunks(chunk_size, after_id):
+            # 在途的请求数有上限，数据库读得比ES写得快时，内存也不会无限增长
+            if len(pending) >= workers * 2:
+                complete_one()
+            pending.append((last_id, pool.submit(send, docs)))
+        while pending:
+            complete_one()
+    return done, after_id
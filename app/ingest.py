@@ -0,0 +1,169 @@
+from app import app, db
+from app.models import User, Post, followers, invalidate_user
+from collections import Counter
+from datetime import datetime, timezone
+from itertools import islice
+from sqlalchemy import bindparam, or_, tuple_
+from sqlalchemy.exc import IntegrityError
+import csv
+import io
+import time
+
+# 从旧平台迁移数据（ingest.py）：把博客和关注关系从文件批量写进post和followers表。
+# 不创建ORM对象，也就不会触发session的事件和每条博客的搜索索引：PostgreSQL用COPY，其他数据库用executemany，
+# 每批单独提交，内存里只有一批数据。用户的计数器每批按增量更新，搜索索引等全部写完后由ingest.py用reindex一次建好。
+# 用户可以用nickname（author、follower、followed列）或者数据库id（author_id、follower_id、followed_id列）指定，
+# 找不到的用户对应的行会被跳过，没有内容或者内容超过post.body长度的博客也跳过，不会截断后写进去。
+
+
+def batches(rows, size):
+    rows = iter(rows)
+    while True:
+        batch = list(islice(rows, size))
+        if not batch:
+            return
+        yield batch
+
+
+def parse_timestamp(value):
+    # ISO 8601，比如2019-10-01T08:00:00Z，带时区的转换成UTC，没有时区的当作UTC；没有时间的用导入的时间
+    if not value:
+        return datetime.utcnow()
+    if isinstance(value, datetime):
+        timestamp = value
+    else:
+        value = value.strip()
+        timestamp = datetime.fromisoformat(value[:-1] if value.endswith('Z') else value)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def user_ref(row, name):
+    if row.get(name + '_id'):
+        return int(row[name + '_id'])
+    return row.get(name) or None
+
+
+def resolve_users(refs):
+    # 一条查询把这一批引用到的nickname和id都查出来，返回{引用: 用户id}
+    nicknames = set(ref for ref in refs if isinstance(ref, str))
+    ids = set(ref for ref in refs if isinstance(ref, int))
+    if not nicknames and not ids:
+        return {}
+    known = {}
+    # 文件里的nickname是字符串，id是整数，两者不会混淆。
+    # IN的列表用expanding的参数，执行时才展开，不用为几千个值各构造一个表达式对象
+    query = db.session.query(User.id, User.nickname) \
+        .filter(or_(User.nickname.in_(bindparam('nicknames', expanding=True)), User.id.in_(bindparam('ids', expanding=True))))
+    for id, nickname in query.params(nicknames=sorted(nicknames), ids=sorted(ids)):
+        known[id] = id
+        known[nickname] = id
+    return known
+
+
+def insert_rows(table, columns, values):
+    conn = db.session.connection()
+    if conn.dialect.name != 'postgresql':
+        conn.execute(table.insert(), values)
+        return
+    # COPY比executemany快一个数量级，数据先在内存里写成CSV，大小和批次成正比
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for value in values:
+        writer.writerow([value[column].isoformat() if isinstance(value[column], datetime) else value[column]
+                         for column in columns])
+    buf.seek(0)
+    preparer = conn.dialect.identifier_preparer
+    sql = 'COPY %s (%s) FROM STDIN WITH (FORMAT csv)' % (preparer.quote(table.name),
+                                                         ', '.join(preparer.quote(column) for column in columns))
+    cursor = conn.connection.cursor()
+    try:
+        cursor.copy_expert(sql, buf)
+    except conn.dialect.dbapi.IntegrityError as e:
+        # COPY绕过了SQLAlchemy，错误要包装成和executemany一样的异常，ingest()才会重试
+        raise IntegrityError(sql, None, e)
+    finally:
+        cursor.close()
+
+
+def add_counts(column, counts):
+    table = User.__table__
+    update = table.update().where(table.c.id == bindparam('user_id')) \
+        .values({column: table.c[column] + bindparam('delta')})
+    db.session.execute(update, [{'user_id': id, 'delta': delta} for id, delta in counts.items()])
+
+
+def ingest_posts(rows):
+    # 返回(写入的行数, 跳过的行数, 计数器有变化的用户)
+    refs = [user_ref(row, 'author') for row in rows]
+    known = resolve_users(refs)
+    values = []
+    too_long = 0
+    for row, ref in zip(rows, refs):
+        if known.get(ref) is None or not row.get('body'):
+            continue
+        if len(row['body']) > Post.__table__.c.body.type.length:
+            too_long += 1
+            continue
+        values.append({'body': row['body'], 'timestamp': parse_timestamp(row.get('timestamp')),
+                       'user_id': known[ref]})
+    if too_long:
+        app.logger.warning('ingest: skipped %d posts longer than %d characters', too_long,
+                           Post.__table__.c.body.type.length)
+    if values:
+        insert_rows(Post.__table__, ['body', 'timestamp', 'user_id'], values)
+        counts = Counter(value['user_id'] for value in values)
+        add_counts('post_count', counts)
+    else:
+        counts = {}
+    return len(values), len(rows) - len(values), set(counts)
+
+
+def ingest_follows(rows):
+    refs = [(user_ref(row, 'follower'), user_ref(row, 'followed')) for row in rows]
+    known = resolve_users([ref for pair in refs for ref in pair])
+    edges = set()
+    for follower, followed in refs:
+        if known.get(follower) is not None and known.get(followed) is not None:
+            edges.add((known[follower], known[followed]))
+    if edges:
+        # 已经存在的关注关系跳过，用(follower_id, followed_id)按主键查找，同样用expanding的参数
+        pair = tuple_(followers.c.follower_id, followers.c.followed_id)
+        existing = db.session.query(followers.c.follower_id, followers.c.followed_id) \
+            .filter(pair.in_(bindparam('edges', expanding=True))).params(edges=sorted(edges))
+        edges -= set(tuple(row) for row in existing)
+    if edges:
+        insert_rows(followers, ['follower_id', 'followed_id'],
+                    [{'follower_id': a, 'followed_id': b} for a, b in sorted(edges)])
+        add_counts('followed_count', Counter(a for a, b in edges))
+        add_counts('follower_count', Counter(b for a, b in edges))
+    return len(edges), len(rows) - len(edges), set(a for a, b in edges) | set(b for a, b in edges)
+
+
+def ingest(kind, rows, batch_size=None, report=None):
+    # kind是'posts'或者'follows'，返回(写入的行数, 跳过的行数)
+    ingest_batch = {'posts': ingest_posts, 'follows': ingest_follows}[kind]
+    batch_size = batch_size or app.config['INGEST_BATCH']
+    written = skipped = 0
+    started = time.time()
+    for batch in batches(rows, batch_size):
+        # 导入的同时线上有人关注或者删号的话，这一批可能违反约束，回滚后重新处理
+        for attempt in range(app.config['INGEST_RETRIES']):
+            try:
+                done, rejected, touched = ingest_batch(batch)
+                db.session.commit()
+                break
+            except IntegrityError:
+                db.session.rollback()
+                if attempt == app.config['INGEST_RETRIES'] - 1:
+                    raise
+        # 计数器是绕过ORM改的，缓存里的用户要失效
+        for id in touched:
+            invalidate_user(id)
+        written += done
+        skipped += rejected
+        if report:
+            elapsed = time.time() - started
+            report(written, skipped, (written + skipped) / elapsed if elapsed else 0.0)
+    return written, skipped
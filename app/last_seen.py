@@ -0,0 +1,86 @@
+from app import app, db
+from app.models import User, invalidate_user
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam, or_
+import atexit
+import os
+import threading
+
+# last_seen的延迟写入（write-behind）
+# 以前每个请求都要UPDATE一次user表并提交一次事务，现在先记在进程内的缓冲区里，
+# 由后台线程每隔LAST_SEEN_FLUSH_INTERVAL秒、或者攒够LAST_SEEN_FLUSH_SIZE个用户时，用一条批量UPDATE写回数据库。
+# 请求线程只记缓冲区，不会因为写数据库变慢或者出错；没有请求的进程也会按时写回。
+# 数据库里的值离现在不到LAST_SEEN_TOLERANCE秒的话，连缓冲区都不用记。
+
+
+class LastSeenBuffer():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.wakeup = threading.Event()
+        self.pid = None
+        self.failed = 0
+
+    def start(self):
+        # 调用时已经持有self.lock。fork出来的worker进程不能继承父进程缓冲区里的内容，否则会重复写入，
+        # 后台线程也没有被继承，需要重新启动自己的
+        if self.pid == os.getpid():
+            return
+        self.pending = {}
+        threading.Thread(target=self.run, daemon=True).start()
+        self.pid = os.getpid()
+
+    def touch(self, user_id, stored, now=None):
+        now = now or datetime.utcnow()
+        tolerance = timedelta(seconds=app.config['LAST_SEEN_TOLERANCE'])
+        with self.lock:
+            self.start()
+            seen = max(stored, self.pending.get(user_id, stored)) if stored else self.pending.get(user_id)
+            if seen is not None and now - seen < tolerance:
+                return
+            self.pending[user_id] = now
+            if len(self.pending) >= app.config['LAST_SEEN_FLUSH_SIZE']:
+                self.wakeup.set()
+
+    def run(self):
+        with app.app_context():
+            while True:
+                self.wakeup.wait(app.config['LAST_SEEN_FLUSH_INTERVAL'])
+                self.wakeup.clear()
+                self.flush()
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return 0
+        table = User.__table__
+        # 多个进程可能同时写同一个用户，只允许把时间往后推，不会被更旧的值覆盖
+        update = table.update().where(table.c.id == bindparam('user_id')) \
+            .where(or_(table.c.last_seen == None, table.c.last_seen < bindparam('seen'))) \
+            .values(last_seen=bindparam('seen'))
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(update, [{'user_id': user_id, 'seen': seen} for user_id, seen in pending.items()])
+        except Exception:
+            # 数据库出错时把这一批放回缓冲区，下一次再写，期间新记的值更新的话保留新的
+            with self.lock:
+                self.failed += 1
+                for user_id, seen in pending.items():
+                    if self.pending.get(user_id, seen) <= seen:
+                        self.pending[user_id] = seen
+            app.logger.exception('failed to flush last_seen for %d users', len(pending))
+            return 0
+        # 这条UPDATE绕过了ORM，需要手动让用户缓存失效，否则缓存里一直是旧的last_seen
+        for user_id in pending:
+            invalidate_user(user_id)
+        return len(pending)
+
+
+def flush_at_exit():
+    # 进程退出时把还没写回的部分写进数据库
+    last_seen_buffer.flush()
+
+
+last_seen_buffer = LastSeenBuffer()
+atexit.register(flush_at_exit)
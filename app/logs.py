@@ -0,0 +1,242 @@
+from config import basedir
+from flask_mail import Message
+from logging.handlers import QueueHandler, QueueListener, MemoryHandler, RotatingFileHandler
+from queue import Queue, Full, Empty
+from hashlib import md5
+import atexit
+import logging
+import os
+import threading
+import time
+import traceback
+
+# 生产模式下的日志：请求线程里只把日志记录放进一个有界的队列，由后台的QueueListener线程写文件和发邮件。
+#   - 文件：MemoryHandler攒够LOG_BUFFER_RECORDS条、遇到ERROR或者每LOG_FLUSH_INTERVAL秒才写一次
+#   - 邮件：按错误的指纹（异常类型和抛出的位置，没有异常时是消息模板和调用的位置）去重，
+#     同一个错误在LOG_MAIL_WINDOW秒内只发一封，之后的只计数，窗口结束时再发一封汇总；
+#     每个窗口最多发LOG_MAIL_RATE封，超出的合并到下一封汇总里。邮件交给app/mails.py的dispatcher发送
+# 队列满时直接丢弃并计数，日志再多也不会阻塞请求。
+
+FORMAT = '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+# 一封汇总邮件最多列出这么多种错误
+DIGEST_LINES = 50
+
+
+def fingerprint(record):
+    # Flask记录未处理异常时消息里带着URL，有异常时只看异常类型和最里层抛出的位置
+    if record.exc_info and record.exc_info[0] is not None:
+        tb = record.exc_info[2]
+        while tb is not None and tb.tb_next is not None:
+            tb = tb.tb_next
+        where = '%s:%d' % (tb.tb_frame.f_code.co_filename, tb.tb_lineno) if tb is not None else ''
+        parts = [record.name, record.exc_info[0].__module__, record.exc_info[0].__qualname__, where]
+    else:
+        parts = [record.name, record.levelname, str(record.msg), '%s:%d' % (record.pathname, record.lineno)]
+    return md5('|'.join(parts).encode('utf-8')).hexdigest()[:16]
+
+
+class DroppingQueueHandler(QueueHandler):
+    def __init__(self, pipeline):
+        QueueHandler.__init__(self, None)
+        self.pipeline = pipeline
+
+    def prepare(self, record):
+        # 在请求线程里算好指纹，prepare之后异常对象就被去掉了，只剩格式化好的堆栈
+        key = fingerprint(record)
+        error = record.exc_info[0].__name__ if record.exc_info and record.exc_info[0] is not None else None
+        record = QueueHandler.prepare(self, record)
+        record.fingerprint = key
+        record.error = error
+        return record
+
+    def enqueue(self, record):
+        # fork出来的进程里没有后台线程，第一次记日志时启动自己的
+        self.queue = self.pipeline.start()
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.pipeline.dropped += 1
+
+
+class BufferedListener(QueueListener):
+    def __init__(self, queue, interval, *handlers):
+        QueueListener.__init__(self, queue, *handlers, respect_handler_level=True)
+        self.interval = interval
+
+    def dequeue(self, block):
+        # 没有新日志时也每隔interval秒把缓冲区写出去，过期的邮件汇总也在这时发送
+        while True:
+            try:
+                return self.queue.get(block, self.interval)
+            except Empty:
+                self.flush()
+
+    def flush(self):
+        for handler in self.handlers:
+            handler.flush()
+
+    def enqueue_sentinel(self):
+        # 队列满的时候等后台线程处理掉一些，不能像默认的put_nowait那样抛出异常
+        self.queue.put(self._sentinel)
+
+
+class ErrorMailHandler(logging.Handler):
+    def __init__(self, app, window, rate, send=None):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.app = app
+        self.window = window
+        self.rate = rate
+        self.send = send or self.submit
+        # 指纹到[第一条记录, 出现次数, 第一次出现的时间, 已经在邮件里报告过的次数]
+        self.errors = {}
+        # 窗口结束时还没有报告过的[(第一条记录, 次数, 第一次出现的时间)]，因为限流没发出去时留到下一次
+        self.digest = []
+        self.sent_at = []
+        self.sent = 0
+        self.suppressed = 0
+
+    def allowed(self, now):
+        self.sent_at = [t for t in self.sent_at if t > now - self.window]
+        if len(self.sent_at) >= self.rate:
+            return False
+        self.sent_at.append(now)
+        return True
+
+    def emit(self, record):
+        now = time.time()
+        key = getattr(record, 'fingerprint', None) or fingerprint(record)
+        entry = self.errors.get(key)
+        if entry is not None:
+            entry[1] += 1
+            self.suppressed += 1
+            return
+        entry = self.errors[key] = [record, 1, now, 0]
+        if self.allowed(now):
+            self.mail('microblog failure: %s' % self.summary(record), self.format(record))
+            entry[3] = 1
+        else:
+            self.suppressed += 1
+        self.flush(now)
+
+    def flush(self, now=None):
+        # 窗口结束的错误：还有没报告过的次数就加进汇总
+        now = now or time.time()
+        for key, (record, count, first_seen, reported) in list(self.errors.items()):
+            if first_seen + self.window > now:
+                continue
+            del self.errors[key]
+            if count > reported:
+                self.digest.append((record, count - reported, first_seen))
+        if self.digest and self.allowed(now):
+            digest, self.digest = self.digest, []
+            total = sum(count for record, count, first_seen in digest)
+            lines = ['%d x %s (since %s)' % (count, self.summary(record), time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(first_seen)))
+                     for record, count, first_seen in digest[:DIGEST_LINES]]
+            if len(digest) > DIGEST_LINES:
+                lines.append('... and %d more' % (len(digest) - DIGEST_LINES))
+            # 第一种错误的完整堆栈附在后面
+            body = '\n'.join(lines) + '\n\n' + self.format(digest[0][0])
+            self.mail('microblog failure: %d more errors (%d distinct) in the last %d seconds'
+                      % (total, len(digest), self.window), body)
+
+    def summary(self, record):
+        message = record.getMessage().splitlines()[0] if record.getMessage() else ''
+        error = getattr(record, 'error', None)
+        if error is None and record.exc_info and record.exc_info[0] is not None:
+            error = record.exc_info[0].__name__
+        return '%s: %s' % (error, message) if error else message
+
+    def mail(self, subject, body):
+        self.sent += 1
+        try:
+            self.send(subject, body)
+        except Exception:
+            # 发邮件出错不能再记ERROR日志，否则会变成新的错误邮件
+            traceback.print_exc()
+
+    def submit(self, subject, body):
+        from app.mails import dispatcher
+        server = self.app.config['MAIL_SERVER']
+        msg = Message(subject, sender='no-reply@' + server, recipients=self.app.config['ADMINS'], body=body)
+        # dispatcher发送失败时看到这个标记就不再记ERROR日志
+        msg.error_mail = True
+        dispatcher.submit(msg)
+
+    def close(self):
+        # 进程退出时把还在窗口里的次数也发出去
+        self.flush(float('inf'))
+        logging.Handler.close(self)
+
+
+class LogPipeline():
+    def __init__(self, app, handlers):
+        self.app = app
+        self.handlers = handlers
+        self.lock = threading.Lock()
+        self.queue = None
+        self.listener = None
+        self.pid = None
+        self.dropped = 0
+
+    def start(self):
+        if self.pid == os.getpid():
+            return self.queue
+        with self.lock:
+            if self.pid != os.getpid():
+                if self.pid is not None:
+                    # fork之前父进程缓冲的日志由父进程写，子进程不再重复写一遍
+                    for handler in self.handlers:
+                        if isinstance(handler, MemoryHandler):
+                            handler.buffer = []
+                self.queue = Queue(maxsize=self.app.config['LOG_QUEUE_SIZE'])
+                self.listener = BufferedListener(self.queue, self.app.config['LOG_FLUSH_INTERVAL'], *self.handlers)
+                self.listener.start()
+                self.pid = os.getpid()
+        return self.queue
+
+    def stop(self):
+        # 把队列里剩下的日志处理完，缓冲区写进文件
+        if self.pid != os.getpid():
+            return
+        self.listener.stop()
+        for handler in self.handlers:
+            handler.close()
+        self.pid = None
+
+    def stats(self):
+        mail = [handler for handler in self.handlers if isinstance(handler, ErrorMailHandler)]
+        return {'queued': self.queue.qsize() if self.queue else 0, 'dropped': self.dropped,
+                'mails': sum(handler.sent for handler in mail), 'suppressed': sum(handler.suppressed for handler in mail)}
+
+
+pipeline = None
+
+
+def file_handler(app):
+    # 使用文件记录日志，路径不再依赖当前目录
+    log_dir = os.path.join(basedir, 'tmp')
+    os.makedirs(log_dir, exist_ok=True)
+    handler = RotatingFileHandler(os.path.join(log_dir, 'microblog.log'), 'a', 1*1024*1024*1024, 10, delay=True)
+    handler.setFormatter(logging.Formatter(FORMAT))
+    handler.setLevel(logging.INFO)
+    # ERROR以上马上写出去，进程崩溃时不会丢
+    buffered = MemoryHandler(app.config['LOG_BUFFER_RECORDS'], logging.ERROR, handler)
+    buffered.setLevel(logging.INFO)
+    return buffered
+
+
+def setup_logging(app):
+    global pipeline
+    mail_handler = ErrorMailHandler(app, app.config['LOG_MAIL_WINDOW'], app.config['LOG_MAIL_RATE'])
+    mail_handler.setFormatter(logging.Formatter(FORMAT))
+    pipeline = LogPipeline(app, [file_handler(app), mail_handler])
+    app.logger.addHandler(DroppingQueueHandler(pipeline))
+    app.logger.setLevel(logging.INFO)
+    atexit.register(pipeline.stop)
+    return pipeline
+
+
+def logging_stats():
+    if pipeline is None:
+        return {'queued': 0, 'dropped': 0, 'mails': 0, 'suppressed': 0}
+    return pipeline.stats()
@@ -2,26 +2,126 @@ from flask_mail import Message
 from app import mail
 from flask import render_template
 from config import ADMINS
-from app.decorators import async_
 from app import app
+from queue import Queue, Full, Empty
+from threading import Thread, Lock
+import atexit
+import os
 import pdb
 
 
 # 因为目前发送邮件是同步调用，如果发送邮件的人很多，或者邮件服务器的网络状况很差的时候，我们的web server会被邮件服务拖累
 # 因此我们必须使用异步服务，来实现send_mail()立刻返回，发送邮件的工作将被移交到后台
-@async_
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+# 以前每封邮件都新开一个线程并且重新连接一次SMTP服务器，一波关注就能开出几百个线程。
+# 现在邮件放进一个有界的队列，由固定数量的worker线程发送，每个worker保持自己的SMTP连接，连续发送多封邮件。
+class MailDispatcher():
+    STOP = object()
+
+    def __init__(self, app):
+        self.app = app
+        self.lock = Lock()
+        self.queue = None
+        self.workers = []
+        self.pid = None
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        # 第一次发邮件时才启动worker，fork出来的进程需要重新启动自己的worker
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = Queue(maxsize=self.app.config['MAIL_QUEUE_SIZE'])
+            self.workers = [Thread(target=self.run, daemon=True) for i in range(self.app.config['MAIL_WORKERS'])]
+            for worker in self.workers:
+                worker.start()
+            self.pid = os.getpid()
+
+    def submit(self, msg):
+        self.start()
+        try:
+            # 队列满的时候最多等待MAIL_QUEUE_TIMEOUT秒（背压），还是放不进去就丢弃并计数
+            self.queue.put(msg, timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+        except Full:
+            with self.lock:
+                self.dropped += 1
+            self.app.logger.warning('mail queue is full, dropped message to %s', msg.recipients)
+            return False
+        return True
+
+    def run(self):
+        # flask_mail要求mail.send()方法必须在flask的app_context中才可用
+        with self.app.app_context():
+            conn = None
+            while True:
+                try:
+                    # 连接空闲超过MAIL_IDLE_TIMEOUT秒就断开，没有连接的时候一直等下去
+                    msg = self.queue.get(timeout=self.app.config['MAIL_IDLE_TIMEOUT'] if conn else None)
+                except Empty:
+                    conn = self.close(conn)
+                    continue
+                if msg is self.STOP:
+                    self.close(conn)
+                    self.queue.task_done()
+                    break
+                try:
+                    if conn is None:
+                        conn = mail.connect()
+                        conn.__enter__()
+                    # 同一个连接上发送超过MAIL_MAX_EMAILS封后，flask_mail会自动重连
+                    conn.send(msg)
+                    with self.lock:
+                        self.sent += 1
+                except Exception:
+                    with self.lock:
+                        self.failed += 1
+                    if getattr(msg, 'error_mail', False):
+                        # 发给管理员的错误邮件发不出去时只记WARNING，记ERROR的话又会产生一封错误邮件，一直循环下去
+                        self.app.logger.warning('failed to send error mail to %s', msg.recipients, exc_info=True)
+                    else:
+                        self.app.logger.exception('failed to send mail to %s', msg.recipients)
+                    conn = self.close(conn)
+                finally:
+                    self.queue.task_done()
+
+    def close(self, conn):
+        if conn is not None:
+            try:
+                conn.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
+
+    def shutdown(self, timeout=None):
+        # 把队列里剩下的邮件发完再退出
+        if self.pid != os.getpid():
+            return
+        for worker in self.workers:
+            try:
+                # 队列满了而worker又卡住时，最多等timeout秒，不能让进程一直退不出去
+                self.queue.put(self.STOP, timeout=timeout)
+            except Full:
+                self.app.logger.warning('mail queue is full, %d messages not sent on shutdown', self.queue.qsize())
+                break
+        for worker in self.workers:
+            worker.join(timeout)
+        self.pid = None
+
+    def stats(self):
+        return {'queued': self.queue.qsize() if self.queue else 0,
+                'sent': self.sent, 'failed': self.failed, 'dropped': self.dropped}
+
+
+dispatcher = MailDispatcher(app)
+atexit.register(dispatcher.shutdown, 10)
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    # flask_mail要求mail.sned()方法必须在flask的app_context中才可用
-    # mail.send(msg)
-    send_async_email(app, msg)
+    dispatcher.submit(msg)
 
 
 def follower_notification(followed, follower):
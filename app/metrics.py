@@ -0,0 +1,213 @@
+from app import app
+from flask import request, request_started, request_finished, before_render_template, template_rendered
+from sqlalchemy.engine import Engine
+from sqlalchemy import event
+from bisect import bisect_left
+from functools import wraps
+import heapq
+import threading
+import time
+
+# 请求级别的性能统计
+# 通过SQLAlchemy的engine事件和Flask的信号，记录每个请求发出了多少条SQL、花了多少时间，
+# 搜索后端（ES或者嵌入式索引）和模板渲染各花了多少时间，按endpoint汇总成直方图和计数器，
+# 由views.py中的/metrics以Prometheus的文本格式导出。慢请求会记一条日志，带上其中最慢的几条SQL。
+# 每条SQL只多两次perf_counter()和一次堆操作，可以在生产环境一直打开。
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200)
+
+HELP = {
+    'microblog_request_seconds': ('histogram', 'Request latency by endpoint'),
+    'microblog_request_sql_statements': ('histogram', 'SQL statements per request by endpoint'),
+    'microblog_requests_total': ('counter', 'Requests by endpoint and status'),
+    'microblog_sql_seconds_total': ('counter', 'Time spent in SQL statements by endpoint'),
+    'microblog_search_seconds_total': ('counter', 'Time spent in the search backend by endpoint'),
+    'microblog_template_seconds_total': ('counter', 'Time spent rendering templates by endpoint'),
+    'microblog_slow_requests_total': ('counter', 'Requests slower than METRICS_SLOW_REQUEST by endpoint'),
+}
+
+
+class Histogram():
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # 最后一个位置是+Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Registry():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def observe(self, name, labels, value, buckets):
+        with self.lock:
+            histogram = self.histograms.get((name, labels))
+            if histogram is None:
+                histogram = self.histograms[(name, labels)] = Histogram(buckets)
+            histogram.observe(value)
+
+    def clear(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def render(self, gauges=()):
+        # gauges是(名字, 类型, 说明, 标签, 值)的列表，由调用者在导出时收集，比如各个缓存的命中次数
+        lines = []
+        described = set()
+
+        def describe(name, kind, text):
+            if name not in described:
+                described.add(name)
+                lines.append('# HELP %s %s' % (name, text))
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted(self.histograms.items())
+            histograms = [(key, list(h.buckets), list(h.counts), h.sum) for key, h in histograms]
+        for (name, labels), value in counters:
+            describe(name, *HELP[name])
+            lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        for (name, labels), buckets, counts, total in histograms:
+            describe(name, *HELP[name])
+            cumulative = 0
+            for bound, count in zip(buckets + ['+Inf'], counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (name, format_labels(labels + (('le', str(bound)),)), cumulative))
+            lines.append('%s_sum%s %s' % (name, format_labels(labels), format_value(total)))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), cumulative))
+        for name, kind, text, labels, value in gauges:
+            describe(name, kind, text)
+            lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                             for key, value in labels)
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+registry = Registry()
+# 当前线程正在处理的请求的统计，不在请求里（比如search_worker.py）时active为False
+current = threading.local()
+
+
+def reset():
+    current.active = True
+    current.start = time.perf_counter()
+    current.statements = 0
+    current.sql_time = 0.0
+    current.slowest = []
+    current.search_time = 0.0
+    current.template_time = 0.0
+    current.template_depth = 0
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_start', []).append(time.perf_counter())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['metrics_start'].pop()
+    if not getattr(current, 'active', False):
+        return
+    current.statements += 1
+    current.sql_time += elapsed
+    # 只保留最慢的几条，用小顶堆
+    item = (elapsed, current.statements, statement)
+    if len(current.slowest) < app.config['METRICS_SLOW_STATEMENTS']:
+        heapq.heappush(current.slowest, item)
+    elif current.slowest and item > current.slowest[0]:
+        heapq.heapreplace(current.slowest, item)
+
+
+def handle_error(context):
+    # 出错的语句不会触发after_cursor_execute，把它的开始时间丢掉
+    starts = context.connection.info.get('metrics_start') if context.connection is not None else None
+    if starts:
+        starts.pop()
+
+
+def timed(f):
+    # 统计搜索后端的耗时，用在search.py里访问ES或者嵌入式索引的函数上
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            if getattr(current, 'active', False):
+                current.search_time += time.perf_counter() - start
+    return wrapper
+
+
+def on_before_render(sender, template, context, **extra):
+    # 模板里还会渲染博客片段（render_post），只统计最外层的渲染时间，避免重复计算
+    if not getattr(current, 'active', False):
+        return
+    if current.template_depth == 0:
+        current.template_start = time.perf_counter()
+    current.template_depth += 1
+
+
+def on_rendered(sender, template, context, **extra):
+    if not getattr(current, 'active', False) or current.template_depth == 0:
+        return
+    current.template_depth -= 1
+    if current.template_depth == 0:
+        current.template_time += time.perf_counter() - current.template_start
+
+
+def on_request_started(sender, **extra):
+    reset()
+
+
+def on_request_finished(sender, response, **extra):
+    if not getattr(current, 'active', False):
+        return
+    current.active = False
+    elapsed = time.perf_counter() - current.start
+    endpoint = request.endpoint or 'unknown'
+    labels = (('endpoint', endpoint),)
+    registry.observe('microblog_request_seconds', labels, elapsed, LATENCY_BUCKETS)
+    registry.observe('microblog_request_sql_statements', labels, current.statements, STATEMENT_BUCKETS)
+    registry.inc('microblog_requests_total', labels + (('status', response.status_code),))
+    registry.inc('microblog_sql_seconds_total', labels, current.sql_time)
+    registry.inc('microblog_search_seconds_total', labels, current.search_time)
+    registry.inc('microblog_template_seconds_total', labels, current.template_time)
+    if elapsed >= app.config['METRICS_SLOW_REQUEST']:
+        registry.inc('microblog_slow_requests_total', labels)
+        slowest = '\n'.join('  %.3fs #%d %s' % (seconds, number, ' '.join(statement.split())[:300])
+                            for seconds, number, statement in sorted(current.slowest, reverse=True))
+        app.logger.warning('slow request %s %s (%s): %.3fs, %d statements in %.3fs, search %.3fs, templates %.3fs\n%s',
+                           request.method, request.full_path, endpoint, elapsed, current.statements, current.sql_time,
+                           current.search_time, current.template_time, slowest)
+
+
+if app.config.get('METRICS_ENABLED'):
+    # 挂在Engine类上，之后创建的所有engine（包括只读副本）都会被统计
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    event.listen(Engine, 'handle_error', handle_error)
+    request_started.connect(on_request_started, app)
+    request_finished.connect(on_request_finished, app)
+    before_render_template.connect(on_before_render, app)
+    template_rendered.connect(on_rendered, app)
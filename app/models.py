@@ -1,17 +1,56 @@
-from app import db, lm
+from app import app, db, lm
 # 我们存储在数据库中的数据将会以类的集合的形式来表示，我们称之为数据库模型。
 # ORM层需要做的事情就是将以这些类创建的对象映射到合适的数据表中的具体行上。
 from werkzeug.security import generate_password_hash, check_password_hash
 from hashlib import md5
-from app.search import add_to_index, remove_from_index, query_index
+from app.search import SearchPagination, search_enabled, bulk_index, bump_generation
+from app.cache import TieredCache
+from app.replicas import reading_replica
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.orm.session import make_transient_to_detached
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import or_, and_, func, DDL
+from datetime import datetime
+from flask import g, has_app_context
 import pdb
 
 
 followers = db.Table(
     # 定义多对多关系的辅助表，因为是辅助表所以不用把它定义成一个类
     'followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    # 复合主键保证同一对关注关系只有一行，也让"A是否关注了B"成为一次索引查找
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'), primary_key=True, index=True)
+)
+
+
+timeline = db.Table(
+    # 物化的首页时间线，每个用户一份，由app/timeline.py在发博客和关注时维护
+    'timeline',
+    db.Column('user_id', db.Integer, db.ForeignKey('user.id'), primary_key=True),
+    db.Column('post_id', db.Integer, primary_key=True),
+    # 冗余保存作者和时间，取关时按作者删除，读取和截断时按时间排序都不需要再join post表
+    db.Column('author_id', db.Integer),
+    db.Column('timestamp', db.DateTime),
+    db.Index('ix_timeline_user_timestamp', 'user_id', 'timestamp')
+)
+
+
+search_generations = db.Table(
+    # 每个索引的代数，search_worker.py把修改写进ES之后加一，没有共享缓存层时各个web进程靠它让搜索缓存失效
+    'search_generation',
+    db.Column('index', db.String(64), primary_key=True),
+    db.Column('generation', db.Integer, nullable=False, default=0)
+)
+
+
+search_rebuilds = db.Table(
+    # reindex.py --swap正在重建的索引，以及开始时outbox的最大id。重建期间search_worker.py同步过的outbox记录不删除，
+    # 留到重建完成时由reindex.py重放进新的索引，否则这期间的修改只写进了旧索引，切换别名后就丢了
+    'search_rebuild',
+    db.Column('index', db.String(64), primary_key=True),
+    db.Column('target', db.String(128), nullable=False),
+    db.Column('outbox_id', db.Integer, nullable=False)
 )
 
 
@@ -23,6 +62,13 @@ class User(db.Model):
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime)
+    # 粉丝太多的作者发博客时不做写扩散，他的博客在读取时间线时再合并进来
+    timeline_pull = db.Column(db.Boolean, default=False)
+    # 冗余的计数器，个人主页直接显示，不用再对动态关系做COUNT(*)
+    # 由关注、取关以及博客的新增和删除维护，出现偏差时用repair_counters.py从原始数据重新统计
+    follower_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    followed_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    post_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     # 在USER表中建立多对多关系（这里是关注与被关注人的关系）
     followed = db.relationship(
         'User',
@@ -73,98 +119,386 @@ class User(db.Model):
 
     @staticmethod
     def make_unique_nickname(nickname):
-        if User.query.filter_by(nickname=nickname).first() is None:
-            return nickname
-        version = 2
-        while True:
-            new_nickname = nickname + str(version)
-            if User.query.filter_by(nickname=new_nickname).first() is None:
-                break
-            version += 1
-        return new_nickname
+        # 以前每试一个后缀（john2、john3……）就查一次数据库，现在一条查询取出所有已经用掉的后缀
+        return unique_nicknames([nickname])[0]
+
+    @staticmethod
+    def add_unique(nickname, **fields):
+        # 分配nickname和INSERT之间，别的worker可能抢先用掉了同一个名字，这时违反唯一约束，
+        # 在savepoint里回滚后重新分配，不影响这个事务里之前的修改
+        for attempt in range(app.config['NICKNAME_RETRIES']):
+            user = User(nickname=User.make_unique_nickname(nickname), **fields)
+            try:
+                with db.session.begin_nested():
+                    db.session.add(user)
+                return user
+            except IntegrityError:
+                if attempt == app.config['NICKNAME_RETRIES'] - 1:
+                    raise
 
     # 添加和删除关注者
     def follow(self, user):
         if not self.is_following(user):
             # 这个里使用append是因为followed是User的辅助表，它属于User对象，它是User对象维护的一个列表。所以我们需要在操作完成后，返回user对象，然后再调用数据库去update它。
             self.followed.append(user)
+            memo = self.followed_memo()
+            if memo is not None:
+                memo.add(user.id)
             return self
 
     def unfollow(self, user):
         if self.is_following(user):
             # 这个里使用remove是因为followed是User的辅助表，它属于User对象，它是User对象维护的一个列表。所以我们需要在操作完成后，返回user对象，然后再调用数据库去update它。
             self.followed.remove(user)
+            memo = self.followed_memo()
+            if memo is not None:
+                memo.discard(user.id)
             return self
 
     def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        # 这次请求里已经查过关注列表的话直接判断，否则只对这一个用户做一次主键查找，不再COUNT
+        memo = self.followed_memo()
+        if memo is not None:
+            return user.id in memo
+        return user.id in self.following_ids([user.id])
+
+    def following_ids(self, ids):
+        # 批量判断：这些用户里面我关注了哪些，一次查询返回id的集合。显示一组用户的关注按钮时用它代替逐个is_following
+        ids = list(ids)
+        memo = self.followed_memo()
+        if memo is not None:
+            return memo.intersection(ids)
+        if not ids:
+            return set()
+        rows = db.session.query(followers.c.followed_id) \
+            .filter(followers.c.follower_id == self.id, followers.c.followed_id.in_(ids))
+        return set(row[0] for row in rows)
+
+    def followed_ids(self):
+        # 关注的所有用户id，在一次请求内只查询一次，结果记在g里
+        memo = self.followed_memo()
+        if memo is None:
+            memo = set(row[0] for row in db.session.query(followers.c.followed_id).filter(followers.c.follower_id == self.id))
+            if has_app_context():
+                g.setdefault('followed_ids', {})[self.id] = memo
+        return memo
+
+    def followed_memo(self):
+        if not has_app_context():
+            return None
+        return g.get('followed_ids', {}).get(self.id)
 
     def followed_posts(self):
-        return Post.query.join(followers, (followers.c.followed_id == Post.user_id)).filter(followers.c.follower_id == self.id).order_by(Post.timestamp.desc())
+        # 模板中每条博客都要显示作者，所以在同一条SQL里把作者一起查出来，避免每条博客再发一次SELECT
+        return Post.query.join(followers, (followers.c.followed_id == Post.user_id)).filter(followers.c.follower_id == self.id) \
+            .options(db.joinedload(Post.author)).order_by(Post.timestamp.desc())
+
+
+# 用户缓存，load_user和按nickname查找用户的视图共用
+# 缓存的是user表一行的数据，而不是User对象本身，因为User对象离开了session就不能再查询followed、posts这些动态关系
+user_cache = TieredCache('user', app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'], app.config['USER_CACHE_SHARED_TTL'])
+
+
+NICKNAME_QUERY_CHUNK = 500
+
+
+def like_prefix(prefix):
+    # LIKE的前缀匹配，nickname里的%和_要转义
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+
+def numbered(base):
+    # nickname是base或者base加上数字。LIKE用前缀走索引，后面只能是数字：johnny这样的名字在数据库里就过滤掉，不用传回来
+    return and_(User.nickname.like(like_prefix(base), escape='\\'),
+                func.ltrim(func.substr(User.nickname, len(base) + 1), '0123456789') == '')
+
+
+def unique_nicknames(nicknames):
+    # 给一批nickname分配没有被占用的用户名，和原来一样从2开始找第一个空着的数字后缀。
+    # 所有前缀用一条查询取出来，前缀很多时分成几条，同一批里重名的也会分到不同的后缀。
+    # LIKE 'john%'在PostgreSQL默认的（非C）排序规则下用不上nickname上普通的索引，
+    # 所以另外建了一个varchar_pattern_ops的索引ix_user_nickname_pattern（见下面的DDL），SQLite的LIKE本来就是全表扫描
+    bases = set(nicknames)
+    # 每个前缀已经用掉的后缀，''代表原名本身
+    taken = dict((base, set()) for base in bases)
+
+    def claim(name):
+        # 去掉末尾的数字后逐个尝试，前缀本身也可能以数字结尾，比如john23既是john的后缀23，也是john2的后缀3
+        stem = name.rstrip('0123456789')
+        for i in range(len(stem), len(name) + 1):
+            if name[:i] in taken:
+                taken[name[:i]].add(name[i:])
+
+    # SQLite限制表达式的深度不能超过1000，所以每条查询最多NICKNAME_QUERY_CHUNK个前缀
+    bases = sorted(bases)
+    for start in range(0, len(bases), NICKNAME_QUERY_CHUNK):
+        rows = db.session.query(User.nickname).filter(or_(*[
+            numbered(base) for base in bases[start:start + NICKNAME_QUERY_CHUNK]]))
+        # SQLite的LIKE不区分大小写，claim按原样比较，多查出来的不影响结果
+        for existing, in rows:
+            claim(existing)
+    # 比上一次分配出去的后缀小的都已经被占用了，同一个前缀不用每次都从头找
+    versions = {}
+    result = []
+    for nickname in nicknames:
+        used = taken[nickname]
+        version = versions.get(nickname, 1)
+        suffix = str(version) if version > 1 else ''
+        while suffix in used:
+            version += 1
+            suffix = str(version)
+        versions[nickname] = version
+        claim(nickname + suffix)
+        result.append(nickname + suffix)
+    return result
+
+
+# 只在PostgreSQL上建，其他数据库不认识varchar_pattern_ops
+db.event.listen(User.__table__, 'after_create', DDL(
+    'CREATE INDEX ix_user_nickname_pattern ON "user" (nickname varchar_pattern_ops)').execute_if(dialect='postgresql'))
+
+
+def user_row(user):
+    return dict((column.key, getattr(user, column.key)) for column in User.__table__.columns)
+
+
+def user_from_row(row):
+    # 用缓存的数据还原出User对象，再用merge(load=False)挂到当前session上，这个过程不会发出SELECT
+    user = User()
+    for key, value in row.items():
+        set_committed_value(user, key, value)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+
+def get_user(id):
+    row = user_cache.get('id:%d' % id)
+    if row is not None:
+        return user_from_row(row)
+    user = User.query.get(id)
+    if user is not None and not reading_replica(db.session):
+        user_cache.set('id:%d' % id, user_row(user))
+    return user
+
+
+def get_user_by_nickname(nickname):
+    # nickname只缓存到id的映射，用户数据本身还是从'id:'这个key读取，失效的时候只需要处理一份
+    id = user_cache.get('nickname:' + nickname)
+    if id is not None:
+        return get_user(id)
+    user = User.query.filter_by(nickname=nickname).first()
+    if user is not None and not reading_replica(db.session):
+        user_cache.set('nickname:' + nickname, user.id)
+        user_cache.set('id:%d' % user.id, user_row(user))
+    return user
+
+
+def invalidate_user(id, *nicknames):
+    user_cache.delete('id:%d' % id)
+    for nickname in nicknames:
+        user_cache.delete('nickname:' + nickname)
+
+
+def collect_user_changes(session, flush_context):
+    # flush的时候记下被修改或删除的用户，包括修改前后的nickname，等事务提交后再让缓存失效
+    changed = session.info.setdefault('user_cache_changes', [])
+    for obj in list(session.dirty) + list(session.deleted):
+        if isinstance(obj, User):
+            history = db.inspect(obj).attrs.nickname.history
+            changed.append((obj.id, [n for n in (history.added or []) + (history.deleted or []) + [obj.nickname] if n]))
+
+
+def invalidate_user_changes(session):
+    for id, nicknames in session.info.pop('user_cache_changes', []):
+        invalidate_user(id, *nicknames)
+
+
+def discard_user_changes(session):
+    session.info.pop('user_cache_changes', None)
+    session.info.pop('user_counters', None)
+
+
+def count_follow(follower, followed, initiator):
+    # 关注关系在flush之前还没有id，先把对象记下来，flush时再统一更新计数器
+    counters = db.session.info.setdefault('user_counters', [])
+    counters.append((follower, 'followed_count', 1))
+    counters.append((followed, 'follower_count', 1))
+
+
+def count_unfollow(follower, followed, initiator):
+    counters = db.session.info.setdefault('user_counters', [])
+    counters.append((follower, 'followed_count', -1))
+    counters.append((followed, 'follower_count', -1))
+
+
+def update_counters(session, flush_context):
+    # 把这次flush里的计数变化按用户合并，每个用户只发一条UPDATE，并且在数据库里做加减，并发时不会互相覆盖
+    deltas = {}
+    for user, column, delta in session.info.pop('user_counters', []):
+        deltas.setdefault(user.id, {}).setdefault(column, 0)
+        deltas[user.id][column] += delta
+    for obj, delta in [(obj, 1) for obj in session.new] + [(obj, -1) for obj in session.deleted]:
+        if isinstance(obj, Post) and obj.user_id is not None:
+            deltas.setdefault(obj.user_id, {}).setdefault('post_count', 0)
+            deltas[obj.user_id]['post_count'] += delta
+    table = User.__table__
+    for id, columns in deltas.items():
+        values = dict((column, table.c[column] + delta) for column, delta in columns.items() if delta)
+        if values:
+            session.connection().execute(table.update().where(table.c.id == id).values(**values))
+            session.info.setdefault('user_cache_changes', []).append((id, []))
+            session.info.setdefault('user_counters_expire', {}).setdefault(id, set()).update(values)
+
+
+def expire_counters(session, flush_context):
+    # 数据库里的计数已经变了，让session中对应的User对象下次访问时重新读取
+    for id, columns in session.info.pop('user_counters_expire', {}).items():
+        user = session.identity_map.get(db.inspect(User).identity_key_from_primary_key((id,)))
+        if user is not None:
+            session.expire(user, list(columns))
+
+
+def repair_counters():
+    # 从followers和post表重新统计所有用户的计数器，返回有偏差的用户数
+    table = User.__table__
+    post_table = Post.__table__
+    actual = {
+        'follower_count': db.select([db.func.count()]).where(followers.c.followed_id == table.c.id).as_scalar(),
+        'followed_count': db.select([db.func.count()]).where(followers.c.follower_id == table.c.id).as_scalar(),
+        'post_count': db.select([db.func.count()]).where(post_table.c.user_id == table.c.id).as_scalar()
+    }
+    drifted = db.or_(*[table.c[column] != value for column, value in actual.items()])
+    ids = [row[0] for row in db.session.execute(db.select([table.c.id]).where(drifted))]
+    if ids:
+        db.session.execute(table.update().where(table.c.id.in_(ids)).values(**actual))
+    db.session.commit()
+    for id in ids:
+        invalidate_user(id)
+    return len(ids)
 
 
 # user_loader回调函数
 # 主要是通过获取user对象存储到session中，自己实现最好启用缓存。
 @lm.user_loader
 def load_user(id):
-    # 从数据库找到user对象
-    return User.query.get(int(id))
+    # 先从缓存中找user对象，找不到再查数据库
+    return get_user(int(id))
+
+
+class SearchOutbox(db.Model):
+    # 等待同步到ES的修改，和业务数据在同一个事务里写入，由search_worker.py在后台批量同步
+    __tablename__ = 'search_outbox'
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.String(64))
+    doc_id = db.Column(db.Integer)
+    # 'index'或者'delete'
+    op = db.Column(db.String(16))
+    created = db.Column(db.DateTime, default=datetime.utcnow)
+    # 同步失败后按指数退避重试。为空表示已经同步过了，只是重建索引期间留着等重放，见search_rebuild表
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return '<SearchOutbox %s %s/%r>' % (self.op, self.index, self.doc_id)
 
 
 # 整合ES与Database的钩子类，我们把Mixin类作为一个基类整合到Post模型中
 class SearchableMixin():
     @classmethod
-    def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if total == 0:
-            return cls.query.filter_by(id=0), 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(
-            db.case(when, value=cls.id)), total
+    def search(cls, expression, per_page, cursor=None, with_total=True):
+        # 返回SearchPagination，items是按搜索结果排好序的对象，cursor不合法时抛出InvalidCursor
+        page = SearchPagination(cls.__tablename__, expression, per_page, cursor, with_total)
+        if not page.ids:
+            return page
+        query = cls.query.filter(cls.id.in_(page.ids))
+        # __eager__中列出的关系和搜索结果一起查询出来
+        for name in getattr(cls, '__eager__', []):
+            query = query.options(db.joinedload(getattr(cls, name)))
+        objs = dict((obj.id, obj) for obj in query)
+        # 已经从数据库删掉、但ES里还没同步删除的结果直接跳过
+        page.items = [objs[id] for id in page.ids if id in objs]
+        return page
 
     @classmethod
-    def before_commit(cls, session):
-        # 于修改提交前，保存现场。因为一旦提交后，所有obj就都不可用了
-        session._changes = {
-            'add': [obj for obj in session.new if isinstance(obj, cls)],
-            'update': [obj for obj in session.dirty if isinstance(obj, cls)],
-            'delete': [obj for obj in session.deleted if isinstance(obj, cls)]
-        }
+    def after_flush(cls, session, flush_context):
+        # 以前是在after_commit里逐条同步到ES，每条修改都要在用户请求里等一次ES，ES慢或者挂掉时修改就丢了。
+        # 现在把修改写进outbox表，和业务数据在同一个事务里提交，再由后台的search_worker.py批量同步。
+        # after_flush时session.new/dirty/deleted还保留着flush之前的状态，新对象的id也已经有了
+        if not search_enabled():
+            return
+        now = datetime.utcnow()
+        changes = [(obj, 'index') for obj in session.new if isinstance(obj, cls)]
+        changes += [(obj, 'index') for obj in session.dirty if isinstance(obj, cls) and session.is_modified(obj)]
+        changes += [(obj, 'delete') for obj in session.deleted if isinstance(obj, cls)]
+        if changes:
+            session.connection().execute(SearchOutbox.__table__.insert(), [
+                {'index': cls.__tablename__, 'doc_id': obj.id, 'op': op, 'created': now, 'attempts': 0, 'next_attempt': now}
+                for obj, op in changes])
+            session.info.setdefault('search_changes', set()).add(cls.__tablename__)
 
     @classmethod
     def after_commit(cls, session):
-        # 在提交成功后，是合适的时间把之前提交的修改同步到ES
-        for obj in session._changes['add']:
-            add_to_index(cls.__tablename__, obj)
-        for obj in session._changes['update']:
-            add_to_index(cls.__tablename__, obj)
-        for obj in session._changes['delete']:
-            remove_from_index(cls.__tablename__, obj)
-        session._changes = None
+        # 提交之后让这个进程里这个索引的搜索缓存失效。这时ES里还没有这个文档，
+        # search_worker.py真正写进ES以后还会再失效一次（数据库里的代数加一），所有进程都能看到
+        for index in session.info.pop('search_changes', ()):
+            bump_generation(index)
+
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('search_changes', None)
+
+    @classmethod
+    def index_chunks(cls, chunk_size, after_id=0):
+        # 按主键分段读取需要索引的字段，每次只把一段数据读进内存，也不经过identity map
+        columns = [getattr(cls, field) for field in cls.__searchable__]
+        while True:
+            rows = db.session.query(cls.id, *columns).filter(cls.id > after_id).order_by(cls.id).limit(chunk_size).all()
+            if not rows:
+                break
+            after_id = rows[-1][0]
+            yield after_id, [(row[0], dict(zip(cls.__searchable__, row[1:]))) for row in rows]
 
     @classmethod
     def reindx(cls):
-        # 这是一个辅助方法，用于一次性的加载数据库中的数据到ES
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+        # 这是一个辅助方法，用于一次性的加载数据库中的数据到ES，大的数据量请使用reindex.py
+        for last_id, docs in cls.index_chunks(1000):
+            bulk_index([('index', cls.__tablename__, id, payload) for id, payload in docs])
 
 
 class Post(SearchableMixin, db.Model):
     # 这个字段包含了所有能被搜索并且建立索引的字段。在我们的例子中，我们只要索引blog的body字段。
     __searchable__ = ['body']
+    # 搜索结果页要显示每条博客的作者，和博客一起查询出来
+    __eager__ = ['author']
     # Post对象中的可用字段
     id = db.Column(db.Integer, primary_key=True)
     body = db.Column(db.String(140))
     timestamp = db.Column(db.DateTime)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    # 游标分页按(timestamp, id)定位，有了这两个索引，翻到多深都只是一次索引查找
+    __table_args__ = (
+        db.Index('ix_post_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_post_user_timestamp_id', 'user_id', 'timestamp', 'id'),
+    )
 
     def __repr__(self):
         return '<Post %r>' % (self.body)
 
 
+def searchable_models():
+    # 索引名到模型类的映射，search_worker.py靠它从outbox的记录找回对应的数据
+    return dict((cls.__tablename__, cls) for cls in SearchableMixin.__subclasses__())
+
+
 # 注册监听函数
 # 注意：这里的监听函数不在Post类里面，而在Post类的后面
-db.event.listen(db.session, 'before_commit', Post.before_commit)
+db.event.listen(db.session, 'after_flush', Post.after_flush)
 db.event.listen(db.session, 'after_commit', Post.after_commit)
+db.event.listen(db.session, 'after_rollback', Post.after_rollback)
+db.event.listen(db.session, 'after_flush', collect_user_changes)
+db.event.listen(db.session, 'after_commit', invalidate_user_changes)
+db.event.listen(db.session, 'after_rollback', discard_user_changes)
+db.event.listen(User.followed, 'append', count_follow)
+db.event.listen(User.followed, 'remove', count_unfollow)
+db.event.listen(db.session, 'after_flush', update_counters)
+db.event.listen(db.session, 'after_flush_postexec', expire_counters)
@@ -0,0 +1,74 @@
+from app.models import Post
+# 搜索的游标和这里的游标不合法时抛出同一个异常
+from app.search import InvalidCursor
+from sqlalchemy import tuple_
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from datetime import datetime
+import binascii
+
+# 基于(timestamp, id)的游标分页（keyset pagination）
+# paginate()每次都要COUNT(*)整个结果集，再用OFFSET跳过前面的行，越往后翻越慢。
+# 游标分页记住上一页最后一条博客的(timestamp, id)，下一页直接从索引的这个位置往后读，翻到多深代价都和第一页一样。
+# 游标里还记录了这条博客在列表中的位置，时间线需要靠它判断是否超过了物化时间线的长度。
+
+
+def encode_cursor(post, position):
+    raw = '%s|%d|%d' % (post.timestamp.isoformat(), post.id, position)
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        timestamp, id, position = raw.split('|')
+        return datetime.fromisoformat(timestamp), int(id), int(position)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidCursor(cursor)
+
+
+def cursor_depth(per_page, before=None, after=None):
+    # 这一页需要读到列表中的多深，给home_timeline判断是否要回落到join查询
+    if before:
+        return decode_cursor(before)[2] + 1 + per_page
+    if after:
+        return decode_cursor(after)[2]
+    return per_page
+
+
+class KeysetPagination():
+    # 与Flask-SQLAlchemy的Pagination对象保持同样的has_next/has_prev接口，模板里用next_cursor/prev_cursor生成链接
+    def __init__(self, items, first_position, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next and len(items) > 0
+        self.has_prev = has_prev and len(items) > 0
+        self.next_cursor = encode_cursor(items[-1], first_position + len(items) - 1) if self.has_next else None
+        self.prev_cursor = encode_cursor(items[0], first_position) if self.has_prev else None
+
+
+def keyset_paginate(query, per_page, before=None, after=None):
+    # query里原有的排序会被丢掉，统一按(timestamp, id)倒序，id用来打破时间相同的情况
+    query = query.order_by(None)
+    key = tuple_(Post.timestamp, Post.id)
+    if after:
+        # 往回翻（更新的博客）：正序读取紧挨着游标的一页，再倒过来
+        timestamp, id, position = decode_cursor(after)
+        rows = query.filter(key > tuple_(timestamp, id)) \
+            .order_by(Post.timestamp.asc(), Post.id.asc()).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        return KeysetPagination(items, position - len(items), True, has_prev)
+    position = 0
+    if before:
+        timestamp, id, position = decode_cursor(before)
+        query = query.filter(key < tuple_(timestamp, id))
+        position += 1
+    # 多取一条，用来判断是否还有下一页，这样就不需要COUNT(*)了
+    rows = query.order_by(Post.timestamp.desc(), Post.id.desc()).limit(per_page + 1).all()
+    return KeysetPagination(rows[:per_page], position, len(rows) > per_page, before is not None)
+
+
+def legacy_cursor(query, page, per_page):
+    # 兼容旧的页码URL，只用一次OFFSET找到上一页的最后一条，然后换成游标
+    position = (page - 1) * per_page - 1
+    post = query.order_by(None).order_by(Post.timestamp.desc(), Post.id.desc()).offset(position).first()
+    return encode_cursor(post, position) if post is not None else None
@@ -0,0 +1,149 @@
+from flask import has_request_context, session as flask_session, request, current_app
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, _EngineConnector
+from sqlalchemy import event, orm, text
+from sqlalchemy.sql.expression import Select, CompoundSelect
+from functools import wraps
+import logging
+import random
+import threading
+import time
+
+# 只读副本的读写分离
+# 在config.py的SQLALCHEMY_REPLICAS里配置副本，被@replica_reads装饰的只读视图（GET/HEAD）里，
+# 所有的SELECT都发给其中一个副本，写入和其他语句仍然走主库。下面几种情况即使在只读视图里也读主库：
+#   1. 这次请求的session已经写过数据，之后的读取要能看到自己的写入；
+#   2. 这个浏览器在REPLICA_STICKY_SECONDS秒内提交过写入（比如发博客、关注之后重定向回来的页面），记在flask的session里；
+#   3. 所有副本的复制延迟都超过了REPLICA_MAX_LAG秒，或者连不上。
+# 延迟每隔REPLICA_LAG_CHECK_INTERVAL秒检查一次，只有PostgreSQL能查到延迟，其他数据库只检查能不能连上。
+
+log = logging.getLogger(__name__)
+
+# bind名 -> (检查的时间, 延迟秒数)，连不上时延迟为None
+lag_checks = {}
+lock = threading.Lock()
+# bind名 -> 发给它的查询数，None是主库
+routed = {}
+
+LAG_SQL = text("SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+               "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END")
+
+
+class RoutingConnector(_EngineConnector):
+    # 副本的URL在SQLALCHEMY_REPLICAS里，不放进SQLALCHEMY_BINDS，否则create_all()会在副本上建表
+    def get_uri(self):
+        replicas = self._app.config.get('SQLALCHEMY_REPLICAS') or {}
+        if self._bind in replicas:
+            return replicas[self._bind]
+        return _EngineConnector.get_uri(self)
+
+    def get_options(self, sa_url, echo):
+        # SQLALCHEMY_BIND_OPTIONS按bind单独设置engine参数，比如副本的连接池可以比主库大
+        options = _EngineConnector.get_options(self, sa_url, echo)
+        options.update((self._app.config.get('SQLALCHEMY_BIND_OPTIONS') or {}).get(self._bind, {}))
+        return options
+
+
+class RoutingSession(SignallingSession):
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        primary = SignallingSession.get_bind(self, mapper, clause)
+        if not self.info.get('replica_reads') or not isinstance(clause, (Select, CompoundSelect)):
+            return primary
+        # SELECT ... FOR UPDATE是为了接下来的写入加锁
+        if getattr(clause, '_for_update_arg', None) is not None:
+            return primary
+        # flush的时候也会SELECT（比如加载关系），写过数据之后都只用主库
+        if self._flushing or self.info.get('wrote') or self.new or self.dirty or self.deleted:
+            return primary
+        # 有__bind_key__的模型在别的数据库里，没有副本
+        if primary is not self.db.get_engine(self.app):
+            return primary
+        if has_request_context() and flask_session.get('primary_until', 0) > time.time():
+            return primary
+        # 一次请求只用一个副本，避免两条查询落在延迟不同的副本上
+        if 'replica' not in self.info:
+            healthy = healthy_replicas(self.db, self.app)
+            self.info['replica'] = random.choice(healthy) if healthy else None
+        name = self.info['replica']
+        with lock:
+            routed[name] = routed.get(name, 0) + 1
+        return primary if name is None else self.db.get_engine(self.app, bind=name)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    def make_connector(self, app=None, bind=None):
+        return RoutingConnector(self, self.get_app(app), bind)
+
+    def create_session(self, options):
+        factory = orm.sessionmaker(class_=RoutingSession, db=self, **options)
+        event.listen(factory, 'after_flush', mark_write)
+        event.listen(factory, 'after_commit', remember_write)
+        event.listen(factory, 'after_rollback', forget_write)
+        return factory
+
+
+def replica_lag(engine):
+    # 其他数据库只检查能不能连上
+    with engine.connect() as conn:
+        if engine.dialect.name != 'postgresql':
+            conn.execute(text('SELECT 1'))
+            return 0.0
+        return float(conn.execute(LAG_SQL).scalar())
+
+
+def healthy_replicas(db, app):
+    now = time.time()
+    healthy = []
+    for name in sorted(app.config.get('SQLALCHEMY_REPLICAS') or {}):
+        with lock:
+            checked = lag_checks.get(name)
+        if checked is None or now - checked[0] >= app.config['REPLICA_LAG_CHECK_INTERVAL']:
+            try:
+                lag = replica_lag(db.get_engine(app, bind=name))
+            except Exception:
+                log.warning('replica %s is unavailable', name, exc_info=True)
+                lag = None
+            checked = (now, lag)
+            with lock:
+                lag_checks[name] = checked
+        if checked[1] is not None and checked[1] <= app.config['REPLICA_MAX_LAG']:
+            healthy.append(name)
+    return healthy
+
+
+def replica_reads(f):
+    # 只读视图的装饰器，GET和HEAD请求里的SELECT可以发给副本，放在@login_required下面
+    @wraps(f)
+    def decorated_function(*args, **kwargs):
+        if request.method in ('GET', 'HEAD') and current_app.config.get('SQLALCHEMY_REPLICAS'):
+            current_app.extensions['sqlalchemy'].db.session.info['replica_reads'] = True
+        return f(*args, **kwargs)
+    return decorated_function
+
+
+def reading_replica(session):
+    # 这次请求的session读过副本，读到的数据可能落后于主库，不能放进各进程共享的缓存
+    return session.info.get('replica') is not None
+
+
+def mark_write(session, flush_context):
+    session.info['wrote'] = True
+
+
+def remember_write(session):
+    # 提交了写入，这个浏览器接下来的一段时间都读主库，直到副本赶上
+    if session.info.pop('wrote', False) and has_request_context() and session.app.config.get('SQLALCHEMY_REPLICAS'):
+        flask_session['primary_until'] = time.time() + session.app.config['REPLICA_STICKY_SECONDS']
+
+
+def forget_write(session):
+    session.info.pop('wrote', None)
+
+
+def replica_stats():
+    with lock:
+        return {'lag': dict((name, lag) for name, (checked, lag) in lag_checks.items()), 'routed': dict(routed)}
+
@@ -1,37 +1,293 @@
-from app import es
+from app import app, db
+from app.search_engine import EmbeddedSearch
+from app.cache import TieredCache, shared_tier
+from app.metrics import timed
+from elasticsearch import Elasticsearch, NotFoundError, RequestError
+from flask import has_request_context, session as flask_session
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from hashlib import md5
+import binascii
+import json
+import threading
+import uuid
 import pdb
 
 # Elasticsearch与Flask整合教程 https://www.jianshu.com/p/56cfc972d372
 
 # 这样做的好处就是把所有和ES有关的代码都放在search文件里，以后如果要修改查询引擎，只需要修改这一个文件就好了
-def add_to_index(index, model):
-    # 在指定id的情况下向ES的数据库插入数据，若不存在就插入，若存在则更新
-    if not es:
-        return
+# SEARCH_BACKEND为'embedded'时，使用app/search_engine.py中的进程内倒排索引代替ES，下面的函数接口不变
+embedded = EmbeddedSearch(app.config['SEARCH_INDEX_DIR'], app.config['SEARCH_MERGE_SEGMENTS']) \
+    if app.config.get('SEARCH_BACKEND') == 'embedded' else None
+# ES的客户端，第一次使用时由client()创建，导入时不连接ES。测试时可以直接换成假的客户端
+es = None
+es_lock = threading.Lock()
+
+
+def client():
+    # 没有配置ES_HOSTS或者使用嵌入式索引时返回None
+    global es
+    if es is None and app.config.get('ES_HOSTS') and app.config.get('SEARCH_BACKEND') == 'elasticsearch':
+        with es_lock:
+            if es is None:
+                es = Elasticsearch(app.config['ES_HOSTS'])
+    return es
+
+
+def index_payload(model):
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    es.index(index=index, id=model.id, body=payload)
+    return payload
 
 
-def remove_from_index(index, model):
-    if not es:
-        return
-    es.delete(index=index, id=model.id)
+def search_enabled():
+    return embedded is not None or client() is not None
+
 
+@timed
+def bulk_index(actions):
+    # 用bulk API一次提交多条修改，actions是(op, index, id, payload)的列表，op为'index'或者'delete'
+    # 返回失败的(index, id)集合，ES不可用时直接抛出异常，由调用者决定重试
+    if embedded:
+        return embedded.bulk(actions)
+    es = client()
+    body = []
+    for op, index, id, payload in actions:
+        body.append({op: {'_index': index, '_id': id}})
+        if op == 'index':
+            body.append(payload)
+    if not body:
+        return set()
+    result = es.bulk(body=body)
+    failed = set()
+    if result.get('errors'):
+        for item in result['items']:
+            op, status = list(item.items())[0]
+            # 删除一个不存在的文档返回404，结果和删除成功是一样的
+            if status.get('error') and not (op == 'delete' and status.get('status') == 404):
+                failed.add((status['_index'], int(status['_id'])))
+    return failed
 
-def query_index(index, query, page, per_page):
+
+@timed
+def query_index(index, query, size, after=None, reverse=False, pit=None, with_total=True):
+    # 用search_after代替from/size翻页：from/size要ES对前面所有的结果打分排序，越往后越慢，超过1万条直接报错。
+    # 结果按(分数, _shard_doc)倒序，after是上一页边界那条结果的排序值，reverse为True时取排在after前面的size条。
+    # pit是ES的point in time，同一次翻页一直使用它，期间的写入不会让结果错位。没有pit时打开一个新的，
+    # 不需要翻页的话由调用者用close_pit()关掉。
+    # 返回([(id, 排序值)], 总数, pit)，with_total为False时不统计总数，总数返回None
+    if embedded:
+        hits, total = embedded.search_after(index, query, size, after, reverse)
+        return hits, total if with_total else None, None
+    es = client()
     if not es:
-        return [], 0
+        return [], 0 if with_total else None, None
+    order = 'asc' if reverse else 'desc'
     body = {
         # match和multi_match的不同在于，multi_match可以跨多个字段搜索
         # 通过*传递字段名称，表示所有字段
         # 这个里使用*是为了通用化，因为不同的索引中字段名称可能不同
         'query': {'multi_match': {'query': query, 'fields': ['*']}},
-        # from和size参数控制整个结果集中，哪些数据需要被返回
-        'from': (page - 1) * per_page, 'size': per_page
+        'size': size,
+        # _shard_doc是文档在point in time里的唯一位置，分数相同时用它排序，翻页的结果才稳定
+        'sort': [{'_score': {'order': order}}, {'_shard_doc': {'order': order}}],
+        'track_total_hits': with_total
     }
-    search = es.search(index=index, body=body)
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    total = int(search['hits']['total']['value'])
-    return ids, total
+    if after is not None:
+        body['search_after'] = after
+    search = None
+    if pit is not None:
+        try:
+            search = es.search(body=dict(body, pit={'id': pit, 'keep_alive': app.config['SEARCH_PIT_KEEP_ALIVE']}))
+        except (NotFoundError, RequestError):
+            # 游标里的point in time过期了（404）或者被改坏了（400），打开一个新的接着翻，
+            # 期间有修改的话可能会重复或者漏掉几条
+            search = None
+    if search is None:
+        pit = open_pit(index)
+        search = es.search(body=dict(body, pit={'id': pit, 'keep_alive': app.config['SEARCH_PIT_KEEP_ALIVE']}))
+    if search.get('pit_id', pit) != pit and has_request_context() and flask_session.get('search_pit') == pit:
+        flask_session['search_pit'] = search['pit_id']
+    hits = [(int(hit['_id']), hit['sort']) for hit in search['hits']['hits']]
+    if reverse:
+        hits.reverse()
+    total = int(search['hits']['total']['value']) if with_total else None
+    return hits, total, search.get('pit_id', pit)
+
+
+def open_pit(index):
+    # 固定版本的客户端里还没有open_point_in_time方法，直接发请求。
+    # 用户重新搜索或者换了关键字，之前的游标就不会再用了，所以每个浏览器只保留最近打开的一个point in time，
+    # 打开新的时候把上一个关掉，不用等keep_alive过期。缓存里共用这个point in time的其他人翻页时会重新打开
+    es = client()
+    pit = es.transport.perform_request('POST', '/%s/_pit' % index,
+                                       params={'keep_alive': app.config['SEARCH_PIT_KEEP_ALIVE']})['id']
+    if has_request_context():
+        close_pit(flask_session.get('search_pit'))
+        flask_session['search_pit'] = pit
+    return pit
+
+
+def close_pit(pit):
+    # 不会再翻页时马上释放point in time，不要让ES一直保留着到keep_alive过期
+    es = client()
+    if es is None or pit is None:
+        return
+    if has_request_context() and flask_session.get('search_pit') == pit:
+        flask_session.pop('search_pit')
+    try:
+        es.transport.perform_request('DELETE', '/_pit', body={'id': pit})
+    except (NotFoundError, RequestError):
+        pass
+
+
+# 搜索结果的缓存，键里带着索引的代数，索引修改后代数改变，旧的结果不会再被读到，等着过期淘汰就行
+search_cache = TieredCache('search', app.config['SEARCH_CACHE_SIZE'], app.config['SEARCH_CACHE_TTL'],
+                           app.config['SEARCH_CACHE_SHARED_TTL'])
+# 没有共享缓存层时，每个进程自己记录本进程提交引起的代数变化，再加上数据库里search_worker.py写进ES以后的代数
+generations = {}
+
+
+def generation(index):
+    shared = shared_tier()
+    if shared is None:
+        return '%d.%d' % (stored_generation(index), generations.get(index, 0))
+    value = shared.get(search_cache.key('generation:%s' % index))
+    if value is None:
+        # 共享层里的代数过期或者被淘汰了，换一个新的，不能再命中以前的缓存
+        value = bump_generation(index)
+    return value
+
+
+def stored_generation(index):
+    # 按主键读一行，比一次ES查询便宜得多，search_worker.py在别的进程里同步了修改，这里也能马上看到
+    from app.models import search_generations
+    return db.session.query(search_generations.c.generation).filter(search_generations.c.index == index).scalar() or 0
+
+
+def bump_stored_generation(conn, indexes):
+    # 和删除outbox记录在同一个事务里执行，提交之后所有进程的搜索缓存都失效
+    from app.models import search_generations
+    for index in indexes:
+        updated = conn.execute(search_generations.update().where(search_generations.c.index == index)
+                               .values(generation=search_generations.c.generation + 1)).rowcount
+        if not updated:
+            conn.execute(search_generations.insert(), [{'index': index, 'generation': 1}])
+
+
+def bump_generation(index):
+    shared = shared_tier()
+    if shared is None:
+        generations[index] = generations.get(index, 0) + 1
+        return generations[index]
+    # 共享层只有get/set，多个进程同时读出再加一会互相覆盖，所以每次换成一个随机值
+    value = uuid.uuid4().hex
+    shared.set(search_cache.key('generation:%s' % index), value, app.config['SEARCH_CACHE_SHARED_TTL'])
+    return value
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(anchor, reverse, offset, pit):
+    raw = json.dumps([anchor, 1 if reverse else 0, offset, pit], separators=(',', ':'))
+    return urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('utf-8')
+        anchor, reverse, offset, pit = json.loads(raw)
+    except (binascii.Error, UnicodeDecodeError, ValueError, TypeError):
+        raise InvalidCursor(cursor)
+    # 锚点是(分数, _shard_doc)两个数，pit是字符串，其他的值传给ES只会报错
+    if anchor is not None and not (isinstance(anchor, list) and len(anchor) == 2 and
+                                   all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in anchor)):
+        raise InvalidCursor(cursor)
+    if reverse not in (0, 1) or not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+        raise InvalidCursor(cursor)
+    if not (pit is None or isinstance(pit, str)):
+        raise InvalidCursor(cursor)
+    return anchor, bool(reverse), offset, pit
+
+
+def cached_block(index, query, size, anchor, reverse, pit, with_total):
+    # 一次向ES取size条（SEARCH_CACHE_PREFETCH页）缓存起来，同一块里的翻页不再请求ES。
+    # 缓存的键里没有pit，热门查询的第一页所有人共用一份结果
+    key = '%s:%s:%d:%s:%d:%d:%s' % (index, generation(index), size, md5(json.dumps(anchor).encode('utf-8')).hexdigest(),
+                                    reverse, with_total, md5(query.encode('utf-8')).hexdigest())
+    block = search_cache.get(key)
+    if block is None:
+        # 多取一条，用来判断这一块之外还有没有结果
+        hits, total, pit = query_index(index, query, size + 1, anchor, reverse, pit, with_total)
+        more = len(hits) > size
+        if more:
+            hits = hits[1:] if reverse else hits[:size]
+        elif not reverse:
+            # 往后已经没有结果了，不会再用这个point in time往后翻。往回翻时重新打开一个
+            close_pit(pit)
+            pit = None
+        block = (hits, more, total, pit)
+        search_cache.set(key, block)
+    return block
+
+
+class SearchPagination():
+    # 和KeysetPagination一样提供has_next/has_prev和next_cursor/prev_cursor，total在不统计总数时为None
+    # 游标记录一个锚点（某条结果的排序值）、方向和在这一块里的偏移：
+    # 正向的块是锚点之后的结果，偏移从块头算起；反向的块是锚点之前的结果，偏移从块尾算起
+    def __init__(self, index, query, per_page, cursor=None, with_total=True):
+        anchor, reverse, offset, pit = decode_cursor(cursor) if cursor else (None, False, 0, None)
+        size = per_page * app.config['SEARCH_CACHE_PREFETCH']
+        hits, more, self.total, pit = cached_block(index, query, size, anchor, reverse, pit, with_total)
+        if reverse:
+            end = max(len(hits) - offset, 0)
+            page = hits[max(end - per_page, 0):end]
+            self.has_prev = end > per_page or more
+            self.has_next = True
+            prev = (anchor, True, offset + per_page) if end > per_page else (page[0][1] if page else None, True, 0)
+            next = (anchor, True, offset - per_page) if offset > 0 else (page[-1][1] if page else None, False, 0)
+        else:
+            page = hits[offset:offset + per_page]
+            self.has_next = offset + per_page < len(hits) or more
+            self.has_prev = offset > 0 or anchor is not None
+            next = (anchor, False, offset + per_page) if offset + per_page < len(hits) else \
+                (page[-1][1] if page else None, False, 0)
+            prev = (anchor, False, offset - per_page) if offset > 0 else (page[0][1] if page else None, True, 0)
+        self.ids = [id for id, sort in page]
+        self.has_next = self.has_next and len(page) > 0
+        self.has_prev = self.has_prev and len(page) > 0
+        self.next_cursor = encode_cursor(next[0], next[1], next[2], pit) if self.has_next else None
+        self.prev_cursor = encode_cursor(prev[0], prev[1], prev[2], pit) if self.has_prev else None
+        self.items = []
+
+
+def search_cache_stats():
+    return search_cache.stats()
+
+
+def create_index(index, body):
+    es = client()
+    es.indices.create(index=index, body=body)
+
+
+def ensure_index(index, body):
+    # 索引不存在时创建，由bootstrap.py调用，以前是在导入app时执行的
+    es = client()
+    if es is not None and not es.indices.exists(index=index):
+        es.indices.create(index=index, body=body)
+        return True
+    return False
+
+
+def swap_alias(alias, index):
+    # 原子地把alias指向新的索引，旧的索引如果和alias同名（最早直接建的'post'索引）就直接删掉
+    es = client()
+    actions = [{'add': {'index': index, 'alias': alias}}]
+    if es.indices.exists_alias(name=alias):
+        for old in es.indices.get_alias(name=alias):
+            actions.insert(0, {'remove': {'index': old, 'alias': alias}})
+    elif es.indices.exists(index=alias):
+        actions.insert(0, {'remove_index': {'index': alias}})
+    es.indices.update_aliases(body={'actions': actions})
@@ -0,0 +1,326 @@
+from collections import Counter
+from bisect import bisect_left
+import fcntl
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+
+# 进程内的全文搜索引擎，没有配置ES的时候（开发、测试、小规模部署）作为search.py的后端。
+# 结构和Lucene类似：每次提交写出一个不可修改的段文件，查询时把所有段内存映射（mmap）进来，
+# 删除和更新只是在旧的段上记一个删除标记，段太多时合并成一个。
+# 排序使用BM25，中文、日文、韩文按字切分，再加上相邻两个字组成的词（bigram），不依赖分词词典。
+
+# 假名、中日韩统一表意文字（含扩展A）、韩文音节和兼容表意文字
+CJK = u'\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff'
+TOKEN = re.compile(u'[0-9a-z]+|[%s]+' % CJK)
+CJK_RUN = re.compile(u'[%s]' % CJK)
+
+# 段文件格式（小端）：
+#   头部: magic, 版本, 文档数, 词数, 文档总长度, 词典的偏移
+#   文档表: n_docs个int32的文档id（升序），n_docs个int32的文档长度
+#   倒排表: 每个词连续存放df个(文档id, 词频, 文档长度)三元组，都是int32
+#   词典: 每个词依次为u16长度、utf-8字节、u32倒排表偏移（以int32计）、u32 df
+HEADER = struct.Struct('<4sIIIQQ')
+TERM = struct.Struct('<II')
+MAGIC = b'MBSG'
+VERSION = 1
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text, query=False):
+    tokens = []
+    for run in TOKEN.findall(text.lower()):
+        if not CJK_RUN.match(run):
+            tokens.append(run)
+            continue
+        bigrams = [run[i:i + 2] for i in range(len(run) - 1)]
+        if query:
+            # 查询时连续的汉字只用bigram匹配，单个字才用单字匹配
+            tokens.extend(bigrams or [run])
+        else:
+            # 索引时单字和bigram都要，这样查询单个字也能命中
+            tokens.extend(run)
+            tokens.extend(bigrams)
+    return tokens
+
+
+def write_segment(path, docs):
+    # docs是{文档id: 词的列表}，写出一个段文件
+    ids = sorted(docs)
+    postings = {}
+    lengths = []
+    for id in ids:
+        lengths.append(len(docs[id]))
+        for term, tf in Counter(docs[id]).items():
+            postings.setdefault(term, []).append((id, tf, len(docs[id])))
+    return write_postings(path, ids, lengths, postings)
+
+
+def write_postings(path, ids, lengths, postings):
+    terms = sorted(postings)
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(b'\0' * HEADER.size)
+        f.write(struct.pack('<%di' % len(ids), *ids))
+        f.write(struct.pack('<%di' % len(lengths), *lengths))
+        offsets = []
+        offset = 0
+        for term in terms:
+            plist = postings[term]
+            f.write(struct.pack('<%di' % (3 * len(plist)), *[v for triple in plist for v in triple]))
+            offsets.append(offset)
+            offset += 3 * len(plist)
+        dict_offset = f.tell()
+        for term, offset in zip(terms, offsets):
+            raw = term.encode('utf-8')
+            f.write(struct.pack('<H', len(raw)) + raw + TERM.pack(offset, len(postings[term])))
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(ids), len(terms), sum(lengths), dict_offset))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class Segment():
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self.n_docs, n_terms, self.total_length, dict_offset = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a search segment' % path)
+        view = memoryview(self.mm)
+        start = HEADER.size
+        self.ids = view[start:start + 4 * self.n_docs].cast('i')
+        self.lengths = view[start + 4 * self.n_docs:start + 8 * self.n_docs].cast('i')
+        postings_start = start + 8 * self.n_docs
+        self.postings = view[postings_start:dict_offset].cast('i')
+        # 词典读进内存，倒排表留在mmap里，用到时才由操作系统从磁盘读入
+        self.terms = {}
+        pos = dict_offset
+        for i in range(n_terms):
+            size, = struct.unpack_from('<H', self.mm, pos)
+            term = bytes(self.mm[pos + 2:pos + 2 + size]).decode('utf-8')
+            self.terms[term] = TERM.unpack_from(self.mm, pos + 2 + size)
+            pos += 2 + size + TERM.size
+        self.deleted = set()
+        self.load_deleted()
+
+    def load_deleted(self):
+        path = self.path + '.del'
+        self.deleted = set()
+        if os.path.exists(path):
+            with open(path) as f:
+                self.deleted = set(json.load(f))
+
+    def save_deleted(self):
+        tmp = self.path + '.del.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(sorted(self.deleted), f)
+        os.replace(tmp, self.path + '.del')
+
+    def contains(self, id):
+        i = bisect_left(self.ids, id)
+        return i < self.n_docs and self.ids[i] == id
+
+    def postings_for(self, term):
+        entry = self.terms.get(term)
+        if entry is None:
+            return
+        offset, df = entry
+        postings = self.postings
+        for i in range(offset, offset + 3 * df, 3):
+            if postings[i] not in self.deleted:
+                yield postings[i], postings[i + 1], postings[i + 2]
+
+    def live(self):
+        return self.n_docs - len(self.deleted)
+
+    def close(self):
+        self.ids.release()
+        self.lengths.release()
+        self.postings.release()
+        self.mm.close()
+
+
+class Index():
+    # 一个索引对应一个目录，manifest.json记录当前有哪些段
+    def __init__(self, path, merge_segments):
+        self.path = path
+        self.merge_segments = merge_segments
+        self.segments = {}
+        self.names = []
+        self.stamp = None
+        os.makedirs(path, exist_ok=True)
+
+    def manifest_path(self):
+        return os.path.join(self.path, 'manifest.json')
+
+    def refresh(self):
+        # 其他进程提交后manifest会变，这时重新加载段列表，已经打开的段只重新读取删除标记
+        try:
+            st = os.stat(self.manifest_path())
+        except FileNotFoundError:
+            return
+        stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if stamp == self.stamp:
+            return
+        with open(self.manifest_path()) as f:
+            manifest = json.load(f)
+        segments = {}
+        for name in manifest['segments']:
+            segment = self.segments.pop(name, None)
+            if segment is None:
+                segment = Segment(os.path.join(self.path, name))
+            else:
+                segment.load_deleted()
+            segments[name] = segment
+        # 合并后不再使用的段，关闭它们的mmap
+        for segment in self.segments.values():
+            segment.close()
+        self.segments = segments
+        self.names = manifest['segments']
+        self.next = manifest['next']
+        self.stamp = stamp
+
+    def commit(self, docs, deleted):
+        # docs是{文档id: 文本}，deleted是要删除的文档id集合
+        with open(os.path.join(self.path, 'LOCK'), 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.stamp = None
+            self.next = 1
+            self.refresh()
+            dead = set(docs) | set(deleted)
+            for segment in self.segments.values():
+                hit = set(id for id in dead if segment.contains(id)) - segment.deleted
+                if hit:
+                    segment.deleted |= hit
+                    segment.save_deleted()
+            names = list(self.names)
+            if docs:
+                name = 'seg_%06d' % self.next
+                self.next += 1
+                write_segment(os.path.join(self.path, name), dict((id, tokenize(text)) for id, text in docs.items()))
+                names.append(name)
+            self.write_manifest(names)
+            self.refresh()
+            if len(self.names) > self.merge_segments:
+                self.merge()
+
+    def merge(self):
+        # 把所有段里还有效的文档合并成一个段，顺便清理掉删除标记
+        ids = []
+        lengths = []
+        postings = {}
+        for segment in self.segments.values():
+            for i in range(segment.n_docs):
+                if segment.ids[i] not in segment.deleted:
+                    ids.append(segment.ids[i])
+                    lengths.append(segment.lengths[i])
+            for term in segment.terms:
+                postings.setdefault(term, []).extend(segment.postings_for(term))
+        order = sorted(range(len(ids)), key=ids.__getitem__)
+        ids = [ids[i] for i in order]
+        lengths = [lengths[i] for i in order]
+        for term in postings:
+            postings[term].sort()
+        postings = dict((term, plist) for term, plist in postings.items() if plist)
+        name = 'seg_%06d' % self.next
+        self.next += 1
+        write_postings(os.path.join(self.path, name), ids, lengths, postings)
+        old = list(self.names)
+        self.write_manifest([name])
+        self.refresh()
+        for old_name in old:
+            for suffix in ('', '.del'):
+                if os.path.exists(os.path.join(self.path, old_name + suffix)):
+                    os.remove(os.path.join(self.path, old_name + suffix))
+
+    def write_manifest(self, names):
+        tmp = self.manifest_path() + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'segments': names, 'next': self.next}, f)
+        os.replace(tmp, self.manifest_path())
+
+    def scores(self, query):
+        self.refresh()
+        segments = list(self.segments.values())
+        n = sum(segment.live() for segment in segments)
+        if n == 0:
+            return {}
+        avgdl = float(sum(segment.total_length for segment in segments)) / sum(segment.n_docs for segment in segments)
+        scores = {}
+        for term in set(tokenize(query, query=True)):
+            matches = [posting for segment in segments for posting in segment.postings_for(term)]
+            if not matches:
+                continue
+            idf = math.log(1 + (n - len(matches) + 0.5) / (len(matches) + 0.5))
+            for id, tf, dl in matches:
+                scores[id] = scores.get(id, 0.0) + idf * tf * (K1 + 1) / (tf + K1 * (1 - B + B * dl / avgdl))
+        return scores
+
+    def search(self, query, offset, size):
+        scores = self.scores(query)
+        # 分数相同的时候按id倒序，新的博客排在前面
+        top = heapq.nlargest(offset + size, scores.items(), key=lambda item: (item[1], item[0]))
+        return [id for id, score in top[offset:]], len(scores)
+
+    def search_after(self, query, size, after=None, reverse=False):
+        # 按(分数, id)倒序排列，返回排在after之后（reverse时为之前）的size条，和ES的search_after一样
+        scores = self.scores(query)
+        keys = [(score, id) for id, score in scores.items()]
+        if after is not None:
+            after = tuple(after)
+            keys = [key for key in keys if (key > after if reverse else key < after)]
+        if reverse:
+            hits = sorted(heapq.nsmallest(size, keys), reverse=True)
+        else:
+            hits = heapq.nlargest(size, keys)
+        return [(id, [score, id]) for score, id in hits], len(scores)
+
+
+class EmbeddedSearch():
+    def __init__(self, path, merge_segments=10):
+        self.path = path
+        self.merge_segments = merge_segments
+        self.indexes = {}
+        self.lock = threading.Lock()
+
+    def index(self, name):
+        with self.lock:
+            if name not in self.indexes:
+                self.indexes[name] = Index(os.path.join(self.path, name), self.merge_segments)
+            return self.indexes[name]
+
+    def bulk(self, actions):
+        # 和search.bulk_index的参数一样，每个索引的所有修改作为一次提交
+        grouped = {}
+        for op, index, id, payload in actions:
+            docs, deleted = grouped.setdefault(index, ({}, set()))
+            if op == 'index':
+                docs[id] = ' '.join(str(value) for value in payload.values() if value is not None)
+                deleted.discard(id)
+            else:
+                docs.pop(id, None)
+                deleted.add(id)
+        for index, (docs, deleted) in grouped.items():
+            target = self.index(index)
+            with self.lock:
+                target.commit(docs, deleted)
+        return set()
+
+    def search(self, index, query, offset, size):
+        target = self.index(index)
+        with self.lock:
+            return target.search(query, offset, size)
+
+    def search_after(self, index, query, size, after=None, reverse=False):
+        target = self.index(index)
+        with self.lock:
+            return target.search_after(query, size, after, reverse)
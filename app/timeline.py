@@ -0,0 +1,162 @@
+from app import app, db
+from app.models import User, Post, followers, timeline
+from sqlalchemy import select, func, literal, tuple_, and_, not_, exists
+
+# 首页时间线的写扩散（fan-out-on-write）
+# 发博客时把博客推到每个粉丝的时间线里，首页直接读取预先算好的一小段，而不是每次都去join followers表。
+# 粉丝数超过TIMELINE_FANOUT_LIMIT的作者不做写扩散，否则一条博客就会变成几百万次写入，
+# 这些作者的博客在读取时间线的时候再合并进来（读扩散）。
+
+
+def enabled():
+    return app.config.get('TIMELINE_ENABLED', False)
+
+
+def home_timeline(user, depth):
+    # depth是这次翻页需要读到的最深位置，超过了时间线保留的长度就只能回落到原来的join查询
+    if not enabled() or depth > app.config['TIMELINE_LENGTH']:
+        return user.followed_posts()
+    pushed = Post.query.join(timeline, timeline.c.post_id == Post.id).filter(timeline.c.user_id == user.id)
+    # 大V的博客没有写进时间线，读取时按关注关系合并
+    pulled = Post.query.join(followers, followers.c.followed_id == Post.user_id).join(User, User.id == Post.user_id) \
+        .filter(followers.c.follower_id == user.id, User.timeline_pull == True)
+    return pushed.union(pulled).options(db.joinedload(Post.author)).order_by(Post.timestamp.desc())
+
+
+def newest_timestamp(user):
+    # 首页上最新一条博客的时间，给条件GET用。时间线表的(user_id, timestamp)索引上只需要读一行，
+    # 不用像join followers表那样对每个关注的人都查一次；大V的博客不在时间线里，单独按关注关系查，这样的作者很少
+    pushed = db.session.query(func.max(timeline.c.timestamp)).filter(timeline.c.user_id == user.id).scalar()
+    pulled = db.session.query(func.max(Post.timestamp)).join(followers, followers.c.followed_id == Post.user_id) \
+        .join(User, User.id == Post.user_id).filter(followers.c.follower_id == user.id, User.timeline_pull == True) \
+        .scalar()
+    return max([t for t in (pushed, pulled) if t is not None], default=None)
+
+
+def fan_out(conn, post):
+    user_table = User.__table__
+    author_id = post.user_id
+    pull, count = conn.execute(select([user_table.c.timeline_pull, user_table.c.follower_count])
+                               .where(user_table.c.id == author_id)).first()
+    if pull:
+        return
+    if count > app.config['TIMELINE_FANOUT_LIMIT']:
+        # 粉丝太多，切换成读扩散，之后这个作者的博客都不再推送
+        conn.execute(user_table.update().where(user_table.c.id == author_id).values(timeline_pull=True))
+        return
+    fans = select([followers.c.follower_id]).where(followers.c.followed_id == author_id)
+    conn.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'author_id', 'timestamp'],
+        select([followers.c.follower_id, literal(post.id), literal(author_id),
+                literal(post.timestamp, type_=db.DateTime)]).where(followers.c.followed_id == author_id)))
+    # 每次推送都截断的话，要对所有粉丝的时间线排一次序，所以这里摊薄到每TIMELINE_TRIM_INTERVAL条博客做一次
+    if post.id % app.config['TIMELINE_TRIM_INTERVAL'] == 0:
+        trim(conn, fans)
+
+
+def backfill(conn, follower_id, followed_id):
+    # 新关注了一个人，把他最近的博客补进自己的时间线
+    user_table = User.__table__
+    post_table = Post.__table__
+    if conn.execute(select([user_table.c.timeline_pull]).where(user_table.c.id == followed_id)).scalar():
+        return
+    # 同一次flush里可能已经推送过新博客，所以要跳过时间线里已经存在的条目
+    present = exists().where(and_(timeline.c.user_id == follower_id, timeline.c.post_id == post_table.c.id))
+    recent = select([literal(follower_id), post_table.c.id, post_table.c.user_id, post_table.c.timestamp]) \
+        .where(and_(post_table.c.user_id == followed_id, not_(present))) \
+        .order_by(post_table.c.timestamp.desc()).limit(app.config['TIMELINE_LENGTH'])
+    conn.execute(timeline.insert().from_select(['user_id', 'post_id', 'author_id', 'timestamp'], recent))
+    trim(conn, [follower_id])
+
+
+def prune(conn, follower_id, followed_id):
+    # 取消关注时，把这个作者的博客从时间线里删掉，再从剩下关注的人那里补足
+    conn.execute(timeline.delete().where(and_(timeline.c.user_id == follower_id, timeline.c.author_id == followed_id)))
+    refill(conn, [follower_id])
+
+
+def refill(conn, user_ids):
+    # 时间线里删掉了条目以后（取消关注、删除博客），从还在关注的人的博客里补到TIMELINE_LENGTH条，已有的条目保留。
+    # 不补的话时间线变短了，翻页深度的检查却还是通过，首页就会少博客甚至是空的。
+    # 所有用户用一条INSERT ... SELECT补，每个用户取关注的人最新的TIMELINE_LENGTH条（和recent_posts()一样），跳过已有的
+    user_table = User.__table__
+    post_table = Post.__table__
+    ranked = select([
+        followers.c.follower_id.label('user_id'), post_table.c.id.label('post_id'),
+        post_table.c.user_id.label('author_id'), post_table.c.timestamp,
+        func.row_number().over(partition_by=followers.c.follower_id, order_by=post_table.c.timestamp.desc()).label('rank')
+    ]).select_from(post_table.join(followers, followers.c.followed_id == post_table.c.user_id)
+                   .join(user_table, user_table.c.id == post_table.c.user_id)) \
+        .where(and_(followers.c.follower_id.in_(user_ids), not_(user_table.c.timeline_pull == True))).alias('ranked')
+    present = exists().where(and_(timeline.c.user_id == ranked.c.user_id, timeline.c.post_id == ranked.c.post_id))
+    conn.execute(timeline.insert().from_select(
+        ['user_id', 'post_id', 'author_id', 'timestamp'],
+        select([ranked.c.user_id, ranked.c.post_id, ranked.c.author_id, ranked.c.timestamp])
+        .where(and_(ranked.c.rank <= app.config['TIMELINE_LENGTH'], not_(present)))))
+    trim(conn, user_ids)
+
+
+def trim(conn, user_ids):
+    # 每个用户只保留最新的TIMELINE_LENGTH条，user_ids可以是id列表也可以是子查询
+    ranked = select([
+        timeline.c.user_id, timeline.c.post_id,
+        func.row_number().over(partition_by=timeline.c.user_id, order_by=timeline.c.timestamp.desc()).label('rank')
+    ]).where(timeline.c.user_id.in_(user_ids)).alias('ranked')
+    expired = select([ranked.c.user_id, ranked.c.post_id]).where(ranked.c.rank > app.config['TIMELINE_LENGTH'])
+    conn.execute(timeline.delete().where(tuple_(timeline.c.user_id, timeline.c.post_id).in_(expired)))
+
+
+def recent_posts(user_id):
+    # 关注的人（不含读扩散的大V）最新的TIMELINE_LENGTH条博客，列的顺序和timeline表一致
+    user_table = User.__table__
+    post_table = Post.__table__
+    return select([literal(user_id), post_table.c.id, post_table.c.user_id, post_table.c.timestamp]) \
+        .select_from(post_table.join(followers, followers.c.followed_id == post_table.c.user_id)
+                     .join(user_table, user_table.c.id == post_table.c.user_id)) \
+        .where(and_(followers.c.follower_id == user_id, not_(user_table.c.timeline_pull == True))) \
+        .order_by(post_table.c.timestamp.desc()).limit(app.config['TIMELINE_LENGTH'])
+
+
+def rebuild(conn, user_id):
+    # 从头重建一个用户的时间线，用于刚打开TIMELINE_ENABLED或者数据修复
+    conn.execute(timeline.delete().where(timeline.c.user_id == user_id))
+    conn.execute(timeline.insert().from_select(['user_id', 'post_id', 'author_id', 'timestamp'], recent_posts(user_id)))
+
+
+def on_follow(follower, followed, initiator):
+    # 关注关系在flush之前还没有写进数据库，所以先记下来，等after_flush时再处理
+    db.session.info.setdefault('timeline_ops', []).append((backfill, follower, followed))
+
+
+def on_unfollow(follower, followed, initiator):
+    db.session.info.setdefault('timeline_ops', []).append((prune, follower, followed))
+
+
+def after_flush(session, flush_context):
+    ops = session.info.pop('timeline_ops', [])
+    if not enabled():
+        return
+    conn = session.connection()
+    # 先推送新博客，再处理关注关系，backfill会跳过已经推送过的条目
+    for obj in session.new:
+        if isinstance(obj, Post):
+            fan_out(conn, obj)
+    for obj in session.deleted:
+        if isinstance(obj, Post):
+            # 删掉的博客在哪些时间线里，删除之后这些时间线要补足。只有删除后不到TIMELINE_LENGTH条的才需要补，
+            # 还没截断的长时间线不用管，一条分组查询就能查出所有粉丝的时间线长度
+            fans = select([timeline.c.user_id]).where(timeline.c.post_id == obj.id)
+            counts = conn.execute(select([timeline.c.user_id, func.count()]).where(timeline.c.user_id.in_(fans))
+                                  .group_by(timeline.c.user_id))
+            short = [user_id for user_id, count in counts if count <= app.config['TIMELINE_LENGTH']]
+            conn.execute(timeline.delete().where(timeline.c.post_id == obj.id))
+            if short:
+                refill(conn, short)
+    for op, follower, followed in ops:
+        op(conn, follower.id, followed.id)
+
+
+# 注册监听函数，和SearchableMixin一样挂在session的事件上
+db.event.listen(User.followed, 'append', on_follow)
+db.event.listen(User.followed, 'remove', on_unfollow)
+db.event.listen(db.session, 'after_flush', after_flush)
@@ -0,0 +1,323 @@
+from app import app, db
+from app.models import Post
+from app.search_engine import tokenize
+from hashlib import blake2b
+from datetime import datetime
+import calendar
+import heapq
+import os
+import re
+import struct
+import threading
+import time
+import numpy as np
+
+# 热门话题：最近TRENDING_WINDOW秒内被最多博客提到的词和话题标签（#xxx），不用每次请求都对post表做GROUP BY。
+# 新博客提交时（和SearchableMixin一样挂在session的事件上）分词后计入内存中的统计：
+#   - 计数用count-min sketch，一个depth x width的计数矩阵，每个词在每一行按不同的哈希落到一列，
+#     估计值取各行的最小值，只会多估不会少估，多估的部分不超过窗口内词的总数 * e / width（概率1 - e^-depth）
+#   - 窗口分成TRENDING_BUCKETS个桶，每个桶一个sketch，另外一个sketch是窗口内所有桶的和，桶过期时从和里减掉
+#   - 估计值最大的若干个词放在候选集合里，用一个堆找出其中最小的，新词的估计值超过它时替换掉它
+# 每个进程一份：第一次使用时在后台线程里从post表读取窗口内的博客建好，之后每TRENDING_SYNC_INTERVAL秒在后台用主键补上
+# 其他进程或者ingest.py写入的博客，请求不等待。其他进程删除的博客要等进程重启才会从统计里去掉。
+
+# 候选集合的大小是TRENDING_TOP的这么多倍，排名靠后的词估计值接近时不容易被挤出去
+CANDIDATE_FACTOR = 10
+HASHTAG = re.compile(r'#(\w+)')
+STOPWORDS = frozenset('''
+    about after again all also am an and any are as at be because been before being but by can could did do does
+    doing down for from had has have having he her here hers him his how if in into is it its just me more most my
+    no not now of off on once only or other our out over own same she should so some such than that the their them
+    then there these they this those through to too under until up very was we were what when where which while who
+    whom why will with would you your yours im dont cant its thats
+'''.split())
+
+
+def post_terms(text):
+    # 话题标签整体作为一个词；其他部分用搜索引擎的分词，连续的汉字只取bigram，去掉停用词、单个字母和纯数字。
+    # 同一条博客里重复的词只算一次，刷屏的博客不会把一个词顶上去
+    text = text or ''
+    terms = set('#' + tag.lower() for tag in HASHTAG.findall(text))
+    for term in tokenize(HASHTAG.sub(' ', text), query=True):
+        if len(term) > 1 and not term.isdigit() and term not in STOPWORDS:
+            terms.add(term)
+    return sorted(terms)
+
+
+def epoch(timestamp):
+    # 博客的时间是UTC，没有时区
+    return calendar.timegm(timestamp.utctimetuple())
+
+
+class CountMinSketch():
+    def __init__(self, width, depth):
+        self.width = width
+        self.table = np.zeros((depth, width), dtype=np.int32)
+        self.rows = np.arange(depth)
+
+    def columns(self, terms):
+        # 每个词在每一行的列号，shape为(词数, depth)。两个独立的32位哈希h1、h2组合出depth个哈希：h1 + i * h2
+        hashes = np.array([struct.unpack('<II', blake2b(term.encode('utf-8'), digest_size=8).digest()) for term in terms],
+                          dtype=np.uint64).reshape(-1, 2)
+        return ((hashes[:, :1] + self.rows.astype(np.uint64) * (hashes[:, 1:] | 1)) % self.width).astype(np.intp)
+
+    def add(self, columns, count=1):
+        # 同一行里两个词可能落在同一列，要用add.at才会都加上
+        np.add.at(self.table, (self.rows, columns), count)
+
+    def estimate(self, columns):
+        return self.table[self.rows, columns].min(axis=1)
+
+    def nbytes(self):
+        return self.table.nbytes
+
+
+class TrendingTerms():
+    def __init__(self, window, buckets, width, depth, top):
+        self.bucket_seconds = max(1, window // buckets)
+        self.buckets = [(None, CountMinSketch(width, depth)) for i in range(buckets)]
+        self.window = CountMinSketch(width, depth)
+        self.current = None
+        self.capacity = top * CANDIDATE_FACTOR
+        # 候选词到估计值，堆里是(估计值, 词)，估计值变了就再压一个，过时的条目在弹出时跳过
+        self.candidates = {}
+        self.heap = []
+        self.posts = 0
+        self.lock = threading.Lock()
+
+    def bucket_of(self, timestamp):
+        return int(epoch(timestamp) // self.bucket_seconds)
+
+    def advance(self, bucket):
+        # 窗口滑到bucket，移出窗口的桶从总和里减掉再清零
+        if self.current is not None and bucket <= self.current:
+            return
+        self.current = bucket
+        expired = False
+        for i, (number, sketch) in enumerate(self.buckets):
+            if number is not None and number <= bucket - len(self.buckets):
+                self.window.table -= sketch.table
+                sketch.table[:] = 0
+                self.buckets[i] = (None, sketch)
+                expired = True
+        if expired:
+            self.reestimate()
+
+    def reestimate(self):
+        terms = list(self.candidates)
+        counts = self.window.estimate(self.window.columns(terms)) if terms else []
+        self.candidates = dict((term, int(count)) for term, count in zip(terms, counts) if count > 0)
+        self.heap = [(count, term) for term, count in self.candidates.items()]
+        heapq.heapify(self.heap)
+
+    def add(self, terms, timestamp, count=1):
+        # count为-1时是删除博客；窗口以前的博客不再计数
+        if not terms:
+            return
+        with self.lock:
+            bucket = self.bucket_of(timestamp)
+            self.advance(bucket)
+            if bucket <= self.current - len(self.buckets):
+                return
+            number, sketch = self.buckets[bucket % len(self.buckets)]
+            self.buckets[bucket % len(self.buckets)] = (bucket, sketch)
+            columns = self.window.columns(terms)
+            sketch.add(columns, count)
+            self.window.add(columns, count)
+            self.posts += count
+            for term, estimate in zip(terms, self.window.estimate(columns)):
+                self.offer(term, int(estimate))
+
+    def offer(self, term, estimate):
+        if term in self.candidates or len(self.candidates) < self.capacity:
+            self.candidates[term] = estimate
+            heapq.heappush(self.heap, (estimate, term))
+        else:
+            while self.heap[0][1] not in self.candidates or self.candidates[self.heap[0][1]] != self.heap[0][0]:
+                heapq.heappop(self.heap)
+            if estimate <= self.heap[0][0]:
+                return
+            del self.candidates[heapq.heappop(self.heap)[1]]
+            self.candidates[term] = estimate
+            heapq.heappush(self.heap, (estimate, term))
+        if len(self.heap) > 4 * self.capacity:
+            self.heap = [(count, term) for term, count in self.candidates.items()]
+            heapq.heapify(self.heap)
+
+    def top(self, k, min_count=1, now=None):
+        # 返回[(词, 估计的博客数)]，没有新博客时窗口也要按当前时间往前滑
+        with self.lock:
+            self.advance(int((now or time.time()) // self.bucket_seconds))
+            ranked = sorted(self.candidates.items(), key=lambda item: (-item[1], item[0]))
+        return [(term, count) for term, count in ranked[:k] if count >= min_count]
+
+    def estimate(self, term):
+        with self.lock:
+            return int(self.window.estimate(self.window.columns([term]))[0])
+
+    def nbytes(self):
+        return self.window.nbytes() + sum(sketch.nbytes() for number, sketch in self.buckets)
+
+
+trending = None
+trending_lock = threading.Lock()
+# 正在后台加载或者补读的进程号，同一时间只有一个线程做，fork出来的子进程不会继承父进程里的线程
+syncing = None
+# 上一次加载或者补读失败的时间，之后一段时间内不再重试，不会每个请求都去扫post表
+failed_at = 0
+# 已经计入统计的最大博客id，以及提交事件计入的、比它大的博客id，补读post表时跳过
+last_id = 0
+counted = set()
+synced_at = 0
+
+
+def new_trending():
+    return TrendingTerms(app.config['TRENDING_WINDOW'], app.config['TRENDING_BUCKETS'],
+                         app.config['TRENDING_SKETCH_WIDTH'], app.config['TRENDING_SKETCH_DEPTH'],
+                         app.config['TRENDING_TOP'])
+
+
+def read_posts(after_id, since=None, until_id=None):
+    # 按主键分段读取博客，每次只有一段在内存里
+    chunk = app.config['TRENDING_LOAD_CHUNK']
+    while True:
+        query = db.session.query(Post.id, Post.body, Post.timestamp).filter(Post.id > after_id)
+        if since is not None:
+            query = query.filter(Post.timestamp >= since)
+        if until_id is not None:
+            query = query.filter(Post.id <= until_id)
+        rows = query.order_by(Post.id).limit(chunk).all()
+        if not rows:
+            return
+        after_id = rows[-1][0]
+        for row in rows:
+            yield row
+
+
+def refresh_trending():
+    # 从post表重新建立统计，只读窗口内的博客
+    global trending, last_id, synced_at
+    stats = new_trending()
+    newest = db.session.query(db.func.max(Post.id)).scalar() or 0
+    since = datetime.utcfromtimestamp(time.time() - app.config['TRENDING_WINDOW'])
+    for id, body, timestamp in read_posts(0, since, newest):
+        stats.add(post_terms(body), timestamp)
+    with trending_lock:
+        trending = stats
+        last_id = newest
+        counted.clear()
+        synced_at = time.time()
+    return stats
+
+
+def sync_trending():
+    # 补上其他进程写入的博客
+    global last_id, synced_at
+    with trending_lock:
+        start = last_id
+        synced_at = time.time()
+    newest = start
+    for id, body, timestamp in read_posts(start):
+        newest = id
+        # 检查和计入放在同一把锁里，同时提交的这条博客不会被这里和count_posts各算一次
+        with trending_lock:
+            if id in counted:
+                continue
+            counted.add(id)
+            trending.add(post_terms(body), timestamp)
+    with trending_lock:
+        last_id = max(last_id, newest)
+        counted.difference_update([id for id in counted if id <= last_id])
+
+
+def load_in_background():
+    # 第一次使用时从post表建立统计，以后补读其他进程写入的博客，都在后台线程里做
+    global syncing, failed_at
+    try:
+        with app.app_context():
+            if trending is None:
+                refresh_trending()
+            else:
+                sync_trending()
+    except Exception:
+        failed_at = time.time()
+        app.logger.exception('failed to load trending terms')
+    finally:
+        with trending_lock:
+            syncing = None
+
+
+def retry_interval():
+    # 没有定期补读时，加载失败后隔一个桶的时间再重试
+    return app.config['TRENDING_SYNC_INTERVAL'] or app.config['TRENDING_WINDOW'] // app.config['TRENDING_BUCKETS']
+
+
+def current_trending():
+    # 返回当前的统计，请求不等待加载和补读：还没加载好时返回None（首页不显示热门话题），
+    # 补读期间继续使用现有的统计
+    global syncing
+    if not app.config['TRENDING_ENABLED']:
+        return None
+    current = trending
+    interval = app.config['TRENDING_SYNC_INTERVAL']
+    now = time.time()
+    due = current is None or (interval is not None and now - synced_at >= interval)
+    if due and now - failed_at >= retry_interval():
+        with trending_lock:
+            if syncing != os.getpid():
+                syncing = os.getpid()
+                threading.Thread(target=load_in_background, name='trending', daemon=True).start()
+    return current
+
+
+def trending_terms(k=None):
+    stats = current_trending()
+    if stats is None:
+        return []
+    return stats.top(k or app.config['TRENDING_TOP'], app.config['TRENDING_MIN_COUNT'])
+
+
+def collect_posts(session, flush_context):
+    # flush之后新博客才有id，提交之后再计入统计，回滚的不算
+    changes = session.info.setdefault('trending_changes', [])
+    for obj, count in [(obj, 1) for obj in session.new] + [(obj, -1) for obj in session.deleted]:
+        if isinstance(obj, Post):
+            # 删掉的博客在flush之后已经不能再从数据库加载，只用已经加载了的字段
+            fields = db.inspect(obj).dict
+            if fields.get('timestamp') is not None:
+                changes.append((obj.id, fields.get('body'), fields['timestamp'], count))
+
+
+def count_posts(session):
+    changes = session.info.pop('trending_changes', [])
+    if trending is None or not app.config['TRENDING_ENABLED']:
+        return
+    for id, body, timestamp, count in changes:
+        with trending_lock:
+            if count > 0:
+                if id <= last_id or id in counted:
+                    continue
+                counted.add(id)
+            elif id > last_id and id not in counted:
+                # 还没有计入过（补读之前就删掉了）
+                continue
+            else:
+                counted.discard(id)
+            trending.add(post_terms(body), timestamp, count)
+
+
+def discard_posts(session):
+    session.info.pop('trending_changes', None)
+
+
+def trending_stats():
+    stats = trending
+    if stats is None:
+        return {'bytes': 0, 'posts': 0}
+    return {'bytes': stats.nbytes(), 'posts': stats.posts}
+
+
+# 注册监听函数，和SearchableMixin一样挂在session的事件上
+db.event.listen(db.session, 'after_flush', collect_posts)
+db.event.listen(db.session, 'after_commit', count_posts)
+db.event.listen(db.session, 'after_rollback', discard_posts)
@@ -1,12 +1,25 @@
-from flask import render_template, flash, redirect, session, url_for, request, g
+from flask import render_template, flash, redirect, session, url_for, request, g, abort, Response
 from flask_login import login_user, logout_user, current_user, login_required
 from app import app, db, lm, oid
 from app.forms import LoginForm, RegistrationForm, EditForm, PostForm
-from app.models import User, Post
+from app.models import User, Post, get_user_by_nickname
 from datetime import datetime
 from config import POST_PER_PAGE
 from app.forms import SearchForm
 from app.mails import follower_notification
+from app.timeline import home_timeline
+from app.last_seen import last_seen_buffer
+from app.pagination import keyset_paginate, legacy_cursor, cursor_depth, InvalidCursor
+from app.conditional import not_modified, timeline_validator, profile_validator
+from app.metrics import registry
+from app.models import user_cache
+from app.search import search_cache_stats
+from app.fragments import fragment_cache_stats
+from app.mails import dispatcher
+from app.indexer import outbox_stats
+from app.replicas import replica_reads, replica_stats
+from app.features import current_graph, who_to_follow, graph_stats, trending_terms, trending_stats
+from app.logs import logging_stats
 import pdb
 
 
@@ -16,10 +29,9 @@ def before_request():
     # 这一步的作用是，在接受request之前提前填充g.user变量
     g.user = current_user
     if g.user.is_authenticated:
-        # 每次页面发送请求后，都会在数据库更新浏览时间
-        g.user.last_seen = datetime.utcnow()
-        db.session.add(g.user)
-        db.session.commit()
+        # 每次页面发送请求后，都会更新浏览时间
+        # 不再每个请求都提交一次事务，而是记在缓冲区里，定期批量写回数据库
+        last_seen_buffer.touch(g.user.id, g.user.last_seen)
         # 因为我们几乎要在所有的页面都用到SearchForm的实例，与其在每个路由中都创建表单对象，然后再把对象传给模板
         # 不如，直接在将表单对象配置成全局变量。这样可以消除重复代码。
         # 还有一个好处，在模板中也能看到g变量，所以我们不需要显式的给模板传递Form
@@ -31,6 +43,7 @@ def before_request():
 # 分页的时候需要API这边传入一个数字类型的page参数
 @app.route('/index/<int:page>', methods=['GET', 'POST'])
 @login_required
+@replica_reads
 def index(page=1):
     # login_required装饰器保证，该页面只被已登录的用户看到
     user = g.user
@@ -39,7 +52,23 @@ def index(page=1):
     # Flask-SQLAlchemy天生就支持分页，使用函数paginate(页数从1开始, 每一页的条目数, 错误标志为真返回404为假返回空列表), paginate函数返回一个Pagination对象。该对象的items属性是blog列表。他还有其他很有意思的属性。
     # posts = g.user.followed_posts().all()
     # 我们不使用.items属性，而是直接使用Pagination对象，将这个对象传入模板。
-    posts = g.user.followed_posts().paginate(page, POST_PER_PAGE, False)
+    # paginate()每次都要COUNT(*)再OFFSET，越往后翻越慢，所以改用before/after游标分页，旧的页码URL转换成游标后重定向
+    if page > 1:
+        cursor = legacy_cursor(home_timeline(user, page * POST_PER_PAGE), page, POST_PER_PAGE)
+        return redirect(url_for('index', before=cursor) if cursor else url_for('index'))
+    # 页面没有变化时直接返回304，不用再查询时间线和渲染模板
+    if request.method in ('GET', 'HEAD'):
+        response = not_modified(timeline_validator(user))
+        if response is not None:
+            return response
+    before = request.args.get('before')
+    after = request.args.get('after')
+    try:
+        # 打开TIMELINE_ENABLED后，首页读取预先推送好的时间线，而不是每次都去join followers表
+        timeline = home_timeline(user, cursor_depth(POST_PER_PAGE, before, after))
+        posts = keyset_paginate(timeline, POST_PER_PAGE, before, after)
+    except InvalidCursor:
+        abort(404)
     # posts = [{'author': {'nickname': 'John'},
     #           'body': 'Beautiful day in Portland!'},
     #          {'author': {'nickname': 'Suan'},
@@ -54,7 +83,7 @@ def index(page=1):
         # 这里为什么不使用reander_template直接生成表单?因为考虑用户误操作的情况下（比如误刷新，浏览器回重新发送上一个请求，作为刷新浏览器的结果），浏览器冲突提交POST请求回造成数据的冗余。这不是我们预期的结果。
         # 有了重定向的话，那么浏览器最后一个收到的请求就是重定向，这并不会造成重复提交。
         return redirect(url_for('index'))
-    return render_template('index.html', title='Home', form=form, user=user, posts=posts)
+    return render_template('index.html', title='Home', form=form, user=user, posts=posts, trending=trending_terms())
 
 
 # 如果有method参数的话，视图接受GET和POST请求。如果不带method参数的话，只接收GET请求。
@@ -109,10 +138,8 @@ def after_login(resp):
         nickname = resp.nickname
         if nickname is None or nickname == '':
             nickname = resp.email.split('@')[0]
-        # 防止出现重复的用户名
-        nickname = User.make_unique_nickname(nickname)
-        user = User(nickname=nickname, email=resp.email)
-        db.session.add(user)
+        # 防止出现重复的用户名，并发登录时抢到同一个名字会重新分配
+        user = User.add_unique(nickname, email=resp.email)
         db.session.commit()
     remember_me = False
     if 'remember_me' in session:
@@ -149,8 +176,9 @@ def register():
 @app.route('/user/<nickname>')
 @app.route('/user/<nickname>/<int:page>')
 @login_required
+@replica_reads
 def user(nickname, page=1):
-    user = User.query.filter_by(nickname=nickname).first()
+    user = get_user_by_nickname(nickname)
     if user is None:
         flash('User ' + nickname + ' not found.')
         return redirect(url_for('index'))
@@ -159,8 +187,21 @@ def user(nickname, page=1):
     #     {'author': user, 'body': 'Test post #1'},
     #     {'author': user, 'body': 'Test post #2'}
     # ]
-    posts = user.posts.paginate(page, POST_PER_PAGE, False)
-    return render_template('user.html', user=user, posts=posts)
+    if page > 1:
+        cursor = legacy_cursor(user.posts, page, POST_PER_PAGE)
+        return redirect(url_for('user', nickname=nickname, before=cursor) if cursor else url_for('user', nickname=nickname))
+    response = not_modified(profile_validator(user, g.user))
+    if response is not None:
+        return response
+    try:
+        posts = keyset_paginate(user.posts, POST_PER_PAGE, request.args.get('before'), request.args.get('after'))
+    except InvalidCursor:
+        abort(404)
+    # 推荐关注只显示在自己的主页上；“Follows you”来自内存中的关注图，最多是GRAPH_REBUILD_INTERVAL秒以前的
+    suggestions = who_to_follow(user) if user.id == g.user.id else []
+    graph = current_graph()
+    follows_you = graph is not None and user.id != g.user.id and graph.follows(user.id, g.user.id)
+    return render_template('user.html', user=user, posts=posts, suggestions=suggestions, follows_you=follows_you)
 
 
 @app.route('/edit', methods=['GET', 'POST'])
@@ -183,7 +224,7 @@ def edit():
 @app.route('/follow/<nickname>')
 @login_required
 def follow(nickname):
-    user = User.query.filter_by(nickname=nickname).first()
+    user = get_user_by_nickname(nickname)
     if user is None:
         flash('User %s not found.' % nickname)
         return redirect(url_for('index'))
@@ -205,7 +246,7 @@ def follow(nickname):
 @app.route('/unfollow/<nickname>')
 @login_required
 def unfollow(nickname):
-    user = User.query.filter_by(nickname=nickname).first()
+    user = get_user_by_nickname(nickname)
     if user is None:
         flash('User %s not found.' % nickname)
         return redirect(url_for('index'))
@@ -224,6 +265,7 @@ def unfollow(nickname):
 
 @app.route('/search')
 @login_required
+@replica_reads
 def search():
     # 在其他表单中，我们使用validate_on_submit()方法来提交表单
     # 不幸的是，该方法只适用于POST，所以对于这个表单我们需要用form.validate()方式
@@ -231,15 +273,82 @@ def search():
     # 我们只能重定向到首页。
     if not g.search_form.validate():
         return redirect(url_for('index'))
-    page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page, POST_PER_PAGE)
+    # 用游标代替页码翻页，深翻页时ES不用再对前面所有的结果排序，SEARCH_TRACK_TOTAL为False时不统计结果总数
+    q = g.search_form.q.data
+    try:
+        posts = Post.search(q, POST_PER_PAGE, request.args.get('cursor'), app.config['SEARCH_TRACK_TOTAL'])
+    except InvalidCursor:
+        abort(404)
     # 计算下一页的页面URL
-    next_url = url_for('search', q=g.search_form.q.data, page=page+1) \
-        if total > page * POST_PER_PAGE else None
+    next_url = url_for('search', q=q, cursor=posts.next_cursor) if posts.has_next else None
     # 计算上一页的页面URL
-    prev_url = url_for('search', q=g.search_form.q.data, page=page-1) \
-        if page > 1 else None
-    return render_template('search.html', title='Search', posts=posts, next_url=next_url, prev_url=prev_url)
+    prev_url = url_for('search', q=q, cursor=posts.prev_cursor) if posts.has_prev else None
+    return render_template('search.html', title='Search', posts=posts.items, total=posts.total,
+                           next_url=next_url, prev_url=prev_url)
+
+
+# 运行状态的监控接口，给Prometheus抓取
+@app.route('/metrics')
+def metrics():
+    # 请求统计来自app/metrics.py，缓存、outbox、邮件队列等的状态在这里现场收集
+    allowed = app.config['METRICS_ALLOWED_IPS']
+    if allowed is not None and request.remote_addr not in allowed:
+        abort(403)
+    gauges = []
+    for name, stats in [('user', user_cache.stats()), ('search', search_cache_stats()), ('fragment', fragment_cache_stats())]:
+        cache = (('cache', name),)
+        gauges += [
+            ('microblog_cache_hits_total', 'counter', 'Cache hits', cache + (('tier', 'local'),), stats['local_hits']),
+            ('microblog_cache_hits_total', 'counter', 'Cache hits', cache + (('tier', 'shared'),), stats['shared_hits']),
+            ('microblog_cache_misses_total', 'counter', 'Cache misses', cache + (('tier', 'local'),), stats['local_misses']),
+            ('microblog_cache_misses_total', 'counter', 'Cache misses', cache + (('tier', 'shared'),), stats['shared_misses']),
+            ('microblog_cache_hit_ratio', 'gauge', 'Cache hit ratio since start', cache, stats['hit_rate']),
+            ('microblog_cache_entries', 'gauge', 'Entries in the local cache', cache, stats['size']),
+        ]
+    outbox = outbox_stats()
+    # 统计outbox要查询数据库，查完就结束这个只读事务
+    db.session.commit()
+    mail = dispatcher.stats()
+    gauges += [
+        ('microblog_search_outbox_depth', 'gauge', 'Search changes waiting to be indexed', (), outbox['depth']),
+        ('microblog_search_outbox_lag_seconds', 'gauge', 'Age of the oldest unindexed change', (), outbox['lag']),
+        ('microblog_mail_queued', 'gauge', 'Mails waiting in the queue', (), mail['queued']),
+        ('microblog_mail_sent_total', 'counter', 'Mails sent', (), mail['sent']),
+        ('microblog_mail_failed_total', 'counter', 'Mails that failed to send', (), mail['failed']),
+        ('microblog_mail_dropped_total', 'counter', 'Mails dropped because the queue was full', (), mail['dropped']),
+        ('microblog_last_seen_pending', 'gauge', 'last_seen updates waiting to be flushed', (), len(last_seen_buffer.pending)),
+    ]
+    replicas = replica_stats()
+    for name, lag in replicas['lag'].items():
+        # 连不上的副本延迟记为-1
+        gauges.append(('microblog_replica_lag_seconds', 'gauge', 'Replication lag at the last check', (('bind', name),),
+                       -1 if lag is None else lag))
+    for name, count in replicas['routed'].items():
+        gauges.append(('microblog_replica_reads_total', 'counter', 'Read-only queries by the database they were sent to',
+                       (('bind', name or 'primary'),), count))
+    graph = graph_stats()
+    gauges += [
+        ('microblog_graph_users', 'gauge', 'Users in the in-memory follow graph', (), graph['users']),
+        ('microblog_graph_edges', 'gauge', 'Follow edges in the in-memory follow graph', (), graph['edges']),
+        ('microblog_graph_bytes', 'gauge', 'Memory used by the follow graph arrays', (), graph['bytes']),
+        # 还没有加载时记为-1
+        ('microblog_graph_age_seconds', 'gauge', 'Seconds since the follow graph was loaded', (),
+         -1 if graph['age'] is None else graph['age']),
+    ]
+    trending = trending_stats()
+    gauges += [
+        ('microblog_trending_posts_total', 'counter', 'Posts counted for trending terms', (), trending['posts']),
+        ('microblog_trending_bytes', 'gauge', 'Memory used by the trending sketches', (), trending['bytes']),
+    ]
+    logs = logging_stats()
+    gauges += [
+        ('microblog_log_queued', 'gauge', 'Log records waiting for the background writer', (), logs['queued']),
+        ('microblog_log_dropped_total', 'counter', 'Log records dropped because the queue was full', (), logs['dropped']),
+        ('microblog_error_mails_total', 'counter', 'Error mails sent', (), logs['mails']),
+        ('microblog_error_mails_suppressed_total', 'counter', 'Errors folded into a later summary mail', (),
+         logs['suppressed']),
+    ]
+    return Response(registry.render(gauges), mimetype='text/plain; version=0.0.4')
 
 
 # flask为应用程序提供的安装错误页的机制
@@ -0,0 +1,57 @@
+# 生成压测用的模拟数据：用户、关注关系和博客
+# 关注和发博客都服从帕累托分布，少数热门用户有大量粉丝、发大量博客，接近真实的社交网络。
+# 正文从一个按Zipf分布取词的词表生成，搜索压测可以用同一个词表构造查询。
+# 用Core的批量INSERT直接写表，不经过ORM和session的事件，最后统一修正计数器。
+import datetime
+import random
+from app import db
+from app.models import User, Post, followers, repair_counters
+
+SYLLABLES = ['ba', 'ko', 'ri', 'ten', 'sa', 'mu', 'lo', 'vin', 'da', 'pe', 'zu', 'han', 'mi', 'tor', 'gle', 'shi']
+
+
+def vocabulary(size, rnd):
+    words = set()
+    while len(words) < size:
+        words.add(''.join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 3))))
+    return sorted(words)
+
+
+def popular(rnd, n):
+    # 返回1..n之间的一个id，越小的id被选中的概率越大
+    return min(n, int(rnd.paretovariate(1.2)))
+
+
+def populate(n_users, follows, n_posts, seed=0, batch_size=10000):
+    # 重建所有表并填充数据，返回生成正文用的词表
+    rnd = random.Random(seed)
+    words = vocabulary(2000, rnd)
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    conn = db.engine.connect()
+    conn.execute(User.__table__.insert(), [
+        {'id': i, 'nickname': 'user%d' % i, 'email': 'user%d@example.com' % i, 'about_me': 'I am user %d' % i,
+         'timeline_pull': False} for i in range(1, n_users + 1)])
+    # 每个用户都关注自己（注册流程里没有这一步），这样首页时间线里也有自己的博客，压测的数据更接近常见的微博
+    edges = set((i, i) for i in range(1, n_users + 1))
+    for i in range(1, n_users + 1):
+        for _ in range(rnd.randint(0, 2 * follows)):
+            edges.add((i, popular(rnd, n_users)))
+    edges = sorted(edges)
+    for start in range(0, len(edges), batch_size):
+        conn.execute(followers.insert(), [{'follower_id': a, 'followed_id': b} for a, b in edges[start:start + batch_size]])
+    begin = datetime.datetime.utcnow() - datetime.timedelta(seconds=n_posts)
+    batch = []
+    for i in range(1, n_posts + 1):
+        body = ' '.join(words[min(len(words), int(rnd.paretovariate(0.9))) - 1] for _ in range(rnd.randint(3, 20)))
+        batch.append({'id': i, 'body': body[:140], 'user_id': popular(rnd, n_users),
+                      'timestamp': begin + datetime.timedelta(seconds=i)})
+        if len(batch) == batch_size:
+            conn.execute(Post.__table__.insert(), batch)
+            batch = []
+    if batch:
+        conn.execute(Post.__table__.insert(), batch)
+    conn.close()
+    repair_counters()
+    return words
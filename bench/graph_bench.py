@@ -0,0 +1,91 @@
+#!flask/venv/bin/python
+
+# 关注图（app/graph.py）的压测：用随机生成的关注关系构造图，测量构造时间、内存占用和推荐关注的延迟，
+# 加上--db时再测量从当前配置的数据库加载followers表的时间。结果保存成JSON，和上一次的结果对比。
+# 被关注的人按Zipf分布选择，少数用户有大量粉丝，和真实的关注关系接近。
+# 用法: python bench/graph_bench.py --users 100000 --edges 2000000 --queries 1000
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from results import RESULTS_DIR, load_baseline, save_results
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.graph import FollowGraph, load_graph
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--users', type=int, default=100000)
+parser.add_argument('--edges', type=int, default=2000000)
+parser.add_argument('--queries', type=int, default=1000)
+parser.add_argument('--k', type=int, default=5)
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--db', action='store_true', help='also time loading the followers table of the configured database')
+parser.add_argument('--results', default=RESULTS_DIR)
+parser.add_argument('--baseline', help='results file to compare with, default the latest one with the same parameters')
+parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before reporting a regression')
+args = parser.parse_args()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+rng = np.random.RandomState(args.seed)
+src = rng.randint(1, args.users + 1, size=args.edges)
+dst = np.minimum(rng.zipf(1.5, size=args.edges), args.users)
+# Zipf分布的排名打乱后对应到用户id上，热门用户不都是小id
+dst = rng.permutation(args.users)[dst - 1] + 1
+keep = src != dst
+edges = np.unique(np.stack([src[keep], dst[keep]], axis=1), axis=0)
+
+started = time.perf_counter()
+graph = FollowGraph(edges[:, 0], edges[:, 1])
+build = time.perf_counter() - started
+
+latencies = []
+for user_id in rng.randint(1, args.users + 1, size=args.queries):
+    started = time.perf_counter()
+    graph.suggestions(int(user_id), args.k)
+    latencies.append((time.perf_counter() - started) * 1000)
+
+results = {
+    'edges': int(len(edges)),
+    'build_ms': build * 1000,
+    'build_ms_per_million_edges': build * 1000 / len(edges) * 1000000,
+    'bytes_per_edge': graph.nbytes() / float(len(edges)),
+    'megabytes': graph.nbytes() / 1048576.0,
+    'suggestions_p50_ms': percentile(latencies, 0.5),
+    'suggestions_p95_ms': percentile(latencies, 0.95),
+}
+if args.db:
+    started = time.perf_counter()
+    loaded = load_graph()
+    results['db_edges'] = loaded.edges
+    results['db_load_ms'] = (time.perf_counter() - started) * 1000
+
+params = {'users': args.users, 'edges': args.edges, 'queries': args.queries, 'k': args.k, 'seed': args.seed,
+          'db': args.db}
+baseline_path, baseline = load_baseline('graph', params, args.results, args.baseline)
+if baseline:
+    print('Comparing with %s (%s)' % (baseline_path, baseline.get('revision')))
+
+regressions = []
+for name in ('build_ms', 'bytes_per_edge', 'suggestions_p50_ms', 'suggestions_p95_ms', 'db_load_ms'):
+    if name not in results:
+        continue
+    change = ''
+    if baseline and baseline['results'].get(name):
+        old = baseline['results'][name]
+        change = '%+.0f%%' % ((results[name] / old - 1) * 100)
+        if results[name] > old * (1 + args.tolerance):
+            regressions.append('%s %.2f -> %.2f' % (name, old, results[name]))
+    print('%-20s %12.2f %8s' % (name, results[name], change))
+print('%d edges, %.1f MB, %.0f ms per million edges' % (results['edges'], results['megabytes'],
+                                                         results['build_ms_per_million_edges']))
+
+print('Saved %s' % save_results('graph', params, results, args.results))
+for regression in regressions:
+    print('REGRESSION: %s' % regression)
+sys.exit(1 if regressions else 0)
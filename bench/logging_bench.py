@@ -0,0 +1,173 @@
+#!flask/venv/bin/python
+
+# 日志给请求增加的延迟：同样的一串日志（INFO里夹着带异常的ERROR）分别用以前直接挂在logger上的
+# RotatingFileHandler + SMTPHandler，和现在的队列 + 后台线程（app/logs.py）记录，在调用的线程里给每次调用计时。
+# 邮件发到本地一个模拟的SMTP服务器，每个连接先等--smtp-delay秒，模拟网络慢的邮件服务器。
+# 结果保存成JSON，和上一次的结果对比。
+# 用法: python bench/logging_bench.py --records 20000 --error-every 100 --smtp-delay 0.05
+import argparse
+import logging
+import os
+import shutil
+import socketserver
+import smtplib
+import sys
+import tempfile
+import threading
+import time
+from logging.handlers import RotatingFileHandler, SMTPHandler, MemoryHandler
+from email.message import EmailMessage
+from results import RESULTS_DIR, load_baseline, save_results
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import app
+from app.logs import FORMAT, DroppingQueueHandler, ErrorMailHandler, LogPipeline
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--records', type=int, default=20000)
+parser.add_argument('--error-every', type=int, default=100, help='one ERROR with a traceback every this many records')
+parser.add_argument('--smtp-delay', type=float, default=0.05, help='seconds the fake SMTP server waits per connection')
+parser.add_argument('--results', default=RESULTS_DIR)
+parser.add_argument('--baseline', help='results file to compare with, default the latest one with the same parameters')
+parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before reporting a regression')
+args = parser.parse_args()
+
+
+class SlowSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        time.sleep(args.smtp_delay)
+        self.reply('220 localhost')
+        while True:
+            line = self.rfile.readline().decode('utf-8', 'replace').strip()
+            if not line:
+                return
+            command = line.split(' ')[0].upper()
+            if command == 'DATA':
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline().rstrip(b'\r\n') != b'.':
+                    pass
+                self.server.mails += 1
+                self.reply('250 ok')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class SMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    mails = 0
+
+
+server = SMTPServer(('127.0.0.1', 0), SlowSMTPHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+host, port = server.server_address
+
+
+def smtp_send(subject, body):
+    msg = EmailMessage()
+    msg['Subject'] = subject
+    msg['From'] = 'no-reply@localhost'
+    msg['To'] = 'admin@localhost'
+    msg.set_content(body)
+    with smtplib.SMTP(host, port) as smtp:
+        smtp.send_message(msg)
+
+
+def direct_handlers(log_dir):
+    # 改动以前configure_logging挂在app.logger上的两个handler
+    mail_handler = SMTPHandler((host, port), 'no-reply@localhost', ['admin@localhost'], 'microblog failure')
+    mail_handler.setLevel(logging.ERROR)
+    file_handler = RotatingFileHandler(os.path.join(log_dir, 'direct.log'), 'a', 1024 * 1024 * 1024, 10)
+    file_handler.setFormatter(logging.Formatter(FORMAT))
+    file_handler.setLevel(logging.INFO)
+    return [mail_handler, file_handler], None
+
+
+def queued_handlers(log_dir):
+    file_handler = RotatingFileHandler(os.path.join(log_dir, 'queued.log'), 'a', 1024 * 1024 * 1024, 10)
+    file_handler.setFormatter(logging.Formatter(FORMAT))
+    buffered = MemoryHandler(app.config['LOG_BUFFER_RECORDS'], logging.ERROR, file_handler)
+    buffered.setLevel(logging.INFO)
+    mail_handler = ErrorMailHandler(app, app.config['LOG_MAIL_WINDOW'], app.config['LOG_MAIL_RATE'], smtp_send)
+    mail_handler.setFormatter(logging.Formatter(FORMAT))
+    pipeline = LogPipeline(app, [buffered, mail_handler])
+    return [DroppingQueueHandler(pipeline)], pipeline
+
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run(name, make_handlers, log_dir):
+    logger = logging.getLogger('microblog.bench.' + name)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    handlers, pipeline = make_handlers(log_dir)
+    for handler in handlers:
+        logger.addHandler(handler)
+    server.mails = 0
+    latencies = []
+    started = time.perf_counter()
+    for i in range(args.records):
+        if i % args.error_every == args.error_every - 1:
+            try:
+                {}['missing']
+            except KeyError:
+                t = time.perf_counter()
+                logger.exception('Exception on /user/%d [GET]', i)
+        else:
+            t = time.perf_counter()
+            logger.info('GET /user/%d 200', i)
+        latencies.append((time.perf_counter() - t) * 1000000)
+    elapsed = time.perf_counter() - started
+    if pipeline is not None:
+        pipeline.stop()
+    for handler in handlers:
+        handler.close()
+        logger.removeHandler(handler)
+    latencies.sort()
+    return {
+        'mean_us': sum(latencies) / len(latencies),
+        'p50_us': percentile(latencies, 0.5),
+        'p99_us': percentile(latencies, 0.99),
+        'max_us': latencies[-1],
+        'records_per_second': args.records / elapsed,
+        'mails': server.mails,
+        'dropped': pipeline.dropped if pipeline is not None else 0,
+    }
+
+
+log_dir = tempfile.mkdtemp()
+try:
+    results = {'direct': run('direct', direct_handlers, log_dir), 'queued': run('queued', queued_handlers, log_dir)}
+finally:
+    shutil.rmtree(log_dir)
+server.shutdown()
+
+params = {'records': args.records, 'error_every': args.error_every, 'smtp_delay': args.smtp_delay}
+baseline_path, baseline = load_baseline('logging', params, args.results, args.baseline)
+if baseline:
+    print('Comparing with %s (%s)' % (baseline_path, baseline.get('revision')))
+print('%-8s %10s %10s %10s %12s %10s %8s %8s' % ('', 'mean us', 'p50 us', 'p99 us', 'max us', 'records/s', 'mails', 'dropped'))
+for name, result in results.items():
+    print('%-8s %10.1f %10.1f %10.1f %12.1f %10.0f %8d %8d' % (
+        name, result['mean_us'], result['p50_us'], result['p99_us'], result['max_us'], result['records_per_second'],
+        result['mails'], result['dropped']))
+
+regressions = []
+if baseline:
+    old = baseline['results']['queued']
+    for name in ('mean_us', 'p99_us'):
+        if results['queued'][name] > old[name] * (1 + args.tolerance) and results['queued'][name] - old[name] > 5:
+            regressions.append('queued %s %.1f -> %.1f' % (name, old[name], results['queued'][name]))
+
+print('Saved %s' % save_results('logging', params, results, args.results))
+for regression in regressions:
+    print('REGRESSION: %s' % regression)
+sys.exit(1 if regressions else 0)
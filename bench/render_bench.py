@@ -0,0 +1,58 @@
+#!flask/venv/bin/python
+
+# 对比一页博客在有无片段缓存时的模板渲染时间
+# 用法: python bench/render_bench.py --per-page 3,20,50
+import argparse
+import datetime
+import os
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import app, db
+from app.models import User, Post
+from app.fragments import fragment_cache
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--per-page', default='3,20,50', help='posts per page, comma separated')
+parser.add_argument('--authors', type=int, default=10)
+parser.add_argument('--repeat', type=int, default=200)
+parser.add_argument('--db', default='/tmp/microblog_render_bench.db')
+args = parser.parse_args()
+
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + args.db
+# 和首页一样逐条渲染博客片段，不包含base.html，只测量博客列表本身
+page_template = app.jinja_env.from_string('{% for post in posts %}{{ render_post(post) }}{% endfor %}')
+
+db.session.remove()
+db.drop_all()
+db.create_all()
+sizes = [int(s) for s in args.per_page.split(',')]
+authors = [User(nickname='author%d' % i, email='author%d@example.com' % i) for i in range(args.authors)]
+start = datetime.datetime(2019, 1, 1)
+db.session.add_all(authors)
+db.session.add_all([Post(body='post number %d <with> some & text to escape' % i, author=authors[i % args.authors],
+                         timestamp=start + datetime.timedelta(seconds=i)) for i in range(max(sizes))])
+db.session.commit()
+posts = Post.query.options(db.joinedload(Post.author)).order_by(Post.id).all()
+
+
+def measure(page):
+    timings = []
+    with app.test_request_context():
+        page_template.render(posts=page)
+        for _ in range(args.repeat):
+            t = time.perf_counter()
+            page_template.render(posts=page)
+            timings.append(time.perf_counter() - t)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+print('%10s %14s %14s %8s' % ('per page', 'no cache (ms)', 'cached (ms)', 'speedup'))
+for size in sizes:
+    app.config['FRAGMENT_CACHE_ENABLED'] = False
+    plain_ms = measure(posts[:size])
+    app.config['FRAGMENT_CACHE_ENABLED'] = True
+    fragment_cache.local.clear()
+    cached_ms = measure(posts[:size])
+    print('%10d %14.3f %14.3f %7.1fx' % (size, plain_ms, cached_ms, plain_ms / cached_ms))
@@ -0,0 +1,41 @@
+# 压测结果的保存和对比，每次运行保存成bench/results/<种类>-<时间>.json，
+# 默认和参数相同的最近一次结果对比，这样性能退化能在两次运行之间看出来
+import datetime
+import glob
+import json
+import os
+import platform
+import subprocess
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_baseline(kind, params, directory=RESULTS_DIR, path=None):
+    # 返回(路径, 结果)，找不到时返回(None, None)
+    if path is None:
+        for candidate in sorted(glob.glob(os.path.join(directory, '%s-*.json' % kind)), reverse=True):
+            with open(candidate) as f:
+                saved = json.load(f)
+            if saved['params'] == params:
+                return candidate, saved
+        return None, None
+    with open(path) as f:
+        return path, json.load(f)
+
+
+def save_results(kind, params, results, directory=RESULTS_DIR):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, '%s-%s.json' % (kind, datetime.datetime.now().strftime('%Y%m%d-%H%M%S')))
+    with open(path, 'w') as f:
+        json.dump({'params': params, 'revision': git_revision(), 'python': platform.python_version(),
+                   'date': datetime.datetime.utcnow().isoformat(), 'results': results}, f, indent=2)
+    return path
@@ -0,0 +1,97 @@
+#!flask/venv/bin/python
+
+# 对比嵌入式搜索后端和ES的索引吞吐量和查询延迟。索引和查询都走app/search.py：bulk_index批量写入，
+# SearchPagination按游标往后翻--pages页（search_after，ES上用point in time），分别统计第一页和翻页的延迟。
+# 每次查询前清掉本进程的搜索缓存，测的是后端本身，加--cache时保留缓存，看预取和缓存命中后的延迟
+# 用法: python bench/search_bench.py --docs 100000 [--es http://localhost:9200] [--pages 5] [--cache]
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import app, db, search
+from app.search import SearchPagination, bulk_index, close_pit, decode_cursor
+from app.search_engine import EmbeddedSearch
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--docs', type=int, default=100000)
+parser.add_argument('--batch', type=int, default=1000, help='documents per bulk commit')
+parser.add_argument('--queries', type=int, default=500)
+parser.add_argument('--per-page', type=int, default=10)
+parser.add_argument('--pages', type=int, default=5, help='pages followed through next_cursor per query')
+parser.add_argument('--cache', action='store_true', help='keep the search cache between queries')
+parser.add_argument('--es', help='elasticsearch url, skipped when not given or unreachable')
+parser.add_argument('--db', default='sqlite:////tmp/microblog_search_bench.db',
+                    help='database url for the search generation table, it is wiped')
+args = parser.parse_args()
+
+app.config['SQLALCHEMY_DATABASE_URI'] = args.db
+rnd = random.Random(0)
+# 词频按幂律分布，和真实文本接近；一半英文一半中文
+WORDS = ['word%d' % i for i in range(5000)] + [chr(0x4e00 + i) + chr(0x4e00 + i + 7) for i in range(5000)]
+
+
+def sentence():
+    return ' '.join(WORDS[min(len(WORDS) - 1, int(rnd.paretovariate(0.8))) - 1] for _ in range(rnd.randint(5, 30)))
+
+
+docs = [(i, sentence()) for i in range(1, args.docs + 1)]
+queries = [' '.join(rnd.choice(WORDS[:2000]) for _ in range(rnd.randint(1, 3))) for _ in range(args.queries)]
+
+
+def percentile(timings, p):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * p))] * 1000
+
+
+def run(name, refresh=None):
+    started = time.time()
+    for i in range(0, len(docs), args.batch):
+        bulk_index([('index', 'bench', id, {'body': body}) for id, body in docs[i:i + args.batch]])
+    if refresh:
+        refresh()
+    elapsed = time.time() - started
+    first, deeper = [], []
+    for query in queries:
+        cursor = None
+        for number in range(args.pages):
+            if not args.cache:
+                search.search_cache.local.clear()
+            started = time.time()
+            page = SearchPagination('bench', query, args.per_page, cursor, with_total=False)
+            (deeper if number else first).append(time.time() - started)
+            if not page.has_next:
+                break
+            cursor = page.next_cursor
+        else:
+            # 没翻到最后一页就不翻了，point in time要自己关掉
+            close_pit(decode_cursor(page.next_cursor)[3])
+    print('%-10s index %8.0f docs/s   first page p50 %6.2fms  p95 %6.2fms   next pages p50 %6.2fms  p95 %6.2fms' % (
+        name, len(docs) / elapsed, percentile(first, 0.5), percentile(first, 0.95),
+        percentile(deeper or [0], 0.5), percentile(deeper or [0], 0.95)))
+
+
+with app.app_context():
+    db.drop_all()
+    db.create_all()
+    path = tempfile.mkdtemp()
+    try:
+        search.embedded = EmbeddedSearch(path)
+        run('embedded')
+    finally:
+        search.embedded = None
+        shutil.rmtree(path)
+
+    if args.es:
+        from elasticsearch import Elasticsearch
+        es = Elasticsearch(args.es)
+        if not es.ping():
+            print('elasticsearch at %s is unreachable, skipped' % args.es)
+        else:
+            es.indices.delete(index='bench', ignore=[404])
+            search.es = es
+            run('es', lambda: es.indices.refresh(index='bench'))
+            es.indices.delete(index='bench')
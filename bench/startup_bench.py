@@ -0,0 +1,90 @@
+#!flask/venv/bin/python
+
+# 启动时间的压测：每次在一个新的Python进程里导入app、调用configure_app，分别计时，
+# 再用-X importtime找出导入时最慢的模块。结果保存成JSON，和上一次的结果对比。
+# 用法: python bench/startup_bench.py --runs 10
+import argparse
+import json
+import os
+import subprocess
+import sys
+from results import RESULTS_DIR, load_baseline, save_results
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PROBE = '''
+import json, sys, time
+sys.path.insert(0, %r)
+started = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.configure_app()
+created = time.perf_counter()
+from app import search
+print(json.dumps({'import': (imported - started) * 1000, 'configure_app': (created - imported) * 1000,
+                  'es_connected': search.es is not None, 'numpy_imported': 'numpy' in sys.modules}))
+''' % ROOT
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--runs', type=int, default=10)
+parser.add_argument('--top', type=int, default=10, help='slowest modules to list from -X importtime')
+parser.add_argument('--results', default=RESULTS_DIR)
+parser.add_argument('--baseline', help='results file to compare with, default the latest one with the same parameters')
+parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before reporting a regression')
+args = parser.parse_args()
+
+
+def probe(*options):
+    # 每次都是一个新进程，不受当前进程已经导入的模块影响
+    return subprocess.run([sys.executable] + list(options) + ['-c', PROBE], stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, check=True, universal_newlines=True)
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+runs = [json.loads(probe().stdout.splitlines()[-1]) for i in range(args.runs)]
+results = {
+    'import': median([run['import'] for run in runs]),
+    'configure_app': median([run['configure_app'] for run in runs]),
+    'es_connected': any(run['es_connected'] for run in runs),
+    'numpy_imported': any(run['numpy_imported'] for run in runs),
+}
+
+# -X importtime的输出格式: "import time: self [us] | cumulative | imported package"
+modules = []
+for line in probe('-X', 'importtime').stderr.splitlines():
+    if not line.startswith('import time:') or 'cumulative' in line:
+        continue
+    self_us, cumulative, name = line[len('import time:'):].split('|')
+    modules.append((int(self_us), int(cumulative), name.strip()))
+results['slowest_modules'] = [{'module': name, 'self_ms': self_us / 1000.0, 'cumulative_ms': cumulative / 1000.0}
+                              for self_us, cumulative, name in sorted(modules, reverse=True)[:args.top]]
+
+params = {'runs': args.runs, 'python': sys.version.split()[0]}
+baseline_path, baseline = load_baseline('startup', params, args.results, args.baseline)
+if baseline:
+    print('Comparing with %s (%s)' % (baseline_path, baseline.get('revision')))
+
+regressions = []
+for name in ('import', 'configure_app'):
+    change = ''
+    # create_app改名为configure_app之前的结果里没有这一项
+    if baseline and name in baseline['results']:
+        old = baseline['results'][name]
+        change = '%+.0f%%' % ((results[name] / old - 1) * 100) if old else ''
+        if results[name] > old * (1 + args.tolerance) and results[name] - old > 5:
+            regressions.append('%s %.1fms -> %.1fms' % (name, old, results[name]))
+    print('%-14s %8.1f ms %8s' % (name, results[name], change))
+if results['es_connected']:
+    regressions.append('configure_app connected to Elasticsearch')
+print('numpy imported: %s' % ('yes' if results['numpy_imported'] else 'no'))
+print('Slowest modules (self time):')
+for module in results['slowest_modules']:
+    print('  %-50s %8.1f ms %8.1f ms' % (module['module'], module['self_ms'], module['cumulative_ms']))
+
+print('Saved %s' % save_results('startup', params, results, args.results))
+for regression in regressions:
+    print('REGRESSION: %s' % regression)
+sys.exit(1 if regressions else 0)
@@ -0,0 +1,79 @@
+#!flask/venv/bin/python
+
+# 对比首页的两种读取方式：原来的followed_posts() join查询，和写扩散后的物化时间线
+# 用法: python bench/timeline_bench.py --sizes 10000,100000,1000000
+import argparse
+import datetime
+import os
+import random
+import sys
+import time
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import app, db
+from app.models import User, followers
+from app.timeline import home_timeline, rebuild
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--sizes', default='10000,100000,1000000', help='post counts to benchmark, comma separated')
+parser.add_argument('--follows', type=int, default=50, help='followed users per user')
+parser.add_argument('--viewers', type=int, default=20, help='users whose home page is measured')
+parser.add_argument('--repeat', type=int, default=5)
+parser.add_argument('--db', default='/tmp/microblog_timeline_bench.db')
+args = parser.parse_args()
+
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + args.db
+app.config['TIMELINE_ENABLED'] = True
+per_page = app.config['POST_PER_PAGE']
+
+
+def populate(n_posts):
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+    rnd = random.Random(n_posts)
+    n_users = max(1000, n_posts // 50)
+    conn = db.engine.connect()
+    conn.execute(User.__table__.insert(), [
+        {'id': i, 'nickname': 'user%d' % i, 'email': 'user%d@example.com' % i, 'timeline_pull': False}
+        for i in range(1, n_users + 1)])
+    # 关注和发博客都偏向少数热门用户，接近真实的社交网络
+    edges = set()
+    for i in range(1, n_users + 1):
+        for _ in range(args.follows):
+            edges.add((i, min(n_users, int(rnd.paretovariate(1.2)))))
+    conn.execute(followers.insert(), [{'follower_id': a, 'followed_id': b} for a, b in edges])
+    start = datetime.datetime(2019, 1, 1)
+    batch = []
+    for i in range(1, n_posts + 1):
+        batch.append({'id': i, 'body': 'post %d' % i, 'user_id': min(n_users, int(rnd.paretovariate(1.2))),
+                      'timestamp': start + datetime.timedelta(seconds=i)})
+        if len(batch) == 10000:
+            conn.execute(db.metadata.tables['post'].insert(), batch)
+            batch = []
+    if batch:
+        conn.execute(db.metadata.tables['post'].insert(), batch)
+    conn.close()
+    return rnd.sample(range(1, n_users + 1), args.viewers)
+
+
+def measure(query_for, viewers):
+    timings = []
+    for _ in range(args.repeat):
+        for user in viewers:
+            t = time.perf_counter()
+            query_for(user).limit(per_page).all()
+            timings.append(time.perf_counter() - t)
+    timings.sort()
+    return timings[len(timings) // 2] * 1000
+
+
+print('%10s %14s %14s %8s' % ('posts', 'join (ms)', 'timeline (ms)', 'speedup'))
+for size in [int(s) for s in args.sizes.split(',')]:
+    viewer_ids = populate(size)
+    for user_id in viewer_ids:
+        rebuild(db.session.connection(), user_id)
+    db.session.commit()
+    viewers = User.query.filter(User.id.in_(viewer_ids)).all()
+    join_ms = measure(lambda u: u.followed_posts(), viewers)
+    timeline_ms = measure(lambda u: home_timeline(u, per_page), viewers)
+    print('%10d %14.3f %14.3f %7.1fx' % (size, join_ms, timeline_ms, join_ms / timeline_ms))
@@ -0,0 +1,105 @@
+#!flask/venv/bin/python
+
+# 热门话题（app/trending.py）的压测：生成一串按时间排列的博客，词按Zipf分布选择，
+# 分别喂给count-min sketch和精确的计数，比较窗口结束时的top-k、估计误差和内存，以及每秒能处理多少条博客。
+# 每个--widths都单独跑一遍，看sketch宽度和误差、内存的关系。结果保存成JSON，和上一次的结果对比。
+# 用法: python bench/trending_bench.py --posts 200000 --vocabulary 50000 --widths 4096,16384,65536
+import argparse
+import datetime
+import os
+import sys
+import time
+import numpy as np
+from collections import Counter
+from results import RESULTS_DIR, load_baseline, save_results
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app.trending import TrendingTerms
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--posts', type=int, default=200000)
+parser.add_argument('--vocabulary', type=int, default=50000)
+parser.add_argument('--terms', type=int, default=8, help='terms per post')
+parser.add_argument('--window', type=int, default=3600)
+parser.add_argument('--buckets', type=int, default=12)
+parser.add_argument('--span', type=int, default=7200, help='seconds covered by the generated posts')
+parser.add_argument('--widths', default='4096,16384,65536')
+parser.add_argument('--depth', type=int, default=4)
+parser.add_argument('--top', type=int, default=10)
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--results', default=RESULTS_DIR)
+parser.add_argument('--baseline', help='results file to compare with, default the latest one with the same parameters')
+parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before reporting a regression')
+args = parser.parse_args()
+
+rng = np.random.RandomState(args.seed)
+words = np.minimum(rng.zipf(1.3, size=(args.posts, args.terms)), args.vocabulary)
+start = datetime.datetime(2019, 10, 1)
+offsets = np.sort(rng.randint(0, args.span, size=args.posts))
+posts = [(sorted(set('w%d' % w for w in row)), start + datetime.timedelta(seconds=int(offset)))
+         for row, offset in zip(words, offsets)]
+end = start + datetime.timedelta(seconds=args.span)
+
+# 窗口结束时精确的计数，和TrendingTerms一样按桶对齐窗口的起点
+bucket_seconds = args.window // args.buckets
+end_epoch = (end - datetime.datetime(1970, 1, 1)).total_seconds()
+first_bucket = int(end_epoch // bucket_seconds) - args.buckets + 1
+cutoff = datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=first_bucket * bucket_seconds)
+exact = Counter(term for terms, timestamp in posts if timestamp >= cutoff for term in terms)
+exact_top = [term for term, count in sorted(exact.items(), key=lambda item: (-item[1], item[0]))[:args.top]]
+# 精确计数的内存：dict本身加上键（词的字符串）和值（int）
+exact_bytes = sys.getsizeof(exact) + sum(sys.getsizeof(term) + sys.getsizeof(count) for term, count in exact.items())
+
+results = {'exact_terms': len(exact), 'exact_bytes': exact_bytes}
+print('%d posts, %d distinct terms in the window, exact counts %.1f MB' % (args.posts, len(exact), exact_bytes / 1048576.0))
+print('%8s %10s %10s %10s %12s %12s %10s' % ('width', 'MB', 'posts/s', 'recall', 'top-k err', 'mean err', 'p99 err'))
+for width in [int(w) for w in args.widths.split(',')]:
+    stats = TrendingTerms(args.window, args.buckets, width, args.depth, args.top)
+    started = time.perf_counter()
+    for terms, timestamp in posts:
+        stats.add(terms, timestamp)
+    elapsed = time.perf_counter() - started
+    top = stats.top(args.top, now=end_epoch)
+    # 窗口内每个词的多估量（估计值减去精确值）
+    terms = sorted(exact)
+    estimates = stats.window.estimate(stats.window.columns(terms))
+    errors = np.array([int(estimate) - exact[term] for term, estimate in zip(terms, estimates)])
+    top_errors = [abs(count - exact[term]) / float(exact[term]) for term, count in top]
+    result = {
+        'megabytes': stats.nbytes() / 1048576.0,
+        'posts_per_second': args.posts / elapsed,
+        'top_k_recall': len(set(term for term, count in top) & set(exact_top)) / float(len(exact_top)),
+        'top_k_relative_error': max(top_errors) if top_errors else 0.0,
+        'mean_overestimate': float(errors.mean()),
+        'p99_overestimate': float(np.percentile(errors, 99)),
+        'min_error': int(errors.min()),
+    }
+    results['width_%d' % width] = result
+    print('%8d %10.2f %10.0f %10.2f %12.4f %12.2f %10.1f' % (
+        width, result['megabytes'], result['posts_per_second'], result['top_k_recall'],
+        result['top_k_relative_error'], result['mean_overestimate'], result['p99_overestimate']))
+
+params = {'posts': args.posts, 'vocabulary': args.vocabulary, 'terms': args.terms, 'window': args.window,
+          'buckets': args.buckets, 'span': args.span, 'widths': args.widths, 'depth': args.depth, 'top': args.top,
+          'seed': args.seed}
+baseline_path, baseline = load_baseline('trending', params, args.results, args.baseline)
+regressions = []
+if baseline:
+    print('Comparing with %s (%s)' % (baseline_path, baseline.get('revision')))
+    for name, result in results.items():
+        old = baseline['results'].get(name)
+        if not isinstance(result, dict) or not old:
+            continue
+        if result['posts_per_second'] < old['posts_per_second'] / (1 + args.tolerance):
+            regressions.append('%s %.0f -> %.0f posts/s' % (name, old['posts_per_second'], result['posts_per_second']))
+        if result['top_k_recall'] < old['top_k_recall']:
+            regressions.append('%s top-k recall %.2f -> %.2f' % (name, old['top_k_recall'], result['top_k_recall']))
+for name, result in results.items():
+    # count-min sketch不会少估，出现了就是实现有问题
+    if isinstance(result, dict) and result['min_error'] < 0:
+        regressions.append('%s underestimated a term' % name)
+
+print('Saved %s' % save_results('trending', params, results, args.results))
+for regression in regressions:
+    print('REGRESSION: %s' % regression)
+sys.exit(1 if regressions else 0)
@@ -0,0 +1,20 @@
+#!flask/venv/bin/python
+
+# 部署后执行一次的初始化：建好数据库表、日志目录，在ES里创建还不存在的索引
+# 以前这些都在导入app时做，ES连不上的话web进程直接启动失败
+# 用法: python bootstrap.py
+import os
+from app import app, db, configure_app
+from app.search import ensure_index, client
+from config import basedir
+
+configure_app()
+os.makedirs(os.path.join(basedir, 'tmp'), exist_ok=True)
+db.create_all()
+print('Database tables are ready')
+if client() is None:
+    print('Elasticsearch is not configured, skipped index setup')
+elif ensure_index(app.config['POSTS_FULL_TEXT'], app.config['MAPPING']):
+    print('Created index %s' % app.config['POSTS_FULL_TEXT'])
+else:
+    print('Index %s already exists' % app.config['POSTS_FULL_TEXT'])
@@ -0,0 +1,25 @@
+#!flask/venv/bin/python
+
+# 批量导入用户
+# 用法: python import_users.py users.csv [--batch 1000]
+# CSV要有表头，JSON可以是一个数组，也可以每行一个对象。每个用户必须有email，
+# nickname、about_me、password（或者已经算好的password_hash）可选，nickname重复时自动加上数字后缀。
+import argparse
+import sys
+from app import app
+from app.accounts import read_rows, import_accounts
+
+parser = argparse.ArgumentParser()
+parser.add_argument('path', help='.csv, .json or .jsonl file')
+parser.add_argument('--batch', type=int, default=app.config['USER_IMPORT_BATCH'], help='users per INSERT')
+args = parser.parse_args()
+
+
+def report(imported, skipped):
+    sys.stdout.write('\r%d users imported, %d skipped' % (imported, skipped))
+    sys.stdout.flush()
+
+
+imported, skipped = import_accounts(read_rows(args.path), args.batch, report)
+print('')
+print('Imported %d users, skipped %d with a missing or existing email' % (imported, skipped))
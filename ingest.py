@@ -0,0 +1,66 @@
+#!flask/venv/bin/python
+
+# 从文件批量导入博客和关注关系，用于从旧平台迁移数据
+# 用法: python ingest.py --follows follows.csv --posts posts.jsonl [--batch 5000] [--no-index]
+# 博客的列: author（nickname）或author_id, body, timestamp（ISO 8601，可选）
+# 关注关系的列: follower/followed（nickname）或follower_id/followed_id
+# 文件格式和import_users.py一样，CSV要有表头，大文件请用CSV或JSON Lines，这样内存占用不随文件大小增长。
+# 导入时不触发搜索索引，全部写完后对新的博客做一次批量索引；打开了TIMELINE_ENABLED的话，导入后执行timeline_rebuild.py。
+import argparse
+import sys
+import time
+from app import app, db
+from app.models import Post
+from app.accounts import read_rows
+from app.ingest import ingest
+from app.indexer import reindex
+from app.search import search_enabled, bump_generation, bump_stored_generation
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--posts', help='file with posts')
+parser.add_argument('--follows', help='file with follower edges')
+parser.add_argument('--batch', type=int, default=app.config['INGEST_BATCH'], help='rows per COPY/INSERT')
+parser.add_argument('--no-index', action='store_true', help='skip indexing the new posts, run reindex.py later')
+parser.add_argument('--chunk', type=int, default=1000, help='documents per bulk request when indexing')
+parser.add_argument('--workers', type=int, default=4, help='parallel bulk requests when indexing')
+args = parser.parse_args()
+if not args.posts and not args.follows:
+    parser.error('nothing to ingest, pass --posts and/or --follows')
+
+
+def report(written, skipped, rate):
+    sys.stdout.write('\r%d rows written, %d skipped, %.0f rows/s' % (written, skipped, rate))
+    sys.stdout.flush()
+
+
+def index_report(done, total, rate):
+    sys.stdout.write('\r%d/%d posts indexed, %.0f docs/s' % (done, total, rate))
+    sys.stdout.flush()
+
+
+# 关注关系先导入，博客导入后的计数器和时间线重建都能用上完整的关注图
+last_id = db.session.query(db.func.max(Post.id)).scalar() or 0
+db.session.commit()
+for kind, path in (('follows', args.follows), ('posts', args.posts)):
+    if not path:
+        continue
+    print('Ingesting %s from %s' % (kind, path))
+    started = time.time()
+    written, skipped = ingest(kind, read_rows(path), args.batch, report)
+    elapsed = time.time() - started
+    print('')
+    print('%d %s written, %d skipped in %.1fs (%.0f rows/s)' % (written, kind, skipped, elapsed,
+                                                               (written + skipped) / elapsed if elapsed else 0.0))
+
+if args.posts and not args.no_index and search_enabled():
+    index = app.config['POSTS_FULL_TEXT']
+    print('Indexing posts after id %d into %s' % (last_id, index))
+    done, last_id = reindex(Post, index, args.chunk, args.workers, None, last_id, index_report)
+    # 和indexer.drain()一样，数据库里的代数给没有共享缓存层的web进程看，共享层里的直接换掉
+    bump_stored_generation(db.session.connection(), [index])
+    db.session.commit()
+    bump_generation(index)
+    print('')
+    print('Indexed %d posts' % done)
+if app.config.get('TIMELINE_ENABLED'):
+    print('TIMELINE_ENABLED is on: run timeline_rebuild.py to add the ingested posts and follows to home timelines')
@@ -0,0 +1,69 @@
+#!flask/venv/bin/python
+
+# 全量重建ES索引
+# 用法: python reindex.py --index post --workers 4 --chunk 1000 [--swap] [--restart]
+# 中途中断的话，再执行一次同样的命令就会从检查点继续。
+# --swap先把数据写进一个新的索引，完成后再把别名原子地切换过去，重建期间搜索不受影响。
+# 重建期间的修改由search_worker.py写进旧的索引，outbox记录留着，切换别名之前重放进新的索引。
+import argparse
+import os
+import sys
+import time
+from app import app
+from app.models import searchable_models
+from app.search import create_index, swap_alias, embedded
+from app.indexer import reindex, load_checkpoint, start_rebuild, replay, finish_rebuild
+from config import basedir
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--index', default=app.config['POSTS_FULL_TEXT'], help='index (table) to rebuild')
+parser.add_argument('--chunk', type=int, default=1000, help='rows per bulk request')
+parser.add_argument('--workers', type=int, default=4, help='parallel bulk requests')
+parser.add_argument('--checkpoint', help='checkpoint file, default tmp/reindex_<index>.json')
+parser.add_argument('--swap', action='store_true', help='build into a new index and swap the alias when finished')
+parser.add_argument('--restart', action='store_true', help='ignore an existing checkpoint')
+args = parser.parse_args()
+if args.swap and embedded:
+    parser.error('--swap needs the elasticsearch backend, the embedded index commits every batch atomically')
+
+model = searchable_models()[args.index]
+checkpoint = args.checkpoint or os.path.join(basedir, 'tmp', 'reindex_%s.json' % args.index)
+state = None if args.restart else load_checkpoint(checkpoint)
+if args.restart:
+    # 放弃以前没完成的重建，留着重放的记录也不要了
+    finish_rebuild(args.index)
+if state:
+    target, after_id = state['index'], state['last_id']
+    print('Resuming %s into %s after id %d' % (args.index, target, after_id))
+else:
+    target, after_id = args.index, 0
+    if args.swap:
+        target = '%s_%s' % (args.index, time.strftime('%Y%m%d%H%M%S'))
+        create_index(target, app.config['MAPPING'])
+        print('Building %s into new index %s' % (args.index, target))
+if target != args.index:
+    # 在读取数据之前记下outbox的位置，之后的修改都会被重放
+    mark = start_rebuild(args.index, target)
+
+
+def report(done, total, rate):
+    sys.stdout.write('\r%d/%d documents, %.0f docs/s' % (done, total, rate))
+    sys.stdout.flush()
+
+
+started = time.time()
+done, last_id = reindex(model, target, args.chunk, args.workers, checkpoint, after_id, report)
+print('')
+if target != args.index:
+    # 重建期间的修改（包括新增的博客）被search_worker.py写进了旧的索引，切换别名之前重放进新的索引
+    extra, mark = replay(args.index, target, mark)
+    swap_alias(args.index, target)
+    # 重放之后、切换之前同步的修改再补一次，切换以后search_worker.py直接写进新的索引
+    late, mark = replay(args.index, target, mark)
+    finish_rebuild(args.index)
+    print('Replayed %d changes made during the rebuild' % (extra + late))
+    print('Alias %s now points to %s' % (args.index, target))
+if os.path.exists(checkpoint):
+    os.remove(checkpoint)
+elapsed = time.time() - started
+print('Indexed %d documents in %.1fs (%.0f docs/s)' % (done, elapsed, done / elapsed if elapsed else 0.0))
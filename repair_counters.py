@@ -0,0 +1,6 @@
+#!flask/venv/bin/python
+
+from app.models import repair_counters
+
+# 从followers和post表重新统计每个用户的粉丝数、关注数和博客数，修正冗余计数器的偏差
+print('Repaired counters for %d users' % repair_counters())
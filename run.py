@@ -1,3 +1,4 @@
-from app import app
+from app import configure_app
 
+app = configure_app()
 app.run(debug=True, host='0.0.0.0')
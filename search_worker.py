@@ -0,0 +1,18 @@
+#!flask/venv/bin/python
+
+import time
+from app import configure_app
+from app.indexer import drain, outbox_stats
+
+# 后台同步ES的worker，不停地把search_outbox表中的修改批量写入ES
+# 可以同时运行多个，PostgreSQL下它们不会处理同一批记录
+app = configure_app()
+last_report = 0
+while True:
+    done = drain()
+    if time.time() - last_report >= 60:
+        stats = outbox_stats()
+        app.logger.info('search outbox depth=%d lag=%.1fs', stats['depth'], stats['lag'])
+        last_report = time.time()
+    if done == 0:
+        time.sleep(app.config['SEARCH_OUTBOX_POLL'])
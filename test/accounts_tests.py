@@ -0,0 +1,83 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db
+from app.models import User
+from app.accounts import read_rows, import_accounts
+import json
+import os
+import shutil
+import tempfile
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+        db.session.add(User(nickname='john', email='john@example.com'))
+        db.session.commit()
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        return path
+
+    def test_read_formats(self):
+        expected = [{'email': 'a@example.com', 'nickname': 'a'}, {'email': 'b@example.com', 'nickname': 'b'}]
+        csv_path = self.write('users.csv', 'email,nickname\na@example.com,a\nb@example.com,b\n')
+        json_path = self.write('users.json', json.dumps(expected))
+        lines_path = self.write('users.jsonl', '\n'.join(json.dumps(row) for row in expected) + '\n\n')
+        for path in (csv_path, json_path, lines_path):
+            assert [dict(row) for row in read_rows(path)] == expected
+
+    def test_import(self):
+        rows = [
+            {'email': 'john@example.com', 'nickname': 'john'},
+            {'email': 'john@example.org', 'nickname': 'john'},
+            {'email': 'john@example.net', 'nickname': 'john', 'about_me': 'third john'},
+            {'email': 'john@example.org', 'nickname': 'john'},
+            {'email': 'susan@example.com'},
+            {'email': '', 'nickname': 'nobody'},
+            {'email': 'bob@example.com', 'nickname': 'bob', 'password': 'secret'},
+        ]
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            reports = []
+            imported, skipped = import_accounts(rows, 3, lambda *counts: reports.append(counts))
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        assert (imported, skipped) == (4, 3)
+        assert reports == [(2, 1), (3, 3), (4, 3)]
+        # 每批：查email、分配nickname、INSERT各一条
+        assert len([s for s in statements if s.lstrip().upper().startswith(('SELECT', 'INSERT'))]) == 9
+        users = dict((user.email, user) for user in User.query)
+        assert users['john@example.org'].nickname == 'john2'
+        assert users['john@example.net'].nickname == 'john3'
+        assert users['john@example.net'].about_me == 'third john'
+        assert users['susan@example.com'].nickname == 'susan'
+        assert users['bob@example.com'].check_password('secret')
+        assert users['susan@example.com'].follower_count == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db
+from app.models import User, Post
+from app.last_seen import last_seen_buffer
+import datetime
+import json
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+        john = User(nickname='john', email='john@example.com')
+        susan = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        john.follow(susan)
+        start = datetime.datetime(2019, 10, 1)
+        for i in range(7):
+            db.session.add(Post(body='post %d' % i, author=susan, timestamp=start + datetime.timedelta(minutes=i)))
+        db.session.commit()
+        with self.app.session_transaction() as session:
+            session['user_id'] = str(john.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        app.config['API_EXPORT_CHUNK'] = 1000
+        last_seen_buffer.flush()
+        db.session.remove()
+        db.drop_all()
+
+    def get_json(self, url):
+        rv = self.app.get(url)
+        assert rv.status_code == 200, rv.status_code
+        return json.loads(rv.data.decode('utf-8'))
+
+    def test_timeline_paging(self):
+        data = self.get_json('/api/timeline?limit=3')
+        assert [p['body'] for p in data['posts']] == ['post 6', 'post 5', 'post 4']
+        assert data['posts'][0]['author']['nickname'] == 'susan'
+        assert data['posts'][0]['timestamp'] == '2019-10-01T00:06:00Z'
+        assert data['prev'] is None
+        bodies = [p['body'] for p in data['posts']]
+        while data['next']:
+            data = self.get_json(data['next'])
+            bodies += [p['body'] for p in data['posts']]
+        assert bodies == ['post %d' % i for i in range(6, -1, -1)]
+        # 往回翻
+        data = self.get_json(data['prev'])
+        assert [p['body'] for p in data['posts']] == ['post 3', 'post 2', 'post 1']
+
+    def test_user_posts(self):
+        data = self.get_json('/api/users/susan/posts?limit=5')
+        assert len(data['posts']) == 5
+        assert '/api/users/susan/posts' in data['next']
+        assert self.get_json('/api/users/john/posts')['posts'] == []
+        assert self.app.get('/api/users/nobody/posts').status_code == 404
+        assert self.app.get('/api/users/susan/posts?before=garbage').status_code == 400
+
+    def test_export(self):
+        app.config['API_EXPORT_CHUNK'] = 2
+        rv = self.app.get('/api/users/susan/posts/export')
+        assert rv.mimetype == 'application/x-ndjson'
+        lines = rv.data.decode('utf-8').splitlines()
+        assert [json.loads(line)['body'] for line in lines] == ['post %d' % i for i in range(6, -1, -1)]
+        # 响应是按块生成的，每块API_EXPORT_CHUNK行
+        rv = self.app.get('/api/users/susan/posts/export')
+        chunks = list(rv.response)
+        assert [chunk.count(b'\n') for chunk in chunks] == [2, 2, 2, 1]
+
+    def test_export_resume(self):
+        app.config['API_EXPORT_CHUNK'] = 2
+        rv = self.app.get('/api/users/susan/posts/export')
+        # 只收到了前3行就断开了，用最后一行的cursor接着导出
+        lines = [json.loads(line) for line in rv.data.decode('utf-8').splitlines()[:3]]
+        rv = self.app.get('/api/users/susan/posts/export?before=' + lines[-1]['cursor'])
+        assert rv.status_code == 200
+        lines += [json.loads(line) for line in rv.data.decode('utf-8').splitlines()]
+        assert [line['body'] for line in lines] == ['post %d' % i for i in range(6, -1, -1)]
+        # 导出的cursor也能用来翻页
+        data = self.get_json('/api/users/susan/posts?limit=2&before=' + lines[1]['cursor'])
+        assert [p['body'] for p in data['posts']] == ['post 4', 'post 3']
+        assert self.app.get('/api/users/susan/posts/export?before=garbage').status_code == 400
+
+    def test_export_without_timestamp(self):
+        susan = User.query.filter_by(nickname='susan').first()
+        db.session.add(Post(body='no time', author=susan, timestamp=None))
+        db.session.commit()
+        rv = self.app.get('/api/users/susan/posts/export')
+        lines = [json.loads(line) for line in rv.data.decode('utf-8').splitlines()]
+        assert sorted(line['body'] for line in lines) == sorted(['no time'] + ['post %d' % i for i in range(7)])
+        for line in lines:
+            assert (line['cursor'] is None) == (line['body'] == 'no time')
+
+    def test_login_required(self):
+        self.app.get('/logout')
+        # API返回JSON的401，网页仍然重定向到登录页
+        rv = self.app.get('/api/timeline')
+        assert rv.status_code == 401
+        assert json.loads(rv.data.decode('utf-8')) == {'error': 'login required'}
+        assert self.app.get('/api/users/susan/posts/export').status_code == 401
+        rv = self.app.get('/index')
+        assert rv.status_code == 302
+        assert '/login?next=' in rv.headers['Location']
+
+
+if __name__ == '__main__':
+    unittest.main()
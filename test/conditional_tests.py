@@ -0,0 +1,113 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db
+from app.models import User, Post
+from app.last_seen import last_seen_buffer
+from app.graph import refresh_graph
+from app.trending import refresh_trending
+import datetime
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+        john = User(nickname='john', email='john@example.com')
+        susan = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        john.follow(john)
+        john.follow(susan)
+        db.session.add(Post(body='hello', author=susan, timestamp=datetime.datetime(2019, 10, 1)))
+        db.session.commit()
+        self.john_id, self.susan_id = john.id, susan.id
+        # 关注图和热门话题在后台加载，加载完成时页面的ETag会变，先加载好
+        refresh_graph()
+        refresh_trending()
+        with self.app.session_transaction() as session:
+            session['user_id'] = str(john.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        app.config['WTF_CSRF_ENABLED'] = False
+        last_seen_buffer.flush()
+        db.session.remove()
+        db.drop_all()
+
+    def revalidate(self, url, etag):
+        return self.app.get(url, headers={'If-None-Match': etag})
+
+    def add_post(self, user_id, body):
+        db.session.add(Post(body=body, user_id=user_id, timestamp=datetime.datetime.utcnow()))
+        db.session.commit()
+
+    def test_index_not_modified(self):
+        rv = self.app.get('/index')
+        etag = rv.headers['ETag']
+        assert rv.status_code == 200
+        assert rv.headers['Last-Modified'] == 'Tue, 01 Oct 2019 00:00:00 GMT'
+        assert 'no-cache' in rv.headers['Cache-Control'] and 'private' in rv.headers['Cache-Control']
+        rv = self.revalidate('/index', etag)
+        assert rv.status_code == 304
+        assert rv.data == b''
+        # 关注的人发了新博客，页面要重新渲染
+        self.add_post(self.susan_id, 'new')
+        rv = self.revalidate('/index', etag)
+        assert rv.status_code == 200
+        assert b'new' in rv.data
+        assert rv.headers['ETag'] != etag
+
+    def test_if_modified_since(self):
+        rv = self.app.get('/index', headers={'If-Modified-Since': 'Tue, 01 Oct 2019 00:00:00 GMT'})
+        assert rv.status_code == 304
+        rv = self.app.get('/index', headers={'If-Modified-Since': 'Mon, 30 Sep 2019 00:00:00 GMT'})
+        assert rv.status_code == 200
+
+    def test_follow_changes_etag(self):
+        etag = self.app.get('/user/susan').headers['ETag']
+        assert self.revalidate('/user/susan', etag).status_code == 304
+        index_etag = self.app.get('/index').headers['ETag']
+        # 取消关注后会显示flash消息，这个响应不能带ETag，也不能返回304
+        rv = self.app.get('/unfollow/susan', follow_redirects=True)
+        assert b'You have stopped following susan' in rv.data
+        assert 'ETag' not in rv.headers
+        rv = self.revalidate('/user/susan', etag)
+        assert rv.status_code == 200
+        assert b'Follow' in rv.data
+        assert self.revalidate('/index', index_etag).status_code == 200
+
+    def test_profile_change(self):
+        etag = self.app.get('/user/john').headers['ETag']
+        john = User.query.get(self.john_id)
+        john.about_me = 'something new'
+        db.session.commit()
+        rv = self.revalidate('/user/john', etag)
+        assert rv.status_code == 200
+        assert b'something new' in rv.data
+
+    def test_csrf_token(self):
+        app.config['WTF_CSRF_ENABLED'] = True
+        rv = self.app.get('/index')
+        etag = rv.headers['ETag']
+        assert b'csrf_token' in rv.data
+        assert self.revalidate('/index', etag).status_code == 304
+        # 换了一个CSRF token，缓存的页面里的token已经不能用了
+        with self.app.session_transaction() as session:
+            session.pop('csrf_token')
+        rv = self.revalidate('/index', etag)
+        assert rv.status_code == 200
+        assert rv.headers['ETag'] != etag
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db
+from app.models import User, Post, repair_counters
+import datetime
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def counts(self, user):
+        return (user.follower_count, user.followed_count, user.post_count)
+
+    def test_follow_and_post_counters(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        u3 = User(nickname='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        # 同一次提交里的多次关注会合并成一次更新
+        u1.followed.append(u2)
+        u1.followed.append(u3)
+        u3.followed.append(u2)
+        db.session.commit()
+        assert self.counts(u1) == (0, 2, 0)
+        assert self.counts(u2) == (2, 0, 0)
+        assert self.counts(u3) == (1, 1, 0)
+        p1 = Post(body='one', author=u2, timestamp=datetime.datetime.utcnow())
+        p2 = Post(body='two', author=u2, timestamp=datetime.datetime.utcnow())
+        db.session.add_all([p1, p2])
+        db.session.commit()
+        assert u2.post_count == 2
+        db.session.delete(p1)
+        u1.unfollow(u2)
+        db.session.commit()
+        assert self.counts(u1) == (0, 1, 0)
+        assert self.counts(u2) == (1, 0, 1)
+        assert u2.follower_count == u2.followers.count()
+        assert u2.post_count == u2.posts.count()
+
+    def test_rollback_discards_counters(self):
+        u1 = User(nickname='john', email='john@example.com')
+        u2 = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([u1, u2])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.rollback()
+        u1.follow(u2)
+        db.session.commit()
+        assert u2.follower_count == 1
+
+    def test_repair(self):
+        u1 = User(nickname='john', email='john@example.com')
+        db.session.add(u1)
+        db.session.commit()
+        db.session.add(Post(body='one', author=u1))
+        db.session.commit()
+        db.session.execute(User.__table__.update().values(post_count=7, follower_count=3))
+        db.session.commit()
+        assert repair_counters() == 1
+        db.session.expire_all()
+        assert self.counts(u1) == (0, 0, 1)
+        assert repair_counters() == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db
+from app.models import User, Post
+from app.fragments import fragment_cache, render_post
+from markupsafe import escape
+import datetime
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+        fragment_cache.local.clear()
+        self.u = User(nickname='john', email='john@example.com')
+        self.p = Post(body='<b>hello</b>', author=self.u, timestamp=datetime.datetime.utcnow())
+        db.session.add(self.u)
+        db.session.add(self.p)
+        db.session.commit()
+
+    def tearDown(self):
+        app.config['FRAGMENT_CACHE_ENABLED'] = True
+        db.session.remove()
+        db.drop_all()
+        fragment_cache.local.clear()
+
+    def test_cached_fragment(self):
+        with app.test_request_context():
+            html = render_post(self.p)
+            hits = fragment_cache.local.hits
+            assert render_post(self.p) == html
+            assert fragment_cache.local.hits == hits + 1
+        # 正文要转义，头像和nickname都在片段里
+        assert '&lt;b&gt;hello&lt;/b&gt;' in html
+        assert 'john says:' in html
+        assert escape(self.u.avatar(50)) in html
+
+    def test_author_change(self):
+        with app.test_request_context():
+            render_post(self.p)
+            self.u.nickname = 'johnny'
+            db.session.commit()
+            # 作者改了nickname，片段的版本变了，不会读到旧的内容
+            assert 'johnny says:' in render_post(self.p)
+            self.u.email = 'johnny@example.com'
+            db.session.commit()
+            assert escape(self.u.avatar(50)) in render_post(self.p)
+
+    def test_disabled(self):
+        app.config['FRAGMENT_CACHE_ENABLED'] = False
+        with app.test_request_context():
+            html = render_post(self.p)
+            assert render_post(self.p) == html
+        assert fragment_cache.stats()['size'] == 0
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,208 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db, graph
+from app.graph import FollowGraph, gather, load_graph, refresh_graph, who_to_follow
+from app.models import User
+from app.last_seen import last_seen_buffer
+import numpy as np
+import threading
+import time
+
+
+class GraphTestCase(unittest.TestCase):
+    # 不需要数据库，直接用关注关系构造图
+    def setUp(self):
+        # 1关注2、3，2关注4、5，3关注4、6，4关注1，7关注4
+        edges = [(1, 2), (1, 3), (2, 4), (2, 5), (3, 4), (3, 6), (4, 1), (7, 4)]
+        self.graph = FollowGraph([a for a, b in edges], [b for a, b in edges])
+
+    def test_csr(self):
+        g = self.graph
+        assert list(g.ids) == [1, 2, 3, 4, 5, 6, 7]
+        assert [int(g.ids[i]) for i in g.following(g.position(1))] == [2, 3]
+        assert [int(g.ids[i]) for i in g.followers(g.position(4))] == [2, 3, 7]
+        assert g.in_degree[g.position(4)] == 3
+        assert g.position(8) is None
+        assert g.edges == 8
+        rows = np.array([0, 1, 2], dtype=np.int32)
+        assert list(gather(g.out_ptr, g.out_idx, rows)) == \
+            list(np.concatenate([g.following(0), g.following(1), g.following(2)]))
+
+    def test_follows(self):
+        g = self.graph
+        assert g.follows(1, 2)
+        assert not g.follows(2, 1)
+        assert not g.follows(1, 8)
+        assert g.mutual(1, 4) is False
+        assert g.mutual(4, 1) is False
+        both = FollowGraph([1, 2], [2, 1])
+        assert both.mutual(1, 2)
+
+    def test_follower_overlap(self):
+        g = self.graph
+        # 4的粉丝是2、3、7，3的粉丝是1
+        assert g.follower_overlap(4, 3) == (0, 0.0)
+        g = FollowGraph([1, 2, 1, 3], [4, 4, 5, 5])
+        assert g.follower_overlap(4, 5) == (1, 1 / 3)
+        assert g.follower_overlap(4, 9) == (0, 0.0)
+
+    def test_suggestions(self):
+        g = self.graph
+        # 2和3都关注了4，排在最前面；5和6各被一个人关注，粉丝一样多时按id排列
+        assert g.suggestions(1, 3) == [(4, 2), (5, 1), (6, 1)]
+        assert g.suggestions(1, 1) == [(4, 2)]
+        # 排除的用户（比如刚刚关注的）不再推荐，不够的用粉丝最多的用户补足
+        assert g.suggestions(1, 3, exclude=[4, 6]) == [(5, 1), (7, 0)]
+        assert g.suggestions(7, 2) == [(1, 1), (2, 0)]
+        # 不在图里的用户只有热门用户
+        assert g.suggestions(8, 2) == [(4, 0), (1, 0)]
+
+    def test_empty(self):
+        g = FollowGraph([], [])
+        assert g.suggestions(1, 5) == []
+        assert not g.follows(1, 2)
+        assert g.follower_overlap(1, 2) == (0, 0.0)
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+        users = dict((name, User(nickname=name, email=name + '@example.com'))
+                     for name in ['john', 'susan', 'mary', 'david', 'bob'])
+        db.session.add_all(users.values())
+        db.session.commit()
+        for a, b in [('john', 'susan'), ('john', 'mary'), ('susan', 'david'), ('mary', 'david'), ('mary', 'bob'),
+                     ('david', 'john')]:
+            users[a].follow(users[b])
+        db.session.commit()
+        self.ids = dict((name, user.id) for name, user in users.items())
+        refresh_graph()
+        with self.app.session_transaction() as session:
+            session['user_id'] = str(self.ids['john'])
+            session['_fresh'] = True
+
+    def tearDown(self):
+        last_seen_buffer.flush()
+        app.config['GRAPH_ENABLED'] = True
+        db.session.remove()
+        db.drop_all()
+        graph.graph = None
+        graph.failed_at = 0
+
+    def test_load(self):
+        g = load_graph(chunk_size=4)
+        assert g.edges == 6
+        assert g.follows(self.ids['david'], self.ids['john'])
+        assert g.suggestions(self.ids['john'], 2) == [(self.ids['david'], 2), (self.ids['bob'], 1)]
+
+    def test_who_to_follow(self):
+        with app.test_request_context('/'):
+            john = User.query.filter_by(nickname='john').first()
+            assert [(user.nickname, n) for user, n in who_to_follow(john)] == [('david', 2), ('bob', 1)]
+            # 图还没有重新加载，刚关注的用户也不再推荐
+            john.follow(User.query.filter_by(nickname='david').first())
+            db.session.commit()
+        with app.test_request_context('/'):
+            john = User.query.filter_by(nickname='john').first()
+            assert [(user.nickname, n) for user, n in who_to_follow(john)] == [('bob', 1)]
+
+    def test_profile(self):
+        rv = self.app.get('/user/john')
+        assert b'Who to follow' in rv.data
+        assert b'Followed by 2 people you follow' in rv.data
+        assert b'Followed by 1 person you follow' in rv.data
+        # 别人的主页上没有推荐，david关注了john
+        rv = self.app.get('/user/david')
+        assert b'Who to follow' not in rv.data
+        assert b'Follows you' in rv.data
+        rv = self.app.get('/user/susan')
+        assert b'Follows you' not in rv.data
+
+    def test_rebuild(self):
+        rv = self.app.get('/user/john')
+        etag = rv.headers['ETag']
+        rv = self.app.get('/user/john', headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        # 过期的图在后台线程里重新加载，这次请求还是用旧的
+        old = graph.graph
+        old.built_at -= app.config['GRAPH_REBUILD_INTERVAL']
+        self.app.get('/user/john')
+        for i in range(100):
+            if graph.graph is not old:
+                break
+            time.sleep(0.05)
+        assert graph.graph is not old
+        rv = self.app.get('/user/john', headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+
+    def wait_for(self, condition):
+        for i in range(100):
+            if condition():
+                return
+            time.sleep(0.05)
+
+    def test_first_load(self):
+        # 第一次加载也在后台线程里，加载完之前页面上没有推荐
+        graph.graph = None
+        loading = threading.Event()
+        saved = graph.load_graph
+        graph.load_graph = lambda: loading.wait() and saved()
+        try:
+            rv = self.app.get('/user/john')
+            assert b'Who to follow' not in rv.data
+            loading.set()
+            self.wait_for(lambda: graph.graph is not None)
+        finally:
+            graph.load_graph = saved
+        rv = self.app.get('/user/john')
+        assert b'Who to follow' in rv.data
+
+    def test_failed_reload(self):
+        calls = []
+
+        def broken():
+            calls.append(1)
+            raise IOError('database is down')
+
+        old = graph.graph
+        old.built_at -= app.config['GRAPH_REBUILD_INTERVAL']
+        saved = graph.load_graph
+        graph.load_graph = broken
+        try:
+            self.app.get('/user/john')
+            self.wait_for(lambda: graph.failed_at and graph.rebuilding is None)
+            # 加载失败后继续用旧的图，GRAPH_REBUILD_INTERVAL秒之内不再重试
+            rv = self.app.get('/user/john')
+            self.app.get('/user/john')
+            assert b'Who to follow' in rv.data
+            assert graph.graph is old
+            assert len(calls) == 1
+            graph.failed_at -= app.config['GRAPH_REBUILD_INTERVAL']
+            graph.load_graph = saved
+            self.app.get('/user/john')
+            self.wait_for(lambda: graph.graph is not old)
+            assert graph.graph is not old
+        finally:
+            graph.load_graph = saved
+
+    def test_disabled(self):
+        app.config['GRAPH_ENABLED'] = False
+        rv = self.app.get('/user/john')
+        assert b'Who to follow' not in rv.data
+        rv = self.app.get('/metrics')
+        assert b'microblog_graph_edges 6' in rv.data
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db
+from app.models import User, Post, SearchOutbox, followers, user_cache
+from app.ingest import ingest, parse_timestamp
+import datetime
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+        user_cache.local.clear()
+        self.john = User(nickname='john', email='john@example.com')
+        self.susan = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([self.john, self.susan])
+        db.session.commit()
+        self.john.follow(self.susan)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_parse_timestamp(self):
+        assert parse_timestamp('2019-10-01T08:00:00Z') == datetime.datetime(2019, 10, 1, 8)
+        assert parse_timestamp('2019-10-01T08:00:00+08:00') == datetime.datetime(2019, 10, 1, 0)
+        assert parse_timestamp('2019-10-01 08:00:00.5') == datetime.datetime(2019, 10, 1, 8, 0, 0, 500000)
+        assert parse_timestamp('') <= datetime.datetime.utcnow()
+
+    def test_ingest_posts(self):
+        rows = [{'author': 'susan', 'body': 'post %d' % i, 'timestamp': '2019-10-01T00:0%d:00Z' % i} for i in range(5)]
+        rows += [{'author': 'nobody', 'body': 'lost'}, {'author': 'john', 'body': ''},
+                 {'author_id': str(self.john.id), 'body': 'x' * 200}, {'author_id': str(self.john.id), 'body': 'y' * 140}]
+        reports = []
+        assert ingest('posts', rows, 3, lambda *args: reports.append(args[:2])) == (6, 3)
+        assert reports == [(3, 0), (5, 1), (6, 3)]
+        db.session.expire_all()
+        assert [p.body for p in self.susan.posts.order_by(Post.timestamp)] == ['post %d' % i for i in range(5)]
+        # 超长的博客跳过，不截断
+        assert [p.body for p in self.john.posts] == ['y' * 140]
+        assert (self.susan.post_count, self.john.post_count) == (5, 1)
+        # 没有经过session，不会给每条博客写outbox
+        assert SearchOutbox.query.count() == 0
+
+    def test_ingest_follows(self):
+        carol = User(nickname='carol', email='carol@example.com')
+        db.session.add(carol)
+        db.session.commit()
+        rows = [
+            {'follower': 'john', 'followed': 'susan'},
+            {'follower': 'john', 'followed': 'carol'},
+            {'follower_id': carol.id, 'followed_id': self.susan.id},
+            {'follower': 'susan', 'followed': 'carol'},
+            {'follower': 'susan', 'followed': 'carol'},
+            {'follower': 'nobody', 'followed': 'carol'},
+        ]
+        assert ingest('follows', rows, 4) == (3, 3)
+        db.session.expire_all()
+        assert db.session.query(followers).count() == 4
+        assert self.john.is_following(carol) and carol.is_following(self.susan) and self.susan.is_following(carol)
+        assert (self.john.followed_count, self.susan.follower_count, carol.follower_count) == (2, 2, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
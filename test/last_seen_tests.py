@@ -0,0 +1,105 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db
+from app.models import User
+from app import last_seen
+from app.last_seen import LastSeenBuffer
+import datetime
+import time
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['LAST_SEEN_TOLERANCE'] = 60
+        app.config['LAST_SEEN_FLUSH_INTERVAL'] = 3600
+        app.config['LAST_SEEN_FLUSH_SIZE'] = 2
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+        self.now = datetime.datetime(2019, 10, 1, 12, 0, 0)
+        self.users = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(3)]
+        for u in self.users:
+            db.session.add(u)
+        db.session.commit()
+
+    def tearDown(self):
+        # 全局的缓冲区由后台线程写回，不能让这里的小阈值留给其他测试
+        app.config['LAST_SEEN_FLUSH_INTERVAL'] = 30
+        app.config['LAST_SEEN_FLUSH_SIZE'] = 100
+        db.session.remove()
+        db.drop_all()
+
+    def stored(self, user):
+        return db.session.query(User.last_seen).filter(User.id == user.id).scalar()
+
+    def test_flush_by_size(self):
+        buf = LastSeenBuffer()
+        u1, u2, u3 = self.users
+        buf.touch(u1.id, None, self.now)
+        # 还没攒够，没有写数据库
+        assert self.stored(u1) is None
+        buf.touch(u2.id, None, self.now)
+        # 攒够了由后台线程写回，请求线程不等待
+        for i in range(100):
+            if not buf.pending and self.stored(u2) is not None:
+                break
+            time.sleep(0.01)
+            db.session.remove()
+        assert self.stored(u1) == self.now
+        assert self.stored(u2) == self.now
+        assert buf.pending == {}
+
+    def test_tolerance(self):
+        buf = LastSeenBuffer()
+        u1 = self.users[0]
+        buf.touch(u1.id, self.now - datetime.timedelta(seconds=10), self.now)
+        assert buf.pending == {}
+        buf.touch(u1.id, self.now - datetime.timedelta(seconds=120), self.now)
+        assert buf.pending == {u1.id: self.now}
+        # 缓冲区里的值已经足够新了
+        buf.touch(u1.id, self.now - datetime.timedelta(seconds=120), self.now + datetime.timedelta(seconds=5))
+        assert buf.pending == {u1.id: self.now}
+
+    def test_never_moves_backwards(self):
+        # 两个进程各自的缓冲区，较旧的值后写入也不会覆盖较新的值
+        u1 = self.users[0]
+        newer, older = LastSeenBuffer(), LastSeenBuffer()
+        newer.touch(u1.id, None, self.now)
+        older.touch(u1.id, None, self.now - datetime.timedelta(minutes=5))
+        assert newer.flush() == 1
+        older.flush()
+        assert self.stored(u1) == self.now
+
+    def test_flush_failure(self):
+        # 写数据库出错时不抛给调用的人，这一批放回缓冲区，下一次再写
+        buf = LastSeenBuffer()
+        u1 = self.users[0]
+        buf.touch(u1.id, None, self.now)
+
+        class BrokenEngine():
+            def begin(self):
+                raise IOError('database is down')
+
+        saved = last_seen.db
+        last_seen.db = type('BrokenDB', (), {'engine': BrokenEngine()})()
+        try:
+            assert buf.flush() == 0
+        finally:
+            last_seen.db = saved
+        assert buf.failed == 1
+        assert buf.pending == {u1.id: self.now}
+        assert buf.flush() == 1
+        assert self.stored(u1) == self.now
+
+
+if __name__ == '__main__':
+    unittest.main()
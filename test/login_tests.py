@@ -3,8 +3,8 @@
 import unittest
 import sys
 sys.path.append('/home/haow/microblog')
-from app import app, db
-from app.models import User, Post
+from app import app, db, models
+from app.models import User, Post, unique_nicknames, numbered
 import datetime
 import pdb
 
@@ -44,6 +44,55 @@ class TestCase(unittest.TestCase):
         assert nickname2 != 'John'
         assert nickname2 != nickname
 
+    def test_unique_nicknames(self):
+        for nickname in ['john', 'john2', 'john4', 'johnny', 'john_', 'john5x', 'bob1']:
+            db.session.add(User(nickname=nickname, email=nickname + '@example.com'))
+        db.session.commit()
+        statements = []
+
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            nicknames = unique_nicknames(['john', 'john', 'susan', 'susan', 'bob', 'john_', 'jo%', 'john2', 'john2'])
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        # 前缀后面不是数字的名字不会查出来
+        assert sorted(u.nickname for u in User.query.filter(numbered('john'))) == ['john', 'john2', 'john4']
+        assert [u.nickname for u in User.query.filter(numbered('john_'))] == ['john_']
+        # 一批nickname只查一次数据库，先填空着的后缀，批内重名的也不冲突
+        assert len(statements) == 1
+        assert nicknames == ['john3', 'john5', 'susan', 'susan2', 'bob', 'john_2', 'jo%', 'john22', 'john23']
+        # 分配给john2的john22、john23也算john的后缀，不会再分配给john
+        nicknames = unique_nicknames(['john2'] * 21 + ['john'] * 22)
+        assert len(set(nicknames)) == len(nicknames)
+        assert 'john22' in nicknames[:21] and 'john22' not in nicknames[21:]
+        assert User.make_unique_nickname('John') == 'John'
+
+    def test_add_unique(self):
+        db.session.add(User(nickname='john', email='john@example.com'))
+        db.session.commit()
+        real = models.unique_nicknames
+        calls = []
+
+        def stale(nicknames):
+            # 第一次模拟另一个worker刚刚用掉了john2，分配结果已经过期
+            calls.append(nicknames)
+            if len(calls) == 1:
+                db.session.add(User(nickname='john2', email='other@example.com'))
+                db.session.commit()
+                return ['john2']
+            return real(nicknames)
+        models.unique_nicknames = stale
+        try:
+            user = User.add_unique('john', email='john@example.org')
+            db.session.commit()
+        finally:
+            models.unique_nicknames = real
+        assert user.nickname == 'john3'
+        assert len(calls) == 2
+        assert User.query.count() == 3
+
     def test_follow(self):
         u1 = User(nickname='john', email='john@example.com')
         u2 = User(nickname='susan', email='susan@example.com')
@@ -71,6 +120,33 @@ class TestCase(unittest.TestCase):
         assert u1.followed.count() == 0
         assert u2.followers.count() == 0
 
+    def test_following_ids(self):
+        users = [User(nickname='user%d' % i, email='user%d@example.com' % i) for i in range(4)]
+        for u in users:
+            db.session.add(u)
+        db.session.commit()
+        u0, u1, u2, u3 = users
+        ids = [u.id for u in users]
+        u0.follow(u1)
+        u0.follow(u3)
+        db.session.commit()
+        assert u0.following_ids(ids) == set([ids[1], ids[3]])
+        assert u0.following_ids([]) == set()
+        # 在请求内，关注列表只查询一次，之后的判断都不再访问数据库
+        with app.test_request_context():
+            assert u0.followed_ids() == set([ids[1], ids[3]])
+            assert u0.is_following(u1)
+            assert not u0.is_following(u2)
+            u0.follow(u2)
+            assert u0.is_following(u2)
+            assert u0.following_ids([ids[2], ids[3]]) == set([ids[2], ids[3]])
+            u0.unfollow(u1)
+            assert not u0.is_following(u1)
+            db.session.commit()
+        # 请求结束后session被清理了，重新读取用户
+        u0 = User.query.get(ids[0])
+        assert u0.following_ids(ids) == set([ids[2], ids[3]])
+
     def test_follow_posts(self):
         # 创建4个用户
         u1 = User(nickname='john', email='john@example')
@@ -0,0 +1,208 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, mail
+from app import mails
+from app.mails import MailDispatcher
+from app.logs import ErrorMailHandler, LogPipeline, DroppingQueueHandler, fingerprint
+from logging.handlers import MemoryHandler
+from contextlib import redirect_stderr
+import io
+import logging
+import socket
+import threading
+import time
+
+
+def fail(path):
+    # 同一个地方抛出的异常，消息里的URL不一样
+    try:
+        raise ValueError('bad value')
+    except ValueError:
+        return logging.LogRecord('app', logging.ERROR, __file__, 1, 'Exception on %s [GET]' % path, None, sys.exc_info())
+
+
+class ListHandler(logging.Handler):
+    def __init__(self, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.records = []
+        self.flushes = 0
+
+    def emit(self, record):
+        self.records.append(record)
+
+    def flush(self):
+        self.flushes += 1
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.handler = ErrorMailHandler(app, 60, 3, lambda subject, body: self.sent.append((subject, body)))
+        self.saved = app.config['LOG_QUEUE_SIZE'], app.config['LOG_FLUSH_INTERVAL']
+
+    def tearDown(self):
+        app.config['LOG_QUEUE_SIZE'], app.config['LOG_FLUSH_INTERVAL'] = self.saved
+
+    def expire(self):
+        for entry in self.handler.errors.values():
+            entry[2] -= 60
+        self.handler.sent_at = []
+
+    def test_fingerprint(self):
+        assert fingerprint(fail('/a')) == fingerprint(fail('/b'))
+        other = logging.LogRecord('app', logging.ERROR, __file__, 1, 'Exception on /a [GET]', None, None)
+        assert fingerprint(other) != fingerprint(fail('/a'))
+        # 没有异常时按消息模板区分，参数不同还是同一个错误
+        a = logging.LogRecord('app', logging.ERROR, __file__, 2, 'user %s failed', ('john',), None)
+        b = logging.LogRecord('app', logging.ERROR, __file__, 2, 'user %s failed', ('susan',), None)
+        assert fingerprint(a) == fingerprint(b)
+
+    def test_dedup(self):
+        for i in range(100):
+            self.handler.handle(fail('/post/%d' % i))
+        # 同一个错误只发一封，其余的计数
+        assert len(self.sent) == 1
+        assert self.sent[0][0] == 'microblog failure: ValueError: Exception on /post/0 [GET]'
+        assert 'bad value' in self.sent[0][1]
+        assert self.handler.suppressed == 99
+        # 窗口结束时发一封汇总
+        self.expire()
+        self.handler.flush()
+        assert len(self.sent) == 2
+        assert self.sent[1][0] == 'microblog failure: 99 more errors (1 distinct) in the last 60 seconds'
+        assert self.sent[1][1].startswith('99 x ValueError: Exception on /post/0 [GET]')
+        # 之后再出现又是一个新的窗口
+        self.handler.handle(fail('/again'))
+        assert len(self.sent) == 3
+        self.expire()
+        self.handler.flush()
+        assert len(self.sent) == 3
+
+    def test_rate_limit(self):
+        for i in range(10):
+            self.handler.handle(logging.LogRecord('app', logging.ERROR, __file__, i, 'error %d' % i, None, None))
+        # 每个窗口最多3封，其他的错误合并成一封汇总
+        assert len(self.sent) == 3
+        self.expire()
+        self.handler.flush()
+        assert len(self.sent) == 4
+        assert self.sent[3][0] == 'microblog failure: 7 more errors (7 distinct) in the last 60 seconds'
+        # 进程退出时把窗口里的也发出去
+        self.handler.handle(fail('/a'))
+        self.handler.handle(fail('/b'))
+        self.handler.close()
+        assert self.sent[-1][0] == 'microblog failure: 1 more errors (1 distinct) in the last 60 seconds'
+
+    def test_send_failure(self):
+        def send(subject, body):
+            raise IOError('smtp is down')
+        handler = ErrorMailHandler(app, 60, 3, send)
+        # 出错的堆栈打印到stderr，不再记日志
+        stderr = io.StringIO()
+        with redirect_stderr(stderr):
+            handler.handle(fail('/a'))
+        assert handler.sent == 1
+        assert 'smtp is down' in stderr.getvalue()
+
+    def test_dispatcher_failure(self):
+        # 错误邮件交给dispatcher发送，SMTP服务器连不上时只记WARNING，不会再产生新的错误邮件
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        saved = dict(app.config), mails.dispatcher
+        app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_USE_SSL=False, MAIL_USE_TLS=False,
+                          MAIL_SUPPRESS_SEND=False, MAIL_WORKERS=1)
+        mail.state = mail.init_app(app)
+        mails.dispatcher = MailDispatcher(app)
+        handler = ErrorMailHandler(app, 60, 3)
+        records = ListHandler()
+        app.logger.addHandler(handler)
+        app.logger.addHandler(records)
+        try:
+            app.logger.handle(fail('/a'))
+            mails.dispatcher.queue.join()
+            assert mails.dispatcher.stats()['failed'] == 1
+            assert [r.levelno for r in records.records] == [logging.ERROR, logging.WARNING]
+            assert records.records[1].exc_info[0] is ConnectionRefusedError
+            assert handler.sent == 1
+        finally:
+            app.logger.removeHandler(handler)
+            app.logger.removeHandler(records)
+            mails.dispatcher.shutdown()
+            app.config.clear()
+            app.config.update(saved[0])
+            mails.dispatcher = saved[1]
+            mail.state = mail.init_app(app)
+
+    def test_pipeline(self):
+        app.config['LOG_FLUSH_INTERVAL'] = 0.05
+        target = ListHandler()
+        buffered = MemoryHandler(100, logging.ERROR, target)
+        buffered.setLevel(logging.INFO)
+        mails = ListHandler(logging.ERROR)
+        pipeline = LogPipeline(app, [buffered, mails])
+        logger = logging.getLogger('microblog.logs_tests')
+        logger.propagate = False
+        logger.setLevel(logging.DEBUG)
+        queue_handler = DroppingQueueHandler(pipeline)
+        logger.addHandler(queue_handler)
+        try:
+            logger.debug('not logged')
+            logger.info('hello %s', 'world')
+            try:
+                1 / 0
+            except ZeroDivisionError:
+                logger.exception('boom')
+            for i in range(100):
+                if len(target.records) == 2 and mails.records:
+                    break
+                time.sleep(0.01)
+            # ERROR马上写，之前缓冲的INFO也一起写出去
+            assert [r.getMessage().splitlines()[0] for r in target.records] == ['hello world', 'boom']
+            assert 'ZeroDivisionError' in target.records[1].getMessage()
+            assert [r.error for r in mails.records] == ['ZeroDivisionError']
+            assert mails.records[0].fingerprint
+            # 没有新日志时按LOG_FLUSH_INTERVAL把缓冲区写出去
+            logger.info('later')
+            for i in range(100):
+                if len(target.records) == 3:
+                    break
+                time.sleep(0.01)
+            assert target.records[2].getMessage() == 'later'
+        finally:
+            pipeline.stop()
+            logger.removeHandler(queue_handler)
+
+    def test_full_queue(self):
+        # 后台线程卡住时请求线程不等待，放不下的日志丢弃并计数
+        app.config['LOG_QUEUE_SIZE'] = 2
+        release = threading.Event()
+
+        class SlowHandler(logging.Handler):
+            def emit(self, record):
+                release.wait()
+
+        pipeline = LogPipeline(app, [SlowHandler()])
+        logger = logging.getLogger('microblog.logs_tests.full')
+        logger.propagate = False
+        queue_handler = DroppingQueueHandler(pipeline)
+        logger.addHandler(queue_handler)
+        try:
+            started = time.time()
+            for i in range(50):
+                logger.warning('record %d', i)
+            assert time.time() - started < 0.5
+            assert pipeline.dropped >= 47
+            assert pipeline.stats()['dropped'] == pipeline.dropped
+        finally:
+            release.set()
+            pipeline.stop()
+            logger.removeHandler(queue_handler)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, mail
+from app.mails import MailDispatcher
+from flask_mail import Message
+import socketserver
+import threading
+import time
+
+
+class DebuggingSMTPHandler(socketserver.StreamRequestHandler):
+    # 一个最简单的本地SMTP服务器，只记录收到的连接数和邮件
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('ascii'))
+
+    def handle(self):
+        self.server.connections += 1
+        self.reply('220 localhost debugging server')
+        while True:
+            line = self.rfile.readline().decode('utf-8', 'replace').strip()
+            if not line:
+                return
+            command = line.split(' ')[0].upper()
+            if command in ('EHLO', 'HELO'):
+                self.reply('250 localhost')
+            elif command == 'DATA':
+                self.reply('354 end data with <CR><LF>.<CR><LF>')
+                data = []
+                while True:
+                    l = self.rfile.readline()
+                    if l in (b'.\r\n', b''):
+                        break
+                    data.append(l)
+                self.server.messages.append(b''.join(data))
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 OK')
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), DebuggingSMTPHandler)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.messages = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.saved = dict(app.config)
+        app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=self.server.server_address[1], MAIL_USE_SSL=False,
+                          MAIL_USE_TLS=False, MAIL_SUPPRESS_SEND=False, MAIL_WORKERS=2, MAIL_MAX_EMAILS=100)
+        mail.state = mail.init_app(app)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        app.config.clear()
+        app.config.update(self.saved)
+        mail.state = mail.init_app(app)
+
+    def message(self, i):
+        return Message('hello %d' % i, sender='no-reply@localhost', recipients=['user%d@example.com' % i], body='hi')
+
+    def test_reuses_connections_and_drains_on_shutdown(self):
+        dispatcher = MailDispatcher(app)
+        for i in range(20):
+            assert dispatcher.submit(self.message(i))
+        dispatcher.shutdown()
+        assert len(self.server.messages) == 20
+        # 每个worker最多只建立一个连接
+        assert self.server.connections <= 2
+        assert dispatcher.stats()['sent'] == 20
+
+    def test_drop_when_queue_full(self):
+        # 没有worker消费，队列满了之后的邮件被丢弃并计数
+        app.config.update(MAIL_WORKERS=0, MAIL_QUEUE_SIZE=2, MAIL_QUEUE_TIMEOUT=0)
+        dispatcher = MailDispatcher(app)
+        results = [dispatcher.submit(self.message(i)) for i in range(5)]
+        assert results == [True, True, False, False, False]
+        assert dispatcher.stats() == {'queued': 2, 'sent': 0, 'failed': 0, 'dropped': 3}
+
+    def test_shutdown_with_full_queue(self):
+        # 没有worker消费时，退出不会卡在放不进队列的STOP上
+        app.config.update(MAIL_WORKERS=1, MAIL_QUEUE_SIZE=1, MAIL_QUEUE_TIMEOUT=0)
+        dispatcher = MailDispatcher(app)
+        dispatcher.start()
+        dispatcher.queue.put(dispatcher.STOP)
+        dispatcher.workers[0].join(1)
+        assert dispatcher.submit(self.message(0))
+        started = time.time()
+        dispatcher.shutdown(0.1)
+        assert time.time() - started < 1
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,96 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db, search
+from app.models import User, Post
+from app.metrics import registry
+from app.fragments import fragment_cache
+from app.indexer import drain
+from app.last_seen import last_seen_buffer
+from search_tests import FakeES
+import datetime
+import re
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+        self.saved_es = search.es
+        search.es = FakeES()
+        john = User(nickname='john', email='john@example.com')
+        db.session.add(john)
+        db.session.commit()
+        john.follow(john)
+        db.session.add(Post(body='hello', author=john, timestamp=datetime.datetime.utcnow()))
+        db.session.commit()
+        drain()
+        with self.app.session_transaction() as session:
+            session['user_id'] = str(john.id)
+            session['_fresh'] = True
+        registry.clear()
+        fragment_cache.local.clear()
+
+    def tearDown(self):
+        search.es = self.saved_es
+        app.config['METRICS_SLOW_REQUEST'] = 1.0
+        app.config['METRICS_ALLOWED_IPS'] = ['127.0.0.1', '::1']
+        last_seen_buffer.flush()
+        db.session.remove()
+        db.drop_all()
+
+    def metrics(self):
+        rv = self.app.get('/metrics')
+        assert rv.status_code == 200
+        assert rv.mimetype == 'text/plain'
+        return rv.data.decode('utf-8')
+
+    def value(self, text, name):
+        match = re.search('^%s (\\S+)$' % re.escape(name), text, re.M)
+        assert match, name
+        return float(match.group(1))
+
+    def test_request_metrics(self):
+        self.app.get('/index')
+        self.app.get('/index')
+        text = self.metrics()
+        assert '# TYPE microblog_request_seconds histogram' in text
+        assert self.value(text, 'microblog_requests_total{endpoint="index",status="200"}') == 2
+        assert self.value(text, 'microblog_request_seconds_count{endpoint="index"}') == 2
+        assert self.value(text, 'microblog_request_seconds_bucket{endpoint="index",le="+Inf"}') == 2
+        assert self.value(text, 'microblog_request_sql_statements_sum{endpoint="index"}') > 0
+        assert self.value(text, 'microblog_sql_seconds_total{endpoint="index"}') > 0
+        assert self.value(text, 'microblog_template_seconds_total{endpoint="index"}') > 0
+        assert self.value(text, 'microblog_cache_entries{cache="fragment"}') == 1
+        assert self.value(text, 'microblog_search_outbox_depth') == 0
+
+    def test_search_time(self):
+        self.app.get('/search?q=hello')
+        text = self.metrics()
+        assert self.value(text, 'microblog_search_seconds_total{endpoint="search"}') > 0
+        assert self.value(text, 'microblog_requests_total{endpoint="search",status="200"}') == 1
+
+    def test_slow_request_log(self):
+        app.config['METRICS_SLOW_REQUEST'] = 0
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            self.app.get('/index')
+        assert 'slow request GET /index?' in logs.output[0]
+        assert 'SELECT' in logs.output[0]
+        assert self.value(self.metrics(), 'microblog_slow_requests_total{endpoint="index"}') == 1
+
+    def test_allowed_ips(self):
+        app.config['METRICS_ALLOWED_IPS'] = ['10.0.0.1']
+        assert self.app.get('/metrics').status_code == 403
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db
+from app.models import User, Post
+from app.pagination import keyset_paginate, legacy_cursor, decode_cursor, InvalidCursor
+import datetime
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+        self.u = User(nickname='john', email='john@example.com')
+        db.session.add(self.u)
+        utcnow = datetime.datetime(2019, 10, 1)
+        # 两条博客的时间相同，靠id区分先后
+        self.posts = [Post(body='post %d' % i, author=self.u, timestamp=utcnow+datetime.timedelta(seconds=i // 2)) for i in range(7)]
+        for p in self.posts:
+            db.session.add(p)
+        db.session.commit()
+        self.newest_first = self.posts[::-1]
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_walk_forward_and_back(self):
+        page = keyset_paginate(self.u.posts, 3)
+        assert page.items == self.newest_first[0:3]
+        assert page.has_next and not page.has_prev
+        page = keyset_paginate(self.u.posts, 3, before=page.next_cursor)
+        assert page.items == self.newest_first[3:6]
+        assert page.has_next and page.has_prev
+        last = keyset_paginate(self.u.posts, 3, before=page.next_cursor)
+        assert last.items == self.newest_first[6:]
+        assert not last.has_next and last.has_prev
+        back = keyset_paginate(self.u.posts, 3, after=last.prev_cursor)
+        assert back.items == page.items
+        first = keyset_paginate(self.u.posts, 3, after=back.prev_cursor)
+        assert first.items == self.newest_first[0:3]
+        assert not first.has_prev
+
+    def test_legacy_page(self):
+        cursor = legacy_cursor(self.u.posts, 2, 3)
+        assert decode_cursor(cursor)[2] == 2
+        assert keyset_paginate(self.u.posts, 3, before=cursor).items == self.newest_first[3:6]
+        assert legacy_cursor(self.u.posts, 10, 3) is None
+
+    def test_invalid_cursor(self):
+        with self.assertRaises(InvalidCursor):
+            keyset_paginate(self.u.posts, 3, before='not-a-cursor')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db, search, views
+from app.models import User, Post
+from app.indexer import drain
+from app.last_seen import last_seen_buffer
+from app.graph import refresh_graph
+from app.trending import refresh_trending
+from search_tests import FakeES
+from contextlib import contextmanager
+import datetime
+
+
+@contextmanager
+def count_queries():
+    # 统计这段代码里发给数据库的SQL语句数
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+        self.es = FakeES()
+        self.saved_es = search.es
+        search.es = self.es
+        self.saved_per_page = views.POST_PER_PAGE
+        viewer = User(nickname='viewer', email='viewer@example.com')
+        authors = [User(nickname='author%d' % i, email='author%d@example.com' % i) for i in range(10)]
+        db.session.add(viewer)
+        db.session.add_all(authors)
+        db.session.commit()
+        start = datetime.datetime(2019, 10, 1)
+        # 每个作者的博客交错排列，这样一页里的作者各不相同
+        for i in range(100):
+            db.session.add(Post(body='hello %d' % i, author=authors[i % 10], timestamp=start+datetime.timedelta(seconds=i)))
+        for author in authors:
+            viewer.follow(author)
+        db.session.commit()
+        drain()
+        # 关注图和热门话题在后台线程里加载，它们的查询会被算进来，先加载好
+        refresh_graph()
+        refresh_trending()
+        with self.app.session_transaction() as session:
+            session['user_id'] = str(viewer.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        search.es = self.saved_es
+        views.POST_PER_PAGE = self.saved_per_page
+        last_seen_buffer.flush()
+        db.session.remove()
+        db.drop_all()
+
+    def statements_for(self, url, per_page):
+        views.POST_PER_PAGE = per_page
+        # 先请求一次，让用户缓存和last_seen都稳定下来
+        self.app.get(url)
+        with count_queries() as statements:
+            rv = self.app.get(url)
+        assert rv.status_code == 200
+        assert rv.data.count(b'says:') >= per_page
+        return len(statements)
+
+    def assert_constant(self, url):
+        small = self.statements_for(url, 3)
+        large = self.statements_for(url, 9)
+        assert small == large, '%s: %d statements for 3 posts, %d for 9 posts' % (url, small, large)
+
+    def test_index(self):
+        self.assert_constant('/index')
+
+    def test_user(self):
+        self.assert_constant('/user/author0')
+
+    def test_search(self):
+        self.assert_constant('/search?q=hello')
+
+
+if __name__ == '__main__':
+    unittest.main()
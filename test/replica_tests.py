@@ -0,0 +1,139 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db, replicas
+from app.models import User, Post, user_cache
+from app.last_seen import last_seen_buffer
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import time
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        # 副本用一个本地的SQLite文件，数据由测试自己复制过去
+        self.tmp = tempfile.mkdtemp()
+        app.config['SQLALCHEMY_REPLICAS'] = {'replica': 'sqlite:///' + os.path.join(self.tmp, 'replica.db')}
+        replicas.lag_checks.clear()
+        replicas.routed.clear()
+        user_cache.local.clear()
+        self.app = app.test_client()
+        db.create_all()
+        john = User(nickname='john', email='john@example.com')
+        susan = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        john.follow(susan)
+        db.session.add(Post(body='on both', author=susan, timestamp=datetime.datetime(2019, 10, 1)))
+        db.session.commit()
+        self.replica = db.get_engine(app, bind='replica')
+        self.copy_to_replica()
+        # 只在副本上有的博客，能读到它就说明查询发给了副本
+        self.replica.execute(Post.__table__.insert(), body='replica only', user_id=susan.id,
+                        timestamp=datetime.datetime(2019, 10, 2))
+        with self.app.session_transaction() as session:
+            session['user_id'] = str(john.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        last_seen_buffer.flush()
+        db.session.remove()
+        self.replica.dispose()
+        app.config['SQLALCHEMY_REPLICAS'] = {}
+        app.config['SQLALCHEMY_BIND_OPTIONS'] = {}
+        db.drop_all()
+        shutil.rmtree(self.tmp)
+
+    def copy_to_replica(self):
+        db.Model.metadata.create_all(self.replica)
+        for table in db.Model.metadata.sorted_tables:
+            rows = [dict(row) for row in db.session.execute(table.select())]
+            if rows:
+                self.replica.execute(table.insert(), rows)
+        db.session.commit()
+
+    def bodies(self, nickname='susan'):
+        rv = self.app.get('/api/users/%s/posts' % nickname)
+        assert rv.status_code == 200, rv.status_code
+        return [post['body'] for post in json.loads(rv.data.decode('utf-8'))['posts']]
+
+    def test_reads_go_to_replica(self):
+        assert self.bodies() == ['replica only', 'on both']
+        assert replicas.routed.get('replica', 0) > 0
+        assert replicas.lag_checks['replica'][1] == 0.0
+        rv = self.app.get('/metrics')
+        assert b'microblog_replica_reads_total{bind="replica"}' in rv.data
+        assert b'microblog_replica_lag_seconds{bind="replica"} 0.0' in rv.data
+
+    def test_replica_reads_skip_user_cache(self):
+        # 从副本读到的用户不放进缓存，否则提交之后清掉的旧数据又会被副本填回去
+        susan = User.query.filter_by(nickname='susan').first()
+        assert self.bodies() == ['replica only', 'on both']
+        assert user_cache.get('nickname:susan') is None
+        assert user_cache.get('id:%d' % susan.id) is None
+        app.config['SQLALCHEMY_REPLICAS'] = {}
+        assert self.bodies() == ['on both']
+        assert user_cache.get('nickname:susan') == susan.id
+
+    def test_without_replicas(self):
+        app.config['SQLALCHEMY_REPLICAS'] = {}
+        assert self.bodies() == ['on both']
+
+    def test_read_your_writes(self):
+        rv = self.app.post('/index', data=dict(post='just posted'), follow_redirects=True)
+        assert rv.status_code == 200
+        # 刚写过，这个浏览器读主库，能看到副本上还没有的博客
+        assert self.bodies('john') == ['just posted']
+        assert self.bodies() == ['on both']
+        with self.app.session_transaction() as session:
+            session['primary_until'] = time.time() - 1
+        assert self.bodies() == ['replica only', 'on both']
+
+    def test_lagging_replica(self):
+        replicas.lag_checks['replica'] = (time.time(), app.config['REPLICA_MAX_LAG'] + 1)
+        assert self.bodies() == ['on both']
+        assert replicas.routed.get(None, 0) > 0
+        # 过了检查间隔重新检查，延迟恢复后又开始使用副本
+        replicas.lag_checks['replica'] = (time.time() - app.config['REPLICA_LAG_CHECK_INTERVAL'], 60)
+        assert self.bodies() == ['replica only', 'on both']
+
+    def test_unavailable_replica(self):
+        app.config['SQLALCHEMY_REPLICAS'] = {'replica': 'sqlite:///' + os.path.join(self.tmp, 'missing', 'replica.db')}
+        assert self.bodies() == ['on both']
+        assert replicas.lag_checks['replica'][1] is None
+
+    def test_writes_in_session_use_primary(self):
+        with app.test_request_context('/'):
+            db.session.info['replica_reads'] = True
+            susan = User.query.filter_by(nickname='susan').first()
+            assert [p.body for p in susan.posts.order_by(Post.timestamp.desc())] == ['replica only', 'on both']
+            db.session.add(Post(body='new', author=susan, timestamp=datetime.datetime(2019, 10, 3)))
+            db.session.flush()
+            assert [p.body for p in susan.posts.order_by(Post.timestamp.desc())] == ['new', 'on both']
+            # 加锁的SELECT也走主库
+            assert db.session.query(Post.body).filter_by(body='on both').with_for_update().scalar() == 'on both'
+            db.session.rollback()
+            db.session.remove()
+
+    def test_bind_options(self):
+        app.config['SQLALCHEMY_BIND_OPTIONS'] = {'replica': {'pool_recycle': 123}}
+        # 换了URL才会重新创建engine
+        app.config['SQLALCHEMY_REPLICAS'] = {'replica': 'sqlite:///' + os.path.join(self.tmp, 'replica2.db')}
+        assert db.get_engine(app, bind='replica').pool._recycle == 123
+        assert db.engine.pool._recycle != 123
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app.search_engine import EmbeddedSearch, tokenize
+import shutil
+import tempfile
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.engine = EmbeddedSearch(self.path, merge_segments=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def index(self, docs):
+        self.engine.bulk([('index', 'post', id, {'body': body}) for id, body in docs.items()])
+
+    def test_tokenize(self):
+        assert tokenize('Hello, World') == ['hello', 'world']
+        assert tokenize(u'北京欢迎你') == [u'北', u'京', u'欢', u'迎', u'你', u'北京', u'京欢', u'欢迎', u'迎你']
+        assert tokenize(u'北京', query=True) == [u'北京']
+        assert tokenize(u'京', query=True) == [u'京']
+
+    def test_bm25_ranking(self):
+        self.index({
+            1: u'今天天气很好',
+            2: u'北京天气 北京天气预报',
+            3: u'北京烤鸭',
+            4: 'nothing here',
+        })
+        ids, total = self.engine.search('post', u'北京天气', 0, 10)
+        assert total == 3
+        # 两个词都出现、而且出现次数最多的排在最前面
+        assert ids[0] == 2
+        assert set(ids) == set([1, 2, 3])
+        assert self.engine.search('post', u'烤鸭', 0, 10) == ([3], 1)
+        assert self.engine.search('post', 'NOTHING', 0, 10) == ([4], 1)
+        assert self.engine.search('post', u'上海', 0, 10) == ([], 0)
+
+    def test_paging(self):
+        self.index(dict((i, 'hello') for i in range(1, 8)))
+        ids, total = self.engine.search('post', 'hello', 0, 3)
+        assert total == 7
+        # 分数相同按id倒序
+        assert ids == [7, 6, 5]
+        assert self.engine.search('post', 'hello', 6, 3) == ([1], 7)
+
+    def test_search_after(self):
+        self.index(dict((i, 'hello') for i in range(1, 6)))
+        hits, total = self.engine.search_after('post', 'hello', 2)
+        assert [id for id, sort in hits] == [5, 4] and total == 5
+        hits, total = self.engine.search_after('post', 'hello', 2, hits[-1][1])
+        assert [id for id, sort in hits] == [3, 2]
+        # 反向取排在前面的结果，顺序仍然是从高到低
+        hits, total = self.engine.search_after('post', 'hello', 5, hits[0][1], reverse=True)
+        assert [id for id, sort in hits] == [5, 4]
+
+    def test_update_delete_and_merge(self):
+        for i in range(1, 6):
+            # 每次提交一个段，超过3个段时合并
+            self.index({i: 'version one'})
+        self.index({2: 'version two'})
+        self.engine.bulk([('delete', 'post', 3, None)])
+        assert self.engine.search('post', 'one', 0, 10) == ([5, 4, 1], 3)
+        assert self.engine.search('post', 'two', 0, 10) == ([2], 1)
+        assert len(self.engine.index('post').names) <= 3
+
+    def test_reopen(self):
+        # 另一个进程打开同一个目录，能看到已经提交的数据，也能看到之后的提交
+        self.index({1: u'微博', 2: u'博客'})
+        reader = EmbeddedSearch(self.path)
+        assert reader.search('post', u'微博', 0, 10) == ([1], 1)
+        self.engine.bulk([('delete', 'post', 1, None), ('index', 'post', 3, {'body': u'新微博'})])
+        assert reader.search('post', u'微博', 0, 10) == ([3], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,360 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db
+from app import search
+from app.models import User, Post, SearchOutbox
+from app.last_seen import last_seen_buffer
+from elasticsearch import NotFoundError, RequestError
+from app.indexer import drain, outbox_stats, reindex, load_checkpoint, start_rebuild, replay, finish_rebuild
+import datetime
+import os
+import tempfile
+
+
+class FakeES():
+    # 本地的假ES，只实现bulk API，用来检查outbox同步的结果
+    def __init__(self):
+        self.docs = {}
+        self.requests = 0
+        self.down = False
+        self.pits = {}
+        self.closed = []
+
+    def bulk(self, body):
+        self.requests += 1
+        if self.down:
+            raise ConnectionError('es is down')
+        items = []
+        lines = iter(body)
+        for action in lines:
+            op, meta = list(action.items())[0]
+            key = (meta['_index'], int(meta['_id']))
+            if op == 'index':
+                self.docs[key] = next(lines)
+                items.append({op: {'_index': meta['_index'], '_id': str(meta['_id']), 'status': 200}})
+            elif key in self.docs:
+                del self.docs[key]
+                items.append({op: {'_index': meta['_index'], '_id': str(meta['_id']), 'status': 200}})
+            else:
+                items.append({op: {'_index': meta['_index'], '_id': str(meta['_id']), 'status': 404, 'error': 'not_found'}})
+        return {'errors': any('error' in list(i.values())[0] for i in items), 'items': items}
+
+    def search(self, body, index=None):
+        # 简单的子串匹配，分数都是1，_shard_doc就用文档id，支持search_after和point in time
+        self.requests += 1
+        pit = body['pit']['id']
+        if not pit.startswith('pit'):
+            raise RequestError(400, 'parse_exception', {})
+        if pit not in self.pits or pit in self.closed:
+            raise NotFoundError(404, 'search_context_missing_exception', {})
+        index = self.pits[pit]
+        query = body['query']['multi_match']['query']
+        reverse = body['sort'][0]['_score']['order'] == 'asc'
+        keys = sorted(([1.0, id] for (i, id), doc in self.docs.items()
+                       if i == index and query in ' '.join(map(str, doc.values()))), reverse=not reverse)
+        total = len(keys)
+        if 'search_after' in body:
+            keys = [key for key in keys if (key > body['search_after'] if reverse else key < body['search_after'])]
+        hits = [{'_id': str(key[1]), 'sort': key} for key in keys[:body['size']]]
+        return {'hits': {'hits': hits, 'total': {'value': total}}, 'pit_id': body['pit']['id']}
+
+    @property
+    def transport(self):
+        return self
+
+    def perform_request(self, method, url, params=None, body=None):
+        # 只用来打开和关闭point in time
+        self.requests += 1
+        if method == 'DELETE':
+            self.closed.append(body['id'])
+            return {'succeeded': True}
+        pit = 'pit%d' % len(self.pits)
+        self.pits[pit] = url.split('/')[1]
+        return {'id': pit}
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SEARCH_RETRY_BASE'] = 0
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+        self.es = FakeES()
+        self.saved_es = search.es
+        search.es = self.es
+        search.search_cache.local.clear()
+        search.search_cache.local.hits = search.search_cache.local.misses = 0
+        self.u = User(nickname='john', email='john@example.com')
+        db.session.add(self.u)
+        db.session.commit()
+
+    def tearDown(self):
+        last_seen_buffer.flush()
+        search.es = self.saved_es
+        app.config['SEARCH_CACHE_PREFETCH'] = 5
+        db.session.remove()
+        db.drop_all()
+
+    def add_post(self, body):
+        p = Post(body=body, author=self.u, timestamp=datetime.datetime.utcnow())
+        db.session.add(p)
+        db.session.commit()
+        return p
+
+    def test_outbox_written_in_transaction(self):
+        p = self.add_post('hello')
+        # 提交时不再访问ES，修改先写进outbox
+        assert self.es.requests == 0
+        assert outbox_stats()['depth'] == 1
+        assert drain() == 1
+        assert self.es.docs[('post', p.id)] == {'body': 'hello'}
+        assert outbox_stats() == {'depth': 0, 'lag': 0.0}
+
+    def test_rollback_discards_outbox(self):
+        db.session.add(Post(body='never', author=self.u))
+        db.session.flush()
+        db.session.rollback()
+        assert SearchOutbox.query.count() == 0
+
+    def test_coalesce_updates(self):
+        p = self.add_post('one')
+        p.body = 'two'
+        db.session.commit()
+        p.body = 'three'
+        db.session.commit()
+        q = self.add_post('gone')
+        db.session.delete(q)
+        db.session.commit()
+        assert outbox_stats()['depth'] == 5
+        drain()
+        # 同一个文档只同步一次最后的状态，所有修改用一次bulk请求完成
+        assert self.es.requests == 1
+        assert self.es.docs == {('post', p.id): {'body': 'three'}}
+        assert outbox_stats()['depth'] == 0
+
+    def test_retry_with_backoff(self):
+        app.config['SEARCH_RETRY_BASE'] = 60
+        p = self.add_post('hello')
+        self.es.down = True
+        drain()
+        row = SearchOutbox.query.one()
+        assert row.attempts == 1
+        assert row.next_attempt > datetime.datetime.utcnow() + datetime.timedelta(seconds=30)
+        # 还没到重试时间，不会再访问ES
+        self.es.down = False
+        assert drain() == 0
+        row.next_attempt = datetime.datetime.utcnow()
+        db.session.commit()
+        assert drain() == 1
+        assert ('post', p.id) in self.es.docs
+
+    def test_reindex_resume(self):
+        posts = [self.add_post('post %d' % i) for i in range(10)]
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'reindex.json')
+        # 从第4条之后继续，前面的数据不会再发送
+        done, last_id = reindex(Post, 'post', chunk_size=3, workers=2, checkpoint=checkpoint, after_id=posts[3].id)
+        assert done == 6
+        assert last_id == posts[-1].id
+        assert sorted(id for index, id in self.es.docs) == [p.id for p in posts[4:]]
+        assert self.es.requests == 2
+        assert load_checkpoint(checkpoint) == {'index': 'post', 'last_id': posts[-1].id}
+
+    def test_swap_replays_changes(self):
+        posts = [self.add_post('post %d' % i) for i in range(3)]
+        drain()
+        # reindex.py --swap：先记下outbox的位置，再全量读取
+        mark = start_rebuild('post', 'post_new')
+        reindex(Post, 'post_new', chunk_size=2, workers=1)
+        # 全量读完以后的修改只被search_worker.py写进了旧的索引
+        posts[0].body = 'edited'
+        db.session.delete(posts[1])
+        db.session.commit()
+        new = self.add_post('new post')
+        drain()
+        assert self.es.docs[('post_new', posts[0].id)] == {'body': 'post 0'}
+        # 同步过的记录留着重放，不算在队列深度里
+        assert outbox_stats()['depth'] == 0
+        done, mark = replay('post', 'post_new', mark)
+        assert done == 3
+        assert self.es.docs[('post_new', posts[0].id)] == {'body': 'edited'}
+        assert ('post_new', posts[1].id) not in self.es.docs
+        assert self.es.docs[('post_new', new.id)] == {'body': 'new post'}
+        # 没有新的修改就不再重放
+        assert replay('post', 'post_new', mark) == (0, mark)
+        finish_rebuild('post')
+        assert SearchOutbox.query.count() == 0
+        # 重建结束以后同步过的记录直接删除
+        self.add_post('later')
+        drain()
+        assert SearchOutbox.query.count() == 0
+
+    def search_pages(self, query, per_page, with_total=True):
+        # 一直往后翻到最后一页，返回每一页的博客id和最后一页
+        pages = []
+        page = Post.search(query, per_page, None, with_total)
+        pages.append([p.id for p in page.items])
+        while page.has_next:
+            page = Post.search(query, per_page, page.next_cursor, with_total)
+            pages.append([p.id for p in page.items])
+        return pages, page
+
+    def test_search_cursor(self):
+        app.config['SEARCH_CACHE_PREFETCH'] = 2
+        posts = [self.add_post('cursor %d' % i) for i in range(7)]
+        drain()
+        ids = [p.id for p in reversed(posts)]
+        pages, last = self.search_pages('cursor', 2)
+        assert pages == [ids[0:2], ids[2:4], ids[4:6], ids[6:]]
+        assert last.total == 7
+        # 往回翻，每一页都能回到原来的内容
+        page = last
+        back = []
+        while page.has_prev:
+            page = Post.search('cursor', 2, page.prev_cursor)
+            back.append([p.id for p in page.items])
+        assert back == [ids[4:6], ids[2:4], ids[0:2]]
+        assert Post.search('cursor', 2, None, with_total=False).total is None
+
+    def test_search_cursor_stable(self):
+        app.config['SEARCH_CACHE_PREFETCH'] = 1
+        posts = [self.add_post('stable %d' % i) for i in range(4)]
+        drain()
+        first = Post.search('stable', 2)
+        # 翻页期间有新的博客，下一页不会重复已经看过的结果
+        self.add_post('stable new')
+        drain()
+        second = Post.search('stable', 2, first.next_cursor)
+        assert [p.id for p in second.items] == [posts[1].id, posts[0].id]
+
+    def test_invalid_search_cursor(self):
+        self.add_post('hello')
+        drain()
+        with self.assertRaises(search.InvalidCursor):
+            Post.search('hello', 2, 'garbage')
+        with self.app.session_transaction() as session:
+            session['user_id'] = str(self.u.id)
+            session['_fresh'] = True
+        # 404页面的处理函数没有设置状态码，所以检查页面内容
+        assert b'File Not Fount' in self.app.get('/search?q=hello&cursor=garbage').data
+
+    def test_search_pit_lifetime(self):
+        app.config['SEARCH_CACHE_PREFETCH'] = 1
+        posts = [self.add_post('pit %d' % i) for i in range(5)]
+        drain()
+        # 一块就装得下所有结果时不需要翻页，point in time马上关闭，游标里也没有
+        page = Post.search('pit', 5)
+        assert not page.has_next
+        assert self.es.closed == ['pit0']
+        # 翻页时一直使用游标里的point in time，不会每一页都打开新的
+        pages, last = self.search_pages('pit', 2)
+        assert pages == [[p.id for p in reversed(posts)][i:i + 2] for i in (0, 2, 4)]
+        assert sorted(self.es.pits) == ['pit0', 'pit1']
+        assert self.es.closed == ['pit0', 'pit1']
+        assert search.decode_cursor(last.prev_cursor)[3] is None
+
+    def test_search_pit_reopened(self):
+        app.config['SEARCH_CACHE_PREFETCH'] = 1
+        posts = [self.add_post('reopen %d' % i) for i in range(5)]
+        drain()
+        ids = [p.id for p in reversed(posts)]
+        first = Post.search('reopen', 2)
+        anchor, reverse, offset, pit = search.decode_cursor(first.next_cursor)
+        # point in time过期了或者被改坏了，都重新打开一个接着翻
+        search.close_pit(pit)
+        for bad in (pit, 'garbage'):
+            search.search_cache.local.clear()
+            page = Post.search('reopen', 2, search.encode_cursor(anchor, reverse, offset, bad))
+            assert [p.id for p in page.items] == ids[2:4]
+        assert sorted(self.es.pits) == ['pit0', 'pit1', 'pit2']
+
+    def test_abandoned_pit_closed(self):
+        app.config['SEARCH_CACHE_PREFETCH'] = 1
+        for i in range(5):
+            self.add_post('alpha %d' % i)
+            self.add_post('beta %d' % i)
+        drain()
+        with self.app.session_transaction() as session:
+            session['user_id'] = str(self.u.id)
+            session['_fresh'] = True
+        assert self.app.get('/search?q=alpha').status_code == 200
+        assert self.es.closed == []
+        # 没翻完就换了关键字，上一次搜索的point in time马上关闭，不用等keep_alive过期
+        rv = self.app.get('/search?q=beta')
+        assert rv.status_code == 200
+        assert self.es.closed == ['pit0']
+        with self.app.session_transaction() as session:
+            assert session['search_pit'] == 'pit1'
+        # 翻页还是用这次搜索的point in time，翻到最后关闭
+        cursor = Post.search('beta', 3, None, app.config['SEARCH_TRACK_TOTAL']).next_cursor
+        assert self.app.get('/search?q=beta&cursor=' + cursor).status_code == 200
+        assert sorted(self.es.pits) == ['pit0', 'pit1']
+        assert self.es.closed == ['pit0', 'pit1']
+        with self.app.session_transaction() as session:
+            assert 'search_pit' not in session
+
+    def test_decode_cursor(self):
+        cursor = search.encode_cursor([1.0, 7], False, 2, 'pit0')
+        assert search.decode_cursor(cursor) == ([1.0, 7], False, 2, 'pit0')
+        for bad in ([[1.0], 0, 0, None], [[1.0, 'x'], 0, 0, None], [[True, 1], 0, 0, None], [{}, 0, 0, None],
+                    [None, 2, 0, None], [None, 0, -1, None], [None, 0, 0, 5], [None, 0, 0, ['pit']], [None, 0, 0]):
+            raw = search.urlsafe_b64encode(search.json.dumps(bad).encode('utf-8')).decode('ascii')
+            with self.assertRaises(search.InvalidCursor):
+                search.decode_cursor(raw)
+
+    def test_search_cache(self):
+        app.config['SEARCH_CACHE_PREFETCH'] = 2
+        posts = [self.add_post('cached %d' % i) for i in range(5)]
+        drain()
+        requests = self.es.requests
+        ids = [p.id for p in reversed(posts)]
+        first = Post.search('cached', 2)
+        assert [p.id for p in first.items] == ids[:2] and first.total == 5
+        # 第二页已经随第一页一起取回来了，重复的查询也直接命中缓存
+        second = Post.search('cached', 2, first.next_cursor)
+        assert [p.id for p in second.items] == ids[2:4]
+        assert [p.id for p in Post.search('cached', 2).items] == ids[:2]
+        # 打开point in time和搜索各一次请求
+        assert self.es.requests == requests + 2
+        assert [p.id for p in Post.search('cached', 2, second.next_cursor).items] == ids[4:]
+        # 翻到最后一块时关闭point in time
+        assert self.es.requests == requests + 4
+        assert self.es.closed == ['pit0']
+        assert search.search_cache_stats()['hit_rate'] == 0.5
+
+    def test_search_cache_invalidated(self):
+        self.add_post('fresh one')
+        drain()
+        assert Post.search('fresh', 3).total == 1
+        generation = search.generation('post')
+        # 提交和同步到ES时都会让缓存失效，新的博客马上能搜到
+        self.add_post('fresh two')
+        assert search.generation('post') != generation
+        drain()
+        assert Post.search('fresh', 3).total == 2
+
+    def test_search_cache_invalidated_by_worker(self):
+        # 没有共享缓存层时，search_worker.py进程同步完以后数据库里的代数加一，web进程的缓存也失效
+        self.add_post('worker one')
+        drain()
+        assert Post.search('worker', 3).total == 1
+        self.add_post('worker two')
+        # 模拟另一个进程：它自己提交引起的代数变化这里看不到
+        search.generations.clear()
+        generation = search.generation('post')
+        assert Post.search('worker', 3).total == 1
+        drain()
+        assert search.generation('post') != generation
+        assert Post.search('worker', 3).total == 2
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,167 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db
+from app.models import User, Post, timeline
+from app.timeline import home_timeline, newest_timestamp
+import app.timeline as timeline_module
+import datetime
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['TIMELINE_ENABLED'] = True
+        app.config['TIMELINE_LENGTH'] = 3
+        app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+        app.config['TIMELINE_TRIM_INTERVAL'] = 1
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        app.config['TIMELINE_ENABLED'] = False
+
+    def make_users(self, *names):
+        users = [User(nickname=name, email=name + '@example.com') for name in names]
+        for u in users:
+            db.session.add(u)
+        db.session.commit()
+        return users
+
+    def make_post(self, author, seconds):
+        utcnow = datetime.datetime(2019, 10, 1)
+        p = Post(body='Post from ' + author.nickname, author=author, timestamp=utcnow+datetime.timedelta(seconds=seconds))
+        db.session.add(p)
+        db.session.commit()
+        return p
+
+    def entries(self, user):
+        return db.session.query(timeline.c.post_id).filter(timeline.c.user_id == user.id).count()
+
+    def test_fan_out(self):
+        u1, u2, u3 = self.make_users('john', 'susan', 'mary')
+        u1.follow(u2)
+        u3.follow(u2)
+        db.session.commit()
+        p1 = self.make_post(u2, 1)
+        # 博客被推送到了两个粉丝的时间线里
+        assert self.entries(u1) == 1
+        assert self.entries(u3) == 1
+        assert home_timeline(u1, 3).all() == [p1]
+        assert home_timeline(u1, 3).all() == u1.followed_posts().all()
+
+    def test_follow_backfill_and_unfollow_prune(self):
+        u1, u2 = self.make_users('john', 'susan')
+        p1 = self.make_post(u2, 1)
+        p2 = self.make_post(u2, 2)
+        assert self.entries(u1) == 0
+        u1.follow(u2)
+        db.session.commit()
+        assert home_timeline(u1, 3).all() == [p2, p1]
+        u1.unfollow(u2)
+        db.session.commit()
+        assert self.entries(u1) == 0
+        assert home_timeline(u1, 3).all() == []
+
+    def test_bounded_length(self):
+        u1, u2 = self.make_users('john', 'susan')
+        u1.follow(u2)
+        db.session.commit()
+        posts = [self.make_post(u2, i) for i in range(5)]
+        # 只保留最新的TIMELINE_LENGTH条
+        assert self.entries(u1) == 3
+        assert home_timeline(u1, 3).all() == posts[:1:-1]
+        # 翻页超过时间线长度时，回落到join查询
+        assert home_timeline(u1, 6).all() == posts[::-1]
+
+    def test_unfollow_refills(self):
+        u1, u2, u3 = self.make_users('john', 'susan', 'mary')
+        u1.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+        older = [self.make_post(u3, i) for i in range(2)]
+        newer = [self.make_post(u2, 10 + i) for i in range(3)]
+        # 时间线里只剩susan的3条
+        assert self.entries(u1) == 3
+        assert home_timeline(u1, 3).all() == newer[::-1]
+        u1.unfollow(u2)
+        db.session.commit()
+        # 取消关注后从mary的博客补回来，而不是变成空的
+        assert home_timeline(u1, 3).all() == older[::-1]
+        assert home_timeline(u1, 3).all() == u1.followed_posts().all()
+
+    def test_delete_refills(self):
+        u1, u2 = self.make_users('john', 'susan')
+        u1.follow(u2)
+        db.session.commit()
+        posts = [self.make_post(u2, i) for i in range(5)]
+        db.session.delete(posts[4])
+        db.session.commit()
+        assert self.entries(u1) == 3
+        assert home_timeline(u1, 3).all() == posts[3::-1][:3]
+
+    def test_delete_refills_only_short_timelines(self):
+        # john的时间线还没截断，删掉一条还有4条，不需要补；mary的只有3条，删掉后要补
+        app.config['TIMELINE_TRIM_INTERVAL'] = 1000
+        u1, u2, u3 = self.make_users('john', 'susan', 'mary')
+        u1.follow(u2)
+        db.session.commit()
+        posts = [self.make_post(u2, i) for i in range(5)]
+        u3.follow(u2)
+        db.session.commit()
+        assert (self.entries(u1), self.entries(u3)) == (5, 3)
+        calls = []
+        saved = timeline_module.refill
+        timeline_module.refill = lambda conn, user_ids: calls.append(list(user_ids)) or saved(conn, user_ids)
+        try:
+            db.session.delete(posts[4])
+            db.session.commit()
+        finally:
+            timeline_module.refill = saved
+        assert calls == [[u3.id]]
+        assert (self.entries(u1), self.entries(u3)) == (4, 3)
+        assert home_timeline(u3, 3).all() == posts[3:0:-1]
+
+    def test_busy_author_read_time_merge(self):
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        u1, u2, u3 = self.make_users('john', 'susan', 'mary')
+        u1.follow(u2)
+        u3.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+        p1 = self.make_post(u2, 1)
+        p2 = self.make_post(u3, 2)
+        # susan有两个粉丝，超过了阈值，她的博客不再写扩散
+        assert User.query.get(u2.id).timeline_pull
+        assert self.entries(u1) == 1
+        assert home_timeline(u1, 3).all() == [p2, p1]
+
+    def test_newest_timestamp(self):
+        # 条件GET用的最新时间，时间线里的和读扩散的大V的博客都算
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        u1, u2, u3 = self.make_users('john', 'susan', 'mary')
+        assert newest_timestamp(u1) is None
+        u1.follow(u3)
+        db.session.commit()
+        p1 = self.make_post(u3, 1)
+        assert newest_timestamp(u1) == p1.timestamp
+        u1.follow(u2)
+        u3.follow(u2)
+        db.session.commit()
+        p2 = self.make_post(u2, 2)
+        assert User.query.get(u2.id).timeline_pull
+        assert newest_timestamp(u1) == p2.timestamp
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,253 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db, trending
+from app.trending import CountMinSketch, TrendingTerms, post_terms, refresh_trending, trending_terms
+from app.models import User, Post
+from app.last_seen import last_seen_buffer
+from collections import Counter
+import datetime
+import json
+import random
+import threading
+import time
+
+
+def epoch(timestamp):
+    return (timestamp - datetime.datetime(1970, 1, 1)).total_seconds()
+
+
+class SketchTestCase(unittest.TestCase):
+    # 不需要数据库
+    def test_post_terms(self):
+        assert post_terms('The #Flask release is out, flask 2 is out!') == ['#flask', 'flask', 'release']
+        # 连续的汉字只取bigram
+        assert post_terms(u'今天天气') == [u'今天', u'天天', u'天气']
+
+    def test_sketch_never_underestimates(self):
+        sketch = CountMinSketch(256, 4)
+        random.seed(1)
+        words = ['w%d' % i for i in range(2000)]
+        exact = Counter(random.choice(words) for i in range(20000))
+        terms = sorted(exact)
+        columns = sketch.columns(terms)
+        sketch.add(columns, [[exact[term]] for term in terms])
+        estimates = sketch.estimate(columns)
+        errors = [int(estimate) - exact[term] for term, estimate in zip(terms, estimates)]
+        assert min(errors) >= 0
+        # 多估的部分大多不超过总数 * e / width
+        bound = 20000 * 2.72 / 256
+        assert sum(1 for error in errors if error > bound) < 0.05 * len(errors)
+
+    def test_top_terms(self):
+        stats = TrendingTerms(600, 6, 1024, 4, 2)
+        now = datetime.datetime(2019, 10, 1, 12, 0)
+        for i in range(5):
+            stats.add(['flask'], now)
+        for i in range(3):
+            stats.add(['python'], now)
+        for i in range(40):
+            stats.add(['word%d' % i], now)
+        stats.add(['python'], now)
+        assert stats.top(2, now=epoch(now)) == [('flask', 5), ('python', 4)]
+        # 删除博客
+        stats.add(['flask'], now, -1)
+        stats.add(['flask'], now, -1)
+        assert stats.top(1, now=epoch(now)) == [('python', 4)]
+
+    def test_window_slides(self):
+        stats = TrendingTerms(600, 6, 1024, 4, 5)
+        start = datetime.datetime(2019, 10, 1, 12, 0)
+        stats.add(['old'], start)
+        stats.add(['old'], start)
+        stats.add(['new'], start + datetime.timedelta(seconds=300))
+        assert stats.top(5, now=epoch(start) + 300) == [('old', 2), ('new', 1)]
+        # 窗口是600秒，第一个桶滑出去以后old就不见了
+        assert stats.top(5, now=epoch(start) + 600) == [('new', 1)]
+        assert stats.estimate('old') == 0
+        # 窗口以前的博客不计数
+        stats.add(['old'], start)
+        assert stats.estimate('old') == 0
+        assert stats.top(5, now=epoch(start) + 1000) == []
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+        john = User(nickname='john', email='john@example.com')
+        susan = User(nickname='susan', email='susan@example.com')
+        db.session.add_all([john, susan])
+        db.session.commit()
+        self.john = john.id
+        self.susan = susan.id
+        now = datetime.datetime.utcnow()
+        db.session.add_all([
+            Post(body='#flask is great', user_id=john.id, timestamp=now),
+            Post(body='learning #Flask and python', user_id=john.id, timestamp=now),
+            Post(body='python python python', user_id=john.id, timestamp=now),
+            # 窗口以前的博客不算
+            Post(body='ancient python', user_id=john.id, timestamp=now - datetime.timedelta(days=1)),
+        ])
+        db.session.commit()
+        refresh_trending()
+        with self.app.session_transaction() as session:
+            session['user_id'] = str(john.id)
+            session['_fresh'] = True
+
+    def tearDown(self):
+        self.wait_for(lambda: trending.syncing is None)
+        trending.failed_at = 0
+        last_seen_buffer.flush()
+        app.config['TRENDING_ENABLED'] = True
+        db.session.remove()
+        db.drop_all()
+        trending.trending = None
+
+    def wait_for(self, condition):
+        for i in range(100):
+            if condition():
+                return
+            time.sleep(0.02)
+
+    def sync(self):
+        # 让下一次使用时在后台补读，等它完成
+        trending.synced_at = 0
+        trending_terms()
+        self.wait_for(lambda: trending.syncing is None and trending.synced_at)
+
+    def test_rebuild(self):
+        assert trending_terms() == [('#flask', 2), ('python', 2)]
+
+    def test_commit_events(self):
+        db.session.add(Post(body='more #flask', user_id=self.john, timestamp=datetime.datetime.utcnow()))
+        db.session.commit()
+        assert trending_terms()[0] == ('#flask', 3)
+        # 回滚的博客不计数
+        db.session.add(Post(body='#flask again', user_id=self.john, timestamp=datetime.datetime.utcnow()))
+        db.session.flush()
+        db.session.rollback()
+        assert trending_terms()[0] == ('#flask', 3)
+        # 删除的博客减掉
+        post = Post.query.filter_by(body='#flask is great').first()
+        db.session.delete(post)
+        db.session.commit()
+        assert trending_terms() == [('#flask', 2), ('python', 2)]
+
+    def test_catch_up(self):
+        # 绕过ORM写入的博客（其他进程、ingest.py）在下一次同步时补上，提交事件已经计入的不重复计数
+        db.session.add(Post(body='python tips', user_id=self.john, timestamp=datetime.datetime.utcnow()))
+        db.session.commit()
+        db.session.execute(Post.__table__.insert(), [{'body': 'python #flask', 'user_id': self.john,
+                                                      'timestamp': datetime.datetime.utcnow()}])
+        db.session.commit()
+        assert trending_terms()[0] == ('python', 3)
+        self.sync()
+        assert trending_terms() == [('python', 4), ('#flask', 3)]
+        self.sync()
+        assert trending_terms() == [('python', 4), ('#flask', 3)]
+        # 重新从post表建立的结果一样
+        refresh_trending()
+        assert trending_terms() == [('python', 4), ('#flask', 3)]
+
+    def test_sync_in_background(self):
+        db.session.execute(Post.__table__.insert(), [{'body': 'python', 'user_id': self.john,
+                                                      'timestamp': datetime.datetime.utcnow()}])
+        db.session.commit()
+        # 补读在后台线程里，请求不等待，先用现有的统计
+        loading = threading.Event()
+        calls = []
+        saved = trending.sync_trending
+        trending.sync_trending = lambda: calls.append(1) or (loading.wait() and saved())
+        try:
+            trending.synced_at = 0
+            assert trending_terms()[:1] == [('#flask', 2)]
+            # 已经有线程在补读时不再启动新的
+            assert trending_terms()[:1] == [('#flask', 2)]
+            loading.set()
+            self.wait_for(lambda: trending.syncing is None)
+        finally:
+            trending.sync_trending = saved
+        assert len(calls) == 1
+        assert trending_terms() == [('python', 3), ('#flask', 2)]
+        # 补读已经计入的博客，提交事件来晚了也不会再算一次
+        post = Post.query.filter_by(body='python').one()
+        trending.count_posts(type('Session', (), {'info': {'trending_changes': [(post.id, post.body, post.timestamp, 1)]}})())
+        assert trending_terms() == [('python', 3), ('#flask', 2)]
+
+    def test_first_load_in_background(self):
+        # 第一次加载完成之前首页不显示热门话题
+        trending.trending = None
+        loading = threading.Event()
+        saved = trending.refresh_trending
+        trending.refresh_trending = lambda: loading.wait() and saved()
+        try:
+            assert trending_terms() == []
+            assert b'Trending:' not in self.app.get('/index').data
+            loading.set()
+            self.wait_for(lambda: trending.trending is not None)
+        finally:
+            trending.refresh_trending = saved
+        assert trending_terms() == [('#flask', 2), ('python', 2)]
+
+    def test_failed_load(self):
+        calls = []
+
+        def broken():
+            calls.append(1)
+            raise IOError('database is down')
+
+        trending.trending = None
+        saved = trending.refresh_trending
+        trending.refresh_trending = broken
+        try:
+            trending_terms()
+            self.wait_for(lambda: trending.failed_at and trending.syncing is None)
+            # 失败以后隔一段时间才重试，不会每个请求都去读post表
+            assert trending_terms() == []
+            assert trending_terms() == []
+            assert len(calls) == 1
+            trending.failed_at -= trending.retry_interval()
+            trending.refresh_trending = saved
+            trending_terms()
+            self.wait_for(lambda: trending.trending is not None)
+        finally:
+            trending.refresh_trending = saved
+        assert trending_terms() == [('#flask', 2), ('python', 2)]
+
+    def test_index(self):
+        rv = self.app.get('/index')
+        assert b'Trending:' in rv.data
+        assert b'>#flask</a>' in rv.data
+        etag = rv.headers['ETag']
+        rv = self.app.get('/index', headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        # john没有关注susan，但susan的博客改变了热门话题，首页也要重新渲染
+        db.session.add(Post(body='django django', user_id=self.susan, timestamp=datetime.datetime.utcnow()))
+        db.session.add(Post(body='django', user_id=self.susan, timestamp=datetime.datetime.utcnow()))
+        db.session.commit()
+        rv = self.app.get('/index', headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        assert b'>django</a>' in rv.data
+        rv = self.app.get('/api/trending')
+        terms = json.loads(rv.data.decode('utf-8'))['terms']
+        assert {'term': 'django', 'posts': 2} in terms
+
+    def test_disabled(self):
+        app.config['TRENDING_ENABLED'] = False
+        rv = self.app.get('/index')
+        assert b'Trending:' not in rv.data
+        assert trending_terms() == []
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+#!flask/venv/bin/pyhton
+
+import unittest
+import sys
+sys.path.append('/home/haow/microblog')
+from app import app, db
+from app.cache import LRUCache
+from app.models import User, user_cache, get_user, get_user_by_nickname
+import time
+
+
+class TestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        DB_USER_NAME = 'postgres'
+        DB_PASSWD = '123456'
+        DB_HOST = 'localhost'
+        DB_NAME = 'test'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'postgresql+psycopg2://{}:{}@{}/{}'.format(DB_USER_NAME, DB_PASSWD, DB_HOST, DB_NAME)
+        self.app = app.test_client()
+        db.create_all()
+        user_cache.local.clear()
+        self.u = User(nickname='john', email='john@example.com', about_me='hi')
+        db.session.add(self.u)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        user_cache.local.clear()
+
+    def test_lru_eviction_and_ttl(self):
+        cache = LRUCache(2, 60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+        # b是最久没有使用的，被淘汰了
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        cache.set('d', 4, ttl=0.01)
+        time.sleep(0.02)
+        assert cache.get('d') is None
+        assert cache.hits == 2
+        assert cache.misses == 2
+
+    def test_hit_after_first_load(self):
+        id = self.u.id
+        db.session.remove()
+        hits = user_cache.local.hits
+        u = get_user(id)
+        assert user_cache.local.hits == hits
+        db.session.remove()
+        u = get_user(id)
+        assert user_cache.local.hits == hits + 1
+        assert u.about_me == 'hi'
+        # 从缓存还原的对象挂在session上，动态关系照样能查询
+        assert u.followed.count() == 0
+        assert get_user_by_nickname('john').id == id
+        assert get_user_by_nickname('nobody') is None
+
+    def test_invalidate_on_commit(self):
+        assert get_user_by_nickname('john').about_me == 'hi'
+        db.session.remove()
+        u = get_user_by_nickname('john')
+        u.nickname = 'johnny'
+        u.about_me = 'changed'
+        db.session.commit()
+        db.session.remove()
+        assert get_user_by_nickname('john') is None
+        assert get_user_by_nickname('johnny').about_me == 'changed'
+
+    def test_rollback_keeps_cache(self):
+        id = self.u.id
+        u = get_user(id)
+        u.about_me = 'not saved'
+        db.session.flush()
+        db.session.rollback()
+        db.session.remove()
+        assert get_user(id).about_me == 'hi'
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,15 @@
+#!flask/venv/bin/python
+
+from app import db
+from app.models import User
+from app.timeline import rebuild
+
+# 在打开TIMELINE_ENABLED之前，用这个脚本为已有的用户生成时间线，之后的维护由发博客和关注时的写扩散完成
+# 每个用户单独提交一次，中途失败的话重新执行即可
+ids = [row.id for row in db.session.query(User.id).order_by(User.id)]
+for n, user_id in enumerate(ids, 1):
+    rebuild(db.session.connection(), user_id)
+    db.session.commit()
+    if n % 1000 == 0:
+        print('%d/%d users rebuilt' % (n, len(ids)))
+print('Timeline rebuilt for %d users' % len(ids))